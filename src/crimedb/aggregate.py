@@ -0,0 +1,336 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Single-pass aggregation of crimes from month files.
+
+An aggregator computes some summary (a grid, a timeseries, etc) of the crimes
+that it is fed. aggregate_month_files() reads each month file in a time range
+at most once, parsing each crime's time once, and feeds the result to any
+number of aggregators. Aggregators that only need counts of crimes per day
+are fed from the region's counts table (see crimedb.counts) instead, and never
+cause month files to be read.
+'''
+
+from collections import defaultdict
+import crimedb.core
+import crimedb.counts
+import crimedb.cube
+import crimedb.monthfile
+import crimedb.timecodec
+import crimedb.www
+import datetime
+import logging
+import os.path
+import unittest
+
+__LOGGER = logging.getLogger(__name__)
+
+
+class Aggregator(object):
+    '''
+    Base class for all aggregators.
+    '''
+
+    # Whether or not this aggregator can consume cubes via add_month_cube().
+    # If any aggregator in a pass cannot, all month files are read in full.
+    uses_cubes = False
+
+    # Whether or not this aggregator can consume partitions of a counts table
+    # via add_month_counts(), in which case it is fed from the table whenever
+    # it covers a month
+    uses_counts = False
+
+    def add_crime(self, crime_obj, crime_time):
+        '''
+        Add a crime JSON object to the aggregate. The crime's time has already
+        been parsed into a datetime.datetime object.
+        '''
+
+        pass
+
+    def add_month_cube(self, cube):
+        '''
+        Add all of the crimes in a month cube to the aggregate.
+        '''
+
+        raise NotImplementedError()
+
+    def add_month_counts(self, month_fn, month_counts):
+        '''
+        Add all of the crimes in the counts table partition for the given
+        month file to the aggregate.
+        '''
+
+        raise NotImplementedError()
+
+
+class GridAggregator(Aggregator):
+    '''
+    Aggregator that computes an {x => {y => count}} grid of crimes with a
+    location at the given zoom level.
+    '''
+
+    uses_cubes = True
+
+    def __init__(self, zoom):
+        self.zoom = zoom
+        self.grid = crimedb.www.grid_from_crimes([], zoom)
+
+    def add_crime(self, crime_obj, crime_time):
+        if 'geo' not in crime_obj:
+            return
+
+        lon, lat = crime_obj['geo']['coordinates']
+        x, y = crimedb.www.slippy_tile_coordinates_from_point(
+                lon, lat, self.zoom)
+        self.grid[x][y] += 1
+
+    def add_month_cube(self, cube):
+        if cube['zoom'] != self.zoom:
+            raise ValueError('cube zoom {} does not match grid zoom {}'.format(
+                    cube['zoom'], self.zoom))
+
+        crimedb.cube.grid_from_month_cube(cube, self.grid)
+
+
+class _DayAggregator(Aggregator):
+    '''
+    Base class for aggregators that only care about the (local) day on which a
+    crime occurred.
+    '''
+
+    uses_cubes = True
+    uses_counts = True
+
+    def add_crime(self, crime_obj, crime_time):
+        self.add_day(crime_time.date(), 1)
+
+    def add_month_counts(self, month_fn, month_counts):
+        for date, count in sorted(crimedb.counts.month_counts_days(
+                month_fn, month_counts).items()):
+            self.add_day(date, count)
+
+    def add_month_cube(self, cube):
+        for day, count in cube['days'].items():
+            self.add_day(
+                    datetime.datetime.strptime(day, '%Y-%m-%d').date(),
+                    count)
+
+    def add_day(self, date, count):
+        '''
+        Add the given number of crimes on the given datetime.date.
+        '''
+
+        raise NotImplementedError()
+
+
+class MonthAggregator(_DayAggregator):
+    '''
+    Aggregator that computes a {'YYYY' => [count, ...]} dictionary of crimes
+    per month of each year.
+    '''
+
+    def __init__(self):
+        self.counts = defaultdict(lambda: [0] * 12)
+
+    def add_day(self, date, count):
+        self.counts[date.strftime('%Y')][date.month - 1] += count
+
+    def add_month_counts(self, month_fn, month_counts):
+        # Every crime in the partition is in the same month
+        if month_counts['count']:
+            self.counts[month_fn[0:4]][int(month_fn[5:7]) - 1] += \
+                    sum(month_counts['count'])
+
+
+class WeekdayAggregator(_DayAggregator):
+    '''
+    Aggregator that computes a {'YYYY' => [count, ...]} dictionary of crimes
+    per weekday of each year.
+    '''
+
+    def __init__(self):
+        self.counts = defaultdict(lambda: [0] * 7)
+
+    def add_day(self, date, count):
+        self.counts[date.strftime('%Y')][date.weekday() - 1] += count
+
+
+class OffenseAggregator(Aggregator):
+    '''
+    Aggregator that feeds crimes to a separate aggregator for each offense
+    code, created by calling the given factory. The aggregators are in the
+    offenses dictionary, keyed by code.
+
+    Crimes without an offense code are ignored.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.offenses = {}
+        self.uses_cubes = factory().uses_cubes
+        self.uses_counts = factory().uses_counts
+
+    def _aggregator(self, code):
+        a = self.offenses.get(code)
+        if a is None:
+            a = self.factory()
+            self.offenses[code] = a
+
+        return a
+
+    def add_crime(self, crime_obj, crime_time):
+        code = crime_obj.get('offense')
+        if code is None:
+            return
+
+        self._aggregator(code).add_crime(crime_obj, crime_time)
+
+    def add_month_cube(self, cube):
+        # Cubes written before offense codes existed have no offense cubes,
+        # but neither do their month files have codes
+        for code, oc in cube.get('offenses', {}).items():
+            self._aggregator(int(code)).add_month_cube(oc)
+
+    def add_month_counts(self, month_fn, month_counts):
+        for code, oc in sorted(crimedb.counts.month_counts_by_offense(
+                month_counts).items()):
+            self._aggregator(code).add_month_counts(month_fn, oc)
+
+
+def aggregate_month_files(region_path, time_from, time_to, aggregators):
+    '''
+    Feed all crimes from the month files in the given region directory that
+    occurred within the (inclusive) range [time_from, time_to] to each of the
+    given aggregators.
+
+    Months entirely within the range are fed to aggregators that can use the
+    region's counts table from that, and to the rest from their cubes, if they
+    have one and all of the rest can use it.
+    '''
+
+    counts = crimedb.counts.read_region_counts(
+            crimedb.counts.region_counts_path(region_path))
+
+    all_aggregators = list(aggregators)
+    for fn in sorted(crimedb.monthfile.month_filenames_for_date_range(
+            time_from, time_to)):
+        fp = os.path.join(region_path, fn)
+        if not os.path.isfile(fp):
+            continue
+
+        aggregators = all_aggregators
+        mc = counts.get(fn)
+        if mc and crimedb.counts.month_counts_covered(mc, time_from, time_to):
+            __LOGGER.debug('using counts table for {}'.format(fp))
+            for a in aggregators:
+                if a.uses_counts:
+                    a.add_month_counts(fn, mc)
+
+            aggregators = [a for a in aggregators if not a.uses_counts]
+            if not aggregators:
+                continue
+
+        if all(a.uses_cubes for a in aggregators):
+            cube = crimedb.cube.read_month_cube(
+                    crimedb.cube.month_cube_path(fp))
+            if cube and crimedb.cube.month_cube_covered(
+                    cube, time_from, time_to):
+                __LOGGER.debug('using cube for {}'.format(fp))
+                for a in aggregators:
+                    a.add_month_cube(cube)
+                continue
+
+        crime_objs = crimedb.monthfile.read_month_crimes(
+                fp, time_from, time_to)
+        __LOGGER.debug('{} crimes from {} matched time range'.format(
+                len(crime_objs), fp))
+
+        for co in crime_objs:
+            ct = crimedb.timecodec.parse_time(co['time'])
+            for a in aggregators:
+                a.add_crime(co, ct)
+
+
+class AggregatorTests(unittest.TestCase):
+    '''
+    Tests for aggregators.
+    '''
+
+    def test_cube_equivalence(self):
+        '''
+        Verify that aggregators compute the same results whether they are fed
+        crimes, a cube of those crimes or a counts table of them.
+        '''
+
+        crime_objs = [
+            {'description': 'a', 'time': '2014-01-01T23:30:00-0600',
+             'geo': {'type': 'Point', 'coordinates': [-90.2, 38.6]},
+             'offense': 0},
+            {'description': 'b', 'time': '2014-01-06T00:30:00-0600',
+             'geo': {'type': 'Point', 'coordinates': [-90.3, 38.6]},
+             'offense': 1},
+            {'description': 'a', 'time': '2014-01-06T01:30:00-0600',
+             'offense': 0},
+        ]
+        cube = crimedb.cube.month_cube_from_crimes(crime_objs, 17)
+        month_counts = crimedb.counts.month_counts_from_crimes(crime_objs)
+
+        def state(a):
+            if isinstance(a, OffenseAggregator):
+                return {code: vars(oa) for code, oa in a.offenses.items()}
+
+            return vars(a)
+
+        for factory in [
+                lambda: GridAggregator(17),
+                MonthAggregator,
+                WeekdayAggregator,
+                lambda: OffenseAggregator(lambda: GridAggregator(17)),
+                lambda: OffenseAggregator(MonthAggregator)]:
+            from_crimes = factory()
+            for co in crime_objs:
+                from_crimes.add_crime(
+                        co,
+                        datetime.datetime.strptime(
+                            co['time'], crimedb.core.RFC3999_STRFTIME_FORMAT))
+
+            from_cube = factory()
+            from_cube.add_month_cube(cube)
+
+            self.assertEqual(state(from_crimes), state(from_cube))
+
+            if from_crimes.uses_counts:
+                from_counts = factory()
+                from_counts.add_month_counts('2014-01.json', month_counts)
+
+                self.assertEqual(state(from_crimes), state(from_counts))
+
+    def test_offense_aggregator(self):
+        '''
+        Verify that OffenseAggregator aggregates each offense separately.
+        '''
+
+        oa = OffenseAggregator(MonthAggregator)
+        for co in [
+                {'time': '2014-01-01T00:00:00-0600', 'offense': 0},
+                {'time': '2014-02-01T00:00:00-0600', 'offense': 0},
+                {'time': '2014-02-01T00:00:00-0600', 'offense': 1},
+                {'time': '2014-02-01T00:00:00-0600'}]:
+            oa.add_crime(co, crimedb.timecodec.parse_time(co['time']))
+
+        self.assertEqual(sorted(oa.offenses), [0, 1])
+        self.assertEqual(oa.offenses[0].counts['2014'][0:2], [1, 1])
+        self.assertEqual(oa.offenses[1].counts['2014'][0:2], [0, 1])
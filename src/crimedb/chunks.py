@@ -0,0 +1,247 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Spatially partitioned copies of YYYY-MM.json month files ("chunks").
+
+The located crimes in each month file are also written to a YYYY-MM/
+directory, partitioned by the Slippy map tile at CHUNK_ZOOM containing them.
+Each chunk is named by the quadkey of its tile, e.g. YYYY-MM/023010203112.json,
+and has the same structure as a month file. Within a chunk, crimes are sorted
+by the quadkey of their cell at crimedb.www.GRID_BASE_ZOOM (and then by time),
+so nearby crimes are near each other in the file.
+
+A YYYY-MM.chunks.json manifest lists the chunks in quadkey order, giving the
+bounding box, time range (in epoch seconds) and number of the crimes in each.
+Clients interested in part of a region can use it to fetch only the chunks
+overlapping their viewport.
+'''
+
+import crimedb.output
+import crimedb.timecodec
+import crimedb.www
+import json
+import os
+import os.path
+import tempfile
+import unittest
+
+# Zoom level of the tiles into which month files are partitioned
+CHUNK_ZOOM = 12
+
+
+def quadkey(x, y, zoom):
+    '''
+    Return the quadkey of the given Slippy map tile. Sorting quadkeys of the
+    same length orders their tiles along a Z-order curve.
+    '''
+
+    digits = []
+    for z in range(zoom, 0, -1):
+        mask = 1 << (z - 1)
+        digits += [str((1 if x & mask else 0) + (2 if y & mask else 0))]
+
+    return ''.join(digits)
+
+
+def month_chunks_dir(month_path):
+    '''
+    Return the path of the directory containing the chunks of the given
+    YYYY-MM.json month file.
+    '''
+
+    return os.path.splitext(month_path)[0]
+
+
+def month_chunks_manifest_path(month_path):
+    '''
+    Return the path of the chunk manifest for the given YYYY-MM.json month
+    file.
+    '''
+
+    root, ext = os.path.splitext(month_path)
+    return '{}.chunks{}'.format(root, ext)
+
+
+def chunks_from_crimes(crime_objs, zoom=CHUNK_ZOOM):
+    '''
+    Return a list of (quadkey, [crime, ...]) tuples, sorted by quadkey, of the
+    located crimes in the given list of crime JSON objects, partitioned into
+    tiles at the given zoom level.
+    '''
+
+    keyed = []
+    for co in crime_objs:
+        if 'geo' not in co:
+            continue
+
+        lon, lat = co['geo']['coordinates']
+        x, y = crimedb.www.slippy_tile_coordinates_from_point(
+                lon, lat, crimedb.www.GRID_BASE_ZOOM)
+        keyed += [(
+            quadkey(x, y, crimedb.www.GRID_BASE_ZOOM),
+            crimedb.timecodec.parse_epoch(co['time']),
+            co)]
+
+    keyed.sort(key=lambda k: k[:2])
+
+    chunks = []
+    for qk, _, co in keyed:
+        cqk = qk[:zoom]
+        if not chunks or chunks[-1][0] != cqk:
+            chunks += [(cqk, [])]
+        chunks[-1][1].append(co)
+
+    return chunks
+
+
+def write_month_chunks(month_path, crime_objs, zoom=CHUNK_ZOOM):
+    '''
+    Write the chunks and chunk manifest for the given month file, containing
+    the given list of crime JSON objects, removing any chunks left over from
+    a previous write.
+
+    Returns a list of the paths written.
+    '''
+
+    chunks_dir = month_chunks_dir(month_path)
+    os.makedirs(chunks_dir, exist_ok=True)
+
+    written = []
+    manifest = []
+    for qk, cl in chunks_from_crimes(crime_objs, zoom):
+        fn = '{}.json'.format(qk)
+        cp = os.path.join(chunks_dir, fn)
+        with open(cp, 'wt', encoding='utf-8') as cf:
+            json.dump({'crimes': cl}, cf)
+        written += [cp]
+
+        lons = [co['geo']['coordinates'][0] for co in cl]
+        lats = [co['geo']['coordinates'][1] for co in cl]
+        times = [int(crimedb.timecodec.parse_epoch(co['time'])) for co in cl]
+        manifest += [{
+            'quadkey': qk,
+            'path': '{}/{}'.format(os.path.basename(chunks_dir), fn),
+            'bbox': [min(lons), min(lats), max(lons), max(lats)],
+            'time_min': min(times),
+            'time_max': max(times),
+            'count': len(cl),
+        }]
+
+    # Remove chunks of tiles with no crimes in this write
+    for fn in os.listdir(chunks_dir):
+        fp = os.path.join(chunks_dir, fn)
+        if fn.endswith('.json') and fp not in written:
+            crimedb.output.remove_file(fp)
+
+    mp = month_chunks_manifest_path(month_path)
+    with open(mp, 'wt', encoding='utf-8') as mf:
+        json.dump({'zoom': zoom, 'chunks': manifest}, mf)
+    written += [mp]
+
+    return written
+
+
+def read_month_chunks(month_path, bbox):
+    '''
+    Return a list of the crimes in the chunks of the given month file that
+    overlap the given (minx, miny, maxx, maxy) bounding box. This reads only
+    the chunks that can contain crimes within the bounding box, though not all
+    crimes returned are necessarily within it.
+    '''
+
+    with open(month_chunks_manifest_path(month_path), 'rt',
+              encoding='utf-8') as mf:
+        manifest = json.load(mf)
+
+    crime_objs = []
+    for c in manifest['chunks']:
+        minx, miny, maxx, maxy = c['bbox']
+        if maxx < bbox[0] or maxy < bbox[1] or \
+                minx > bbox[2] or miny > bbox[3]:
+            continue
+
+        cp = os.path.join(os.path.dirname(month_path), c['path'])
+        with open(cp, 'rt', encoding='utf-8') as cf:
+            crime_objs += json.load(cf)['crimes']
+
+    return crime_objs
+
+
+class ChunkTests(unittest.TestCase):
+    '''
+    Tests for month file chunks.
+    '''
+
+    def test_quadkey(self):
+        '''
+        Verify quadkeys against the examples in Bing's documentation.
+        '''
+
+        self.assertEqual(quadkey(3, 5, 3), '213')
+        self.assertEqual(quadkey(0, 0, 0), '')
+
+    def test_month_chunks(self):
+        '''
+        Verify that chunks partition the located crimes of a month, and that
+        reading chunks for a bounding box finds all crimes within it.
+        '''
+
+        crime_objs = [
+            {'description': 'crime {}'.format(i),
+             'time': '2014-01-{:02}T{:02}:00:00-0600'.format(
+                    1 + i % 28, i % 24),
+             'geo': {
+                'type': 'Point',
+                'coordinates': [-90.4 + (i % 17) * 0.02,
+                                38.5 + (i % 13) * 0.02]}}
+                for i in range(500)] + \
+            [{'description': 'unlocated', 'time': '2014-01-01T00:00:00-0600'}]
+
+        with tempfile.TemporaryDirectory() as td:
+            mp = os.path.join(td, '2014-01.json')
+
+            # Chunks from previous writes are removed
+            os.makedirs(month_chunks_dir(mp))
+            with open(os.path.join(month_chunks_dir(mp), '0.json'), 'wt'):
+                pass
+
+            write_month_chunks(mp, crime_objs)
+            with open(month_chunks_manifest_path(mp), 'rt') as mf:
+                manifest = json.load(mf)
+
+            qks = [c['quadkey'] for c in manifest['chunks']]
+            self.assertEqual(qks, sorted(qks))
+            self.assertGreater(len(qks), 1)
+            self.assertEqual(
+                    sorted(os.listdir(month_chunks_dir(mp))),
+                    sorted('{}.json'.format(qk) for qk in qks))
+            self.assertEqual(
+                    sum(c['count'] for c in manifest['chunks']), 500)
+
+            everything = read_month_chunks(mp, (-180, -90, 180, 90))
+            self.assertEqual(
+                    sorted(co['description'] for co in everything),
+                    sorted(co['description'] for co in crime_objs[:500]))
+
+            bbox = (-90.3, 38.55, -90.2, 38.6)
+            found = read_month_chunks(mp, bbox)
+            self.assertLess(len(found), len(everything))
+            self.assertEqual(
+                    sorted(co['description'] for co in found
+                        if bbox[0] <= co['geo']['coordinates'][0] <= bbox[2] and
+                           bbox[1] <= co['geo']['coordinates'][1] <= bbox[3]),
+                    sorted(co['description'] for co in crime_objs[:500]
+                        if bbox[0] <= co['geo']['coordinates'][0] <= bbox[2] and
+                           bbox[1] <= co['geo']['coordinates'][1] <= bbox[3]))
@@ -17,6 +17,8 @@ Utilities for CLI tools in CrimeDB.
 '''
 
 import argparse
+import crimedb.endpoints
+import crimedb.output
 import logging
 import os.path
 import re
@@ -82,36 +84,89 @@ def process_config_args(args, defaults={}):
     can detect when an option has been set via the commandline.
     '''
 
-    if not args.config:
-        return
+    if args.config:
+        with open(args.config, 'r') as fp:
+            line_no = 0
+            for l in fp:
+                line_no += 1
 
-    with open(args.config, 'r') as fp:
-        line_no = 0
-        for l in fp:
-            line_no += 1
+                if re.match(r'^\s*(#.*)?$', l):
+                    continue
 
-            if re.match(r'^\s*(#.*)?$', l):
-                continue
+                k, v = re.split(r'\s+', l.strip(), 1)
+                assert hasattr(args, k)
 
-            k, v = re.split(r'\s+', l.strip(), 1)
-            assert hasattr(args, k)
+                if getattr(args, k) is not None:
+                    continue
 
-            if getattr(args, k) is not None:
-                continue
+                if k in defaults:
+                    if type(defaults[k]) is bool:
+                        assert v in ['True', 'False']
 
-            if k in defaults:
-                if type(defaults[k]) is bool:
-                    assert v in ['True', 'False']
-
-                    if v == 'True':
-                        v = True
+                        if v == 'True':
+                            v = True
+                        else:
+                            v = False
                     else:
-                        v = False
-                else:
-                    v = type(defaults[k])(v)
+                        v = type(defaults[k])(v)
 
-            setattr(args, k, v)
+                setattr(args, k, v)
 
     for k, v in defaults.items():
         if getattr(args, k) is None:
             setattr(args, k, v)
+
+
+precompress_argument_parser = argparse.ArgumentParser(add_help=False)
+'''
+An ArgumentParser instance that supports writing precompressed output files.
+'''
+
+precompress_argument_parser.add_argument(
+        '--precompress', metavar='<encoding>[,<encoding>...]',
+        help=('write precompressed copies of output files in each of these '
+              'encodings; valid encodings are: gzip, br (requires the brotli '
+              'module) (default: none)'))
+
+
+def process_precompress_args(args, parser):
+    '''
+    Process arguments belonging to precompress_argument_parser, replacing
+    args.precompress with a tuple of encodings.
+
+    This must be called after process_config_args().
+    '''
+
+    args.precompress = tuple(
+            e for e in (args.precompress or '').split(',') if e)
+    for e in args.precompress:
+        if e not in crimedb.output.ENCODINGS:
+            parser.error('unsupported encoding {}'.format(e))
+
+
+endpoint_argument_parser = argparse.ArgumentParser(add_help=False)
+'''
+An ArgumentParser instance that supports overriding the URLs of upstream
+sources, e.g. to point them at those started by bin/fakeservers.
+'''
+
+endpoint_argument_parser.add_argument(
+        '--endpoint', action='append', default=[], dest='endpoints',
+        metavar='<name>=<url>',
+        help=('fetch from <url> rather than the default for the upstream '
+              'source <name>; can be specified multiple times, and overrides '
+              'the {} environment variable; valid names are: {}'.format(
+                crimedb.endpoints.ENVIRONMENT_VARIABLE,
+                ', '.join(sorted(crimedb.endpoints.DEFAULT_ENDPOINTS)))))
+
+
+def process_endpoint_args(args, parser):
+    '''
+    Process arguments belonging to endpoint_argument_parser.
+    '''
+
+    try:
+        crimedb.endpoints.set_endpoints(
+                crimedb.endpoints.parse_endpoints(','.join(args.endpoints)))
+    except ValueError as e:
+        parser.error(str(e))
@@ -0,0 +1,229 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Collate the processed crimes of a region into the files of its data directory.
+
+Each region has a subdirectory of the data directory named after it, which
+holds a YYYY-MM.json month file (see crimedb.monthfile) of the crimes in each
+(local) month, along with their cubes, chunks and counts (see crimedb.cube,
+crimedb.chunks and crimedb.counts), the region's offense dictionary (see
+crimedb.offenses) and an index.json file listing its month files. The index.json
+file at the root of the data directory lists the regions.
+'''
+
+from collections import defaultdict
+import crimedb.chunks
+import crimedb.core
+import crimedb.counts
+import crimedb.cube
+import crimedb.monthfile
+import crimedb.offenses
+import crimedb.output
+import crimedb.regions.base
+import datetime
+import json
+import logging
+import os.path
+import tempfile
+import unittest
+
+__LOGGER = logging.getLogger(__name__)
+
+
+def collate_region(data_dir, region, since=None, encodings=(), now=None):
+    '''
+    Write the processed crimes of the given crimedb.regions.base.Region to
+    its subdirectory of the given data directory, which must already have an
+    index.json file.
+
+    If a datetime.datetime month is given, only crimes from that month
+    onwards are collated, and the files for earlier months are left as they
+    are. Files are precompressed in the given encodings as per
+    crimedb.output.write_file(), and stamped with the given update time
+    (default: now).
+    '''
+
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    # Crimes are grouped into months by their local time, so start looking a
+    # day before the first month in UTC
+    time_from = None
+    since_filename = None
+    if since:
+        since_filename = since.strftime('%Y-%m.json')
+        time_from = since.replace(tzinfo=datetime.timezone.utc) - \
+                datetime.timedelta(days=1)
+
+    __LOGGER.info('collating data from region {}'.format(region.name))
+
+    region_dir = os.path.join(data_dir, region.name)
+    meta_path = os.path.join(region_dir, 'index.json')
+    with open(meta_path, 'rt') as mf:
+        meta_obj = json.load(mf)
+
+    crimes_by_month_filenames = defaultdict(list)
+    for c in region.crimes(time_from=time_from):
+        if not c.time:
+            continue
+
+        fn = c.time.strftime('%Y-%m.json')
+        if since_filename and fn < since_filename:
+            continue
+
+        crimes_by_month_filenames[fn] += [c]
+
+    # Assign codes to any offenses that we haven't seen before
+    offenses_path = crimedb.offenses.offense_dictionary_path(region_dir)
+    offenses = crimedb.offenses.read_offense_dictionary(offenses_path)
+    offenses.update(
+            c.description
+                for cl in crimes_by_month_filenames.values()
+                for c in cl)
+    crimedb.output.write_file(
+            offenses_path,
+            crimedb.offenses.offense_dictionary_json(offenses),
+            encodings)
+
+    __LOGGER.info('sorting month data for region {}'.format(region.name))
+    for cm, cl in crimes_by_month_filenames.items():
+        crimes_by_month_filenames[cm] = sorted(cl, key=lambda c: c.time)
+
+    __LOGGER.info('writing month files for region {}'.format(region.name))
+    written_paths = []
+    month_counts = {}
+    for fn, crimes in crimes_by_month_filenames.items():
+        crime_objs = [crimedb.core.crime2json_obj(c) for c in crimes]
+        for c, co in zip(crimes, crime_objs):
+            co['offense'] = offenses.code(c.description)
+        month_path = os.path.join(region_dir, fn)
+        crimedb.monthfile.write_month_file(
+                month_path,
+                crime_objs,
+                now.strftime(crimedb.core.RFC3999_STRFTIME_FORMAT))
+
+        # Write a pre-aggregated cube for the month so that bin/render
+        # doesn't have to re-read and re-bin every crime
+        cube_path = crimedb.cube.month_cube_path(month_path)
+        crimedb.cube.write_month_cube(
+                cube_path,
+                crimedb.cube.month_cube_from_crimes(crime_objs))
+
+        written_paths += [
+            month_path,
+            crimedb.monthfile.month_index_path(month_path),
+            cube_path]
+
+        # Write spatially partitioned copies of the month so that clients
+        # can fetch only the part of the region that they're looking at
+        written_paths += crimedb.chunks.write_month_chunks(
+                month_path, crime_objs)
+
+        month_counts[fn] = crimedb.counts.month_counts_from_crimes(
+                crime_objs)
+
+    __LOGGER.info('updating index.json for region {}'.format(region.name))
+
+    meta_obj['update_time'] = now.strftime(crimedb.core.RFC3999_STRFTIME_FORMAT)
+    files = set(crimes_by_month_filenames.keys())
+    if since_filename:
+        files |= set(
+                fn for fn in meta_obj.get('files', [])
+                    if fn < since_filename)
+    meta_obj['files'] = list(sorted(files))
+
+    with open(os.path.join(region_dir, 'index.json'), 'wt') as mf:
+        json.dump(meta_obj, mf)
+    written_paths += [os.path.join(region_dir, 'index.json')]
+
+    # Only the partitions of the months that we've just written change;
+    # those of earlier months are kept as they are
+    __LOGGER.info('updating counts table for region {}'.format(region.name))
+    crimedb.counts.update_region_counts(
+            crimedb.counts.region_counts_path(region_dir),
+            month_counts,
+            keep=meta_obj['files'],
+            encodings=encodings)
+
+    __LOGGER.info('compressing files for region {}'.format(region.name))
+    crimedb.output.compress_files(written_paths, encodings)
+
+
+def write_data_index(data_dir, region_names, encodings=()):
+    '''
+    Write the index.json file at the root of the given data directory, listing
+    the given region names.
+    '''
+
+    index_path = os.path.join(data_dir, 'index.json')
+    with open(index_path, 'wt') as mf:
+        json.dump({'regions': list(region_names)}, mf)
+    crimedb.output.compress_files([index_path], encodings)
+
+
+class CollateTests(unittest.TestCase):
+    '''
+    Tests for collation.
+    '''
+
+    def test_collate_region(self):
+        '''
+        Verify that crimes are written to month files, and that collating
+        since a given month leaves earlier ones alone.
+        '''
+
+        utc = datetime.timezone.utc
+        crimes = [
+            crimedb.core.Crime(
+                'crime {}'.format(i % 2),
+                datetime.datetime(2014, 1 + i % 3, 1 + i % 28, tzinfo=utc),
+                (-90, 38))
+            for i in range(30)] + \
+            [crimedb.core.Crime('no time', None, (-90, 38))]
+
+        with tempfile.TemporaryDirectory() as td:
+            region = crimedb.regions.base.Region(
+                    'test', os.path.join(td, 'work'))
+            region._clear_intermediate()
+            for c in crimes:
+                region._write_intermediate(c)
+            region._finish_intermediate()
+
+            region_dir = os.path.join(td, 'data', 'test')
+            os.makedirs(region_dir)
+            with open(os.path.join(region_dir, 'index.json'), 'wt') as mf:
+                json.dump({}, mf)
+
+            collate_region(os.path.join(td, 'data'), region)
+
+            with open(os.path.join(region_dir, 'index.json'), 'rt') as mf:
+                meta_obj = json.load(mf)
+            self.assertEqual(
+                    meta_obj['files'],
+                    ['2014-01.json', '2014-02.json', '2014-03.json'])
+            self.assertEqual(
+                    sorted(crimedb.counts.read_region_counts(
+                        crimedb.counts.region_counts_path(region_dir))),
+                    meta_obj['files'])
+
+            jan_path = os.path.join(region_dir, '2014-01.json')
+            jan_mtime = os.stat(jan_path).st_mtime_ns
+            collate_region(
+                    os.path.join(td, 'data'), region,
+                    since=datetime.datetime(2014, 2, 1))
+
+            with open(os.path.join(region_dir, 'index.json'), 'rt') as mf:
+                self.assertEqual(json.load(mf)['files'], meta_obj['files'])
+            self.assertEqual(os.stat(jan_path).st_mtime_ns, jan_mtime)
@@ -16,9 +16,10 @@
 Core classes and methods for CrimeDB.
 '''
 
-import datetime
+import crimedb.timecodec
+import sys
 
-RFC3999_STRFTIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+RFC3999_STRFTIME_FORMAT = crimedb.timecodec.STRFTIME_FORMAT
 
 
 class Crime:
@@ -49,7 +50,7 @@ def crime2json_obj(crime):
     }
 
     if crime.time:
-        jo['time'] = crime.time.strftime(RFC3999_STRFTIME_FORMAT)
+        jo['time'] = crimedb.timecodec.format_time(crime.time)
 
     if crime.location:
         jo['geo'] = {
@@ -65,12 +66,15 @@ def json_obj2crime(jo):
     The inverse of crime2json_obj().
     '''
 
+    # Descriptions come from a small vocabulary, so share a single copy of
+    # each rather than holding millions of equal strings in memory
     description = jo['description']
+    if isinstance(description, str):
+        description = sys.intern(description)
 
     time = None
     if 'time' in jo:
-        time = datetime.datetime.strptime(
-                jo['time'], RFC3999_STRFTIME_FORMAT)
+        time = crimedb.timecodec.parse_time(jo['time'])
 
     location = None
     if 'geo' in jo:
@@ -0,0 +1,294 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Materialized per-region tables of crime counts.
+
+Each region's data directory has a counts.json table of the number of crimes
+on each (local) day, in each (local) hour of the day, with each offense code
+(see crimedb.offenses). The table is partitioned by month file; collation
+replaces the partitions of the months that it writes and leaves the rest
+alone, so keeping it up to date costs nothing more than the months being
+collated.
+
+Each partition stores its rows as parallel arrays of integers:
+
+    {
+        'time_min': <epoch seconds>,
+        'time_max': <epoch seconds>,
+        'day': [<day of month>, ...],
+        'hour': [<hour>, ...],
+        'offense': [<offense code, or -1 if none>, ...],
+        'count': [<count>, ...],
+    }
+
+Rows are sorted by (day, hour, offense). As with cubes (see crimedb.cube),
+time_min and time_max let consumers tell whether a month is entirely within
+the time range that they're interested in; if it isn't, they have to fall
+back to reading the month file.
+'''
+
+from collections import Counter, defaultdict
+import crimedb.output
+import crimedb.timecodec
+import datetime
+import json
+import os.path
+import tempfile
+import unittest
+
+# Bump this when the table format changes; tables with a different version are
+# ignored and rebuilt by the next full collation
+COUNTS_VERSION = 1
+
+# Offense code recorded for crimes without one
+NO_OFFENSE = -1
+
+
+def region_counts_path(region_path):
+    '''
+    Return the path of the counts table in the given region data directory.
+    '''
+
+    return os.path.join(region_path, 'counts.json')
+
+
+def month_counts_from_crimes(crime_objs):
+    '''
+    Return a counts table partition for the given iterable of crime JSON
+    objects from a single month file.
+
+    Crimes without a time are ignored. Days and hours are those of the crime's
+    local time, read straight from its RFC3339 timestamp.
+    '''
+
+    rows = Counter()
+    time_min = None
+    time_max = None
+    for co in crime_objs:
+        if 'time' not in co:
+            continue
+
+        t = co['time']
+        rows[(int(t[8:10]), int(t[11:13]), co.get('offense', NO_OFFENSE))] += 1
+
+        ct = crimedb.timecodec.parse_epoch(t)
+        if time_min is None or ct < time_min:
+            time_min = ct
+        if time_max is None or ct > time_max:
+            time_max = ct
+
+    keys = sorted(rows)
+    return {
+        'time_min': time_min,
+        'time_max': time_max,
+        'day': [k[0] for k in keys],
+        'hour': [k[1] for k in keys],
+        'offense': [k[2] for k in keys],
+        'count': [rows[k] for k in keys],
+    }
+
+
+def read_region_counts(path):
+    '''
+    Read a counts table, returning a {month file name => partition}
+    dictionary. The table is empty if the file doesn't exist or is of an
+    unknown version.
+    '''
+
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path, 'rt', encoding='utf-8') as cf:
+        table = json.load(cf)
+
+    if table.get('version') != COUNTS_VERSION:
+        return {}
+
+    return table['months']
+
+
+def update_region_counts(path, months, keep=None, encodings=()):
+    '''
+    Update the counts table at the given path with the partitions in the
+    given {month file name => partition} dictionary, replacing any existing
+    partitions for those months. If a collection of month file names to keep
+    is given, partitions for any other months are removed.
+
+    The table is precompressed in the given encodings as per
+    crimedb.output.write_file().
+    '''
+
+    table = read_region_counts(path)
+    table.update(months)
+    if keep is not None:
+        keep = set(keep)
+        table = {fn: mc for fn, mc in table.items() if fn in keep}
+
+    crimedb.output.write_file(
+            path,
+            json.dumps(
+                {'version': COUNTS_VERSION, 'months': table},
+                sort_keys=True),
+            encodings)
+
+
+def month_counts_covered(month_counts, time_from, time_to):
+    '''
+    Return whether every crime in the partition falls within the (inclusive)
+    range [time_from, time_to] of datetime.datetime objects.
+    '''
+
+    if month_counts['time_min'] is None:
+        return True
+
+    return time_from.timestamp() <= month_counts['time_min'] and \
+            month_counts['time_max'] <= time_to.timestamp()
+
+
+def month_counts_by_offense(month_counts):
+    '''
+    Return an {offense code => partition} dictionary splitting the rows of the
+    given partition by offense code. Crimes without a code are left out.
+    '''
+
+    by_offense = {}
+    for day, hour, code, count in zip(
+            month_counts['day'], month_counts['hour'],
+            month_counts['offense'], month_counts['count']):
+        if code == NO_OFFENSE:
+            continue
+
+        oc = by_offense.get(code)
+        if oc is None:
+            oc = {
+                'time_min': month_counts['time_min'],
+                'time_max': month_counts['time_max'],
+                'day': [],
+                'hour': [],
+                'offense': [],
+                'count': [],
+            }
+            by_offense[code] = oc
+
+        oc['day'].append(day)
+        oc['hour'].append(hour)
+        oc['offense'].append(code)
+        oc['count'].append(count)
+
+    return by_offense
+
+
+def month_counts_days(month_fn, month_counts, offense=None):
+    '''
+    Return a {datetime.date => count} dictionary of the crimes on each day of
+    the given partition of the given YYYY-MM.json month file. If an offense
+    code is given, only crimes with that code are counted.
+    '''
+
+    year = int(month_fn[0:4])
+    month = int(month_fn[5:7])
+
+    days = defaultdict(int)
+    for day, code, count in zip(
+            month_counts['day'], month_counts['offense'],
+            month_counts['count']):
+        if offense is None or code == offense:
+            days[day] += count
+
+    return {
+        datetime.date(year, month, day): count
+            for day, count in days.items()}
+
+
+def month_counts_hours(month_counts, offense=None):
+    '''
+    Return a list of the number of crimes in each hour of the day in the
+    given partition. If an offense code is given, only crimes with that code
+    are counted.
+    '''
+
+    hours = [0] * 24
+    for hour, code, count in zip(
+            month_counts['hour'], month_counts['offense'],
+            month_counts['count']):
+        if offense is None or code == offense:
+            hours[hour] += count
+
+    return hours
+
+
+class CountsTests(unittest.TestCase):
+    '''
+    Tests for counts tables.
+    '''
+
+    def setUp(self):
+        self.crime_objs = [
+            {'description': 'a', 'time': '2014-01-01T23:30:00-0600',
+             'offense': 0},
+            {'description': 'b', 'time': '2014-01-02T00:30:00-0600',
+             'offense': 1},
+            {'description': 'a', 'time': '2014-01-02T00:45:00-0600',
+             'offense': 0},
+            {'description': 'c', 'time': '2014-01-02T05:00:00-0500'},
+            {'description': 'd'},
+        ]
+
+    def test_month_counts_from_crimes(self):
+        '''
+        Verify that crimes are counted by their local day and hour.
+        '''
+
+        mc = month_counts_from_crimes(self.crime_objs)
+        self.assertEqual(
+                list(zip(mc['day'], mc['hour'], mc['offense'], mc['count'])),
+                [(1, 23, 0, 1), (2, 0, 0, 1), (2, 0, 1, 1),
+                 (2, 5, NO_OFFENSE, 1)])
+        self.assertEqual(
+                mc['time_min'],
+                crimedb.timecodec.parse_epoch('2014-01-01T23:30:00-0600'))
+
+        self.assertEqual(
+                month_counts_days('2014-01.json', mc),
+                {datetime.date(2014, 1, 1): 1, datetime.date(2014, 1, 2): 3})
+        self.assertEqual(
+                month_counts_days('2014-01.json', mc, 0),
+                {datetime.date(2014, 1, 1): 1, datetime.date(2014, 1, 2): 1})
+        self.assertEqual(month_counts_hours(mc)[0:6], [2, 0, 0, 0, 0, 1])
+        self.assertEqual(month_counts_hours(mc, 1)[0], 1)
+        self.assertEqual(sorted(month_counts_by_offense(mc)), [0, 1])
+        self.assertEqual(month_counts_by_offense(mc)[0]['count'], [1, 1])
+
+    def test_update_region_counts(self):
+        '''
+        Verify that updates replace only the given partitions, and remove
+        those not kept.
+        '''
+
+        with tempfile.TemporaryDirectory() as td:
+            path = region_counts_path(td)
+            self.assertEqual(read_region_counts(path), {})
+
+            jan = month_counts_from_crimes(self.crime_objs)
+            feb = month_counts_from_crimes(
+                    [{'time': '2014-02-01T00:00:00-0600'}])
+            update_region_counts(path, {'2014-01.json': jan})
+            update_region_counts(path, {'2014-02.json': feb})
+            self.assertEqual(
+                    read_region_counts(path),
+                    {'2014-01.json': jan, '2014-02.json': feb})
+
+            update_region_counts(path, {}, keep=['2014-02.json'])
+            self.assertEqual(read_region_counts(path), {'2014-02.json': feb})
@@ -0,0 +1,228 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Pre-aggregated per-month crime counts ("cubes").
+
+Each YYYY-MM.json month file written by collation gets a YYYY-MM.cube.json
+sibling containing a sparse grid of crime counts at a fixed zoom level, the
+number of crimes on each (local) day, and the range of crime times covered.
+It also contains a cube for the crimes of each offense code (see
+crimedb.offenses), so that per-offense aggregates can be computed from cubes
+too. Consumers interested in an entire month can use the cube rather than reading
+and re-binning every crime in the month file.
+'''
+
+from collections import defaultdict
+import crimedb.core
+import crimedb.timecodec
+import crimedb.www
+import datetime
+import json
+import os.path
+import unittest
+
+
+def month_cube_path(month_path):
+    '''
+    Return the path of the cube file for the given YYYY-MM.json month file.
+    '''
+
+    root, ext = os.path.splitext(month_path)
+    return '{}.cube{}'.format(root, ext)
+
+
+def month_cube_from_crimes(crimes, zoom=crimedb.www.GRID_BASE_ZOOM,
+                           by_offense=True):
+    '''
+    Return a cube object for the given iterable of crime JSON objects, as
+    returned by crimedb.core.crime2json_obj().
+
+    Crimes without a time are ignored entirely. Crimes without a location are
+    counted in the daily totals but not in the grid. If by_offense is True,
+    the cube's 'offenses' field maps each offense code (as a string) to a cube
+    of the crimes with that code; crimes without a code are not included.
+    '''
+
+    days = defaultdict(int)
+    offenses = defaultdict(list)
+    time_min = None
+    time_max = None
+    located = []
+    for c in crimes:
+        if 'time' not in c:
+            continue
+
+        # The leading YYYY-MM-DD of the timestamp is the local date
+        days[c['time'][:10]] += 1
+
+        ct = crimedb.timecodec.parse_epoch(c['time'])
+        if time_min is None or ct < time_min:
+            time_min = ct
+        if time_max is None or ct > time_max:
+            time_max = ct
+
+        if 'geo' in c:
+            located += [c]
+
+        if by_offense and 'offense' in c:
+            offenses[c['offense']] += [c]
+
+    grid = crimedb.www.grid_from_crimes(located, zoom)
+
+    cube = {
+        'zoom': zoom,
+        'time_min': time_min,
+        'time_max': time_max,
+        'days': dict(sorted(days.items())),
+        'grid': [
+            [x, y, count]
+                for x, ycounts in sorted(grid.items())
+                for y, count in sorted(ycounts.items())],
+    }
+
+    if by_offense:
+        cube['offenses'] = {
+            str(code): month_cube_from_crimes(ocl, zoom, False)
+                for code, ocl in sorted(offenses.items())}
+
+    return cube
+
+
+def write_month_cube(path, cube):
+    '''
+    Write the given cube object to a file.
+    '''
+
+    with open(path, 'wt', encoding='utf-8') as cf:
+        json.dump(cube, cf)
+
+
+def read_month_cube(path, zoom=crimedb.www.GRID_BASE_ZOOM):
+    '''
+    Read a cube object from the given file.
+
+    Returns None if the file does not exist or was computed for a zoom level
+    other than the one requested, in which case the caller should fall back to
+    reading the month file itself.
+    '''
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rt', encoding='utf-8') as cf:
+        cube = json.load(cf)
+
+    if cube['zoom'] != zoom:
+        return None
+
+    return cube
+
+
+def month_cube_covered(cube, time_from, time_to):
+    '''
+    Return whether every crime in the cube falls within the (inclusive) range
+    [time_from, time_to] of datetime.datetime objects.
+    '''
+
+    if cube['time_min'] is None:
+        return True
+
+    return time_from.timestamp() <= cube['time_min'] and \
+            cube['time_max'] <= time_to.timestamp()
+
+
+def grid_from_month_cube(cube, grid=None):
+    '''
+    Return the {x => {y => count}} grid represented by the given cube. If a
+    grid is specified, the cube's counts are added to it in place rather than
+    to a new grid.
+    '''
+
+    if grid is None:
+        grid = crimedb.www.grid_from_crimes([], cube['zoom'])
+
+    for x, y, count in cube['grid']:
+        grid[x][y] += count
+
+    return grid
+
+
+class CubeTests(unittest.TestCase):
+    '''
+    Tests for building and consuming cubes.
+    '''
+
+    def test_month_cube_from_crimes(self):
+        '''
+        Verify that cubes agree with grid_from_crimes() and count days in
+        local time.
+        '''
+
+        crimes = [
+            {'description': 'a', 'time': '2014-01-01T23:30:00-0600',
+             'geo': {'type': 'Point', 'coordinates': [-90.2, 38.6]},
+             'offense': 0},
+            {'description': 'b', 'time': '2014-01-02T00:30:00-0600',
+             'geo': {'type': 'Point', 'coordinates': [-90.2, 38.6]},
+             'offense': 1},
+            {'description': 'a', 'time': '2014-01-02T01:30:00-0600',
+             'offense': 0},
+            {'description': 'd'},
+        ]
+
+        cube = month_cube_from_crimes(crimes, 17)
+        self.assertEqual(cube['days'], {'2014-01-01': 1, '2014-01-02': 2})
+        self.assertEqual(
+                grid_from_month_cube(cube),
+                crimedb.www.grid_from_crimes(crimes[0:2], 17))
+
+        # Round-trip through JSON to make sure we don't depend on any
+        # in-memory types
+        cube = json.loads(json.dumps(cube))
+        self.assertEqual(
+                grid_from_month_cube(cube),
+                crimedb.www.grid_from_crimes(crimes[0:2], 17))
+
+        # Each offense has a cube of its own
+        self.assertEqual(sorted(cube['offenses']), ['0', '1'])
+        self.assertEqual(
+                cube['offenses']['0'],
+                month_cube_from_crimes(
+                    [crimes[0], crimes[2]], 17, by_offense=False))
+        self.assertNotIn('offenses', cube['offenses']['0'])
+
+    def test_month_cube_covered(self):
+        '''
+        Verify the behavior of month_cube_covered().
+        '''
+
+        utc = datetime.timezone.utc
+        cube = month_cube_from_crimes([
+            {'description': 'a', 'time': '2014-01-01T00:00:00-0600'},
+            {'description': 'b', 'time': '2014-01-31T23:00:00-0600'},
+        ])
+
+        self.assertTrue(month_cube_covered(
+                cube,
+                datetime.datetime(2014, 1, 1, 6, tzinfo=utc),
+                datetime.datetime(2014, 2, 1, 5, tzinfo=utc)))
+        self.assertFalse(month_cube_covered(
+                cube,
+                datetime.datetime(2014, 1, 1, 7, tzinfo=utc),
+                datetime.datetime(2014, 2, 1, 5, tzinfo=utc)))
+        self.assertFalse(month_cube_covered(
+                cube,
+                datetime.datetime(2014, 1, 1, 6, tzinfo=utc),
+                datetime.datetime(2014, 2, 1, 4, tzinfo=utc)))
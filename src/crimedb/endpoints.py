@@ -0,0 +1,157 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Registry of the URLs of the upstream services that we download from.
+
+Each service has a name and a default URL, which can be overridden, e.g. to
+point at the stand-ins in crimedb.fakeservers. Overrides are read from the
+CRIMEDB_ENDPOINTS environment variable, as a comma-separated list of
+<name>=<url> pairs, and can also be set with set_endpoints(); those set with
+set_endpoints() take precedence.
+'''
+
+import os
+import unittest
+
+# Map of endpoint names to their default URLs
+DEFAULT_ENDPOINTS = {
+    # Socrata API root of the Dallas open data portal
+    'dallas': 'http://www.dallasopendata.com',
+
+    # MapQuest batch geocoding
+    'mapquest': 'http://open.mapquestapi.com/geocoding/v1/batch',
+
+    # SLMPD crime report page, whose postbacks list and download CSV files
+    'stl': 'http://www.slmpd.org/CrimeReport.aspx',
+
+    # ArcGIS query endpoint for St. Louis County crimes
+    'stlco': ('http://maps.stlouisco.com/arcgis/rest/services/'
+              'Police/AGS_Crimes/MapServer/0/query'),
+}
+
+ENVIRONMENT_VARIABLE = 'CRIMEDB_ENDPOINTS'
+
+_overrides = {}
+
+
+def parse_endpoints(s):
+    '''
+    Return a {name => url} dictionary for the given comma-separated list of
+    <name>=<url> pairs, raising ValueError if it's malformed or names an
+    unknown endpoint.
+    '''
+
+    endpoints = {}
+    for pair in s.split(','):
+        if not pair:
+            continue
+
+        name, sep, url = pair.partition('=')
+        if not sep or not url:
+            raise ValueError('invalid endpoint: {}'.format(pair))
+        if name not in DEFAULT_ENDPOINTS:
+            raise ValueError('unknown endpoint: {}'.format(name))
+
+        endpoints[name] = url
+
+    return endpoints
+
+
+def format_endpoints(endpoints):
+    '''
+    Return the given {name => url} dictionary as a string to be parsed by
+    parse_endpoints().
+    '''
+
+    return ','.join(
+            '{}={}'.format(name, url)
+                for name, url in sorted(endpoints.items()))
+
+
+def set_endpoints(endpoints):
+    '''
+    Override the URLs of endpoints with those in the given {name => url}
+    dictionary, raising ValueError for unknown endpoints. A URL of None
+    removes the override.
+    '''
+
+    for name in endpoints:
+        if name not in DEFAULT_ENDPOINTS:
+            raise ValueError('unknown endpoint: {}'.format(name))
+
+    for name, url in endpoints.items():
+        if url is None:
+            _overrides.pop(name, None)
+        else:
+            _overrides[name] = url
+
+
+def endpoint(name):
+    '''
+    Return the URL of the endpoint with the given name.
+    '''
+
+    if name in _overrides:
+        return _overrides[name]
+
+    env = parse_endpoints(os.environ.get(ENVIRONMENT_VARIABLE, ''))
+    if name in env:
+        return env[name]
+
+    return DEFAULT_ENDPOINTS[name]
+
+
+class EndpointsTests(unittest.TestCase):
+    '''
+    Tests for endpoint configuration.
+    '''
+
+    def tearDown(self):
+        set_endpoints({'stl': None})
+        os.environ.pop(ENVIRONMENT_VARIABLE, None)
+
+    def test_endpoint(self):
+        '''
+        Verify that overrides from the environment and from set_endpoints()
+        are applied in order of precedence.
+        '''
+
+        self.assertEqual(endpoint('stl'), DEFAULT_ENDPOINTS['stl'])
+
+        os.environ[ENVIRONMENT_VARIABLE] = format_endpoints(
+                {'stl': 'http://a', 'dallas': 'http://b'})
+        self.assertEqual(endpoint('stl'), 'http://a')
+        self.assertEqual(endpoint('dallas'), 'http://b')
+
+        set_endpoints({'stl': 'http://c'})
+        self.assertEqual(endpoint('stl'), 'http://c')
+
+        set_endpoints({'stl': None})
+        self.assertEqual(endpoint('stl'), 'http://a')
+
+    def test_parse_endpoints(self):
+        '''
+        Verify that malformed or unknown endpoints are rejected.
+        '''
+
+        self.assertEqual(
+                parse_endpoints('stl=http://a?b=c,stlco=http://d'),
+                {'stl': 'http://a?b=c', 'stlco': 'http://d'})
+        with self.assertRaises(ValueError):
+            parse_endpoints('stl')
+        with self.assertRaises(ValueError):
+            parse_endpoints('nope=http://a')
+        with self.assertRaises(ValueError):
+            set_endpoints({'nope': 'http://a'})
@@ -0,0 +1,720 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Local stand-ins for the upstream sources in crimedb.endpoints, for load and
+regression testing without hitting the real ones.
+
+Each server speaks just enough of its source's protocol for the code that
+consumes it, serving synthetic data from crimedb.synthetic:
+
+    dallas    SocrataServer, the Socrata SODA API
+    mapquest  MapQuestServer, MapQuest batch geocoding
+    stl       SlmpdServer, the SLMPD crime report page and its postbacks
+    stlco     ArcGISServer, an ArcGIS feature service query
+
+Servers listen on an ephemeral port of the loopback interface by default, and
+serve requests on threads of their own once started. Point crimedb at them
+with crimedb.endpoints.set_endpoints(), --endpoint or CRIMEDB_ENDPOINTS.
+
+Faults can be injected into responses with a Faults object: latency, server
+errors, rate limiting and records served out of order.
+'''
+
+import bisect
+import collections
+import csv
+import crimedb.synthetic
+import datetime
+import functools
+import hashlib
+import html
+import http.server
+import io
+import json
+import logging
+import random
+import re
+import threading
+import time
+import unittest
+import urllib.parse
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Faults(object):
+    '''
+    Faults to inject into a server's responses.
+
+    Each response is delayed by latency seconds. Requests fail with a 500 with
+    probability error_rate, and with a 429 if more than rate_limit requests
+    have been served in the last second. If shuffle is set, records within
+    each response are served in random order.
+    '''
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=None,
+                 shuffle=False, seed=0, clock=time.monotonic):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.shuffle = shuffle
+        self.clock = clock
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._served = collections.deque()
+
+    def fault(self):
+        '''
+        Wait out the latency of a request, then return a (status, headers)
+        tuple of the error that it should fail with, or None if it should
+        succeed.
+        '''
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            if self.rate_limit is not None:
+                now = self.clock()
+                while self._served and self._served[0] <= now - 1:
+                    self._served.popleft()
+                if len(self._served) >= self.rate_limit:
+                    return 429, {'Retry-After': '1'}
+                self._served.append(now)
+
+            if self.error_rate and self._rng.random() < self.error_rate:
+                return 500, {}
+
+        return None
+
+    def order(self, records):
+        '''
+        Return a list of the given records, in the order that they should be
+        served.
+        '''
+
+        records = list(records)
+        if self.shuffle:
+            with self._lock:
+                self._rng.shuffle(records)
+
+        return records
+
+
+def _param(params, name, default=None):
+    values = params.get(name)
+    return values[-1] if values else default
+
+
+def _json_response(obj, status=200):
+    return status, {'Content-Type': 'application/json'}, \
+            json.dumps(obj).encode('utf-8')
+
+
+def _text_response(text, status=200, content_type='text/plain'):
+    headers = {'Content-Type': '{}; charset=utf-8'.format(content_type)}
+    return status, headers, text.encode('utf-8')
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def __init__(self, *args, fake, **kwargs):
+        self.fake = fake
+        super().__init__(*args, **kwargs)
+
+    def _respond(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            form = urllib.parse.parse_qs(
+                    self.rfile.read(length).decode('utf-8'),
+                    keep_blank_values=True)
+            for k, v in form.items():
+                params.setdefault(k, []).extend(v)
+
+        with self.fake._lock:
+            self.fake.requests += 1
+
+        fault = self.fake.faults.fault()
+        if fault:
+            status, headers = fault
+            body = b''
+        else:
+            status, headers, body = self.fake.handle(method, url.path, params)
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def log_message(self, format, *args):
+        _LOGGER.debug('{} {}'.format(self.address_string(), format % args))
+
+
+class FakeServer(object):
+    '''
+    Base class for fake servers. Subclasses implement handle().
+
+    Servers serve requests once started, and are started and stopped when used
+    as context managers. The number of requests received, including those
+    failed by faults, is kept in the requests attribute.
+    '''
+
+    # Path of the endpoint on the server, appended to its address in its URL
+    path = ''
+
+    def __init__(self, faults=None, host='127.0.0.1', port=0):
+        self.faults = faults or Faults()
+        self.requests = 0
+
+        self._lock = threading.Lock()
+        self._httpd = http.server.ThreadingHTTPServer(
+                (host, port), functools.partial(_RequestHandler, fake=self))
+        self._thread = None
+
+    @property
+    def url(self):
+        '''
+        The URL of the server's endpoint, for crimedb.endpoints.
+        '''
+
+        host, port = self._httpd.server_address[0:2]
+        return 'http://{}:{}{}'.format(host, port, self.path)
+
+    def start(self):
+        self._thread = threading.Thread(
+                target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, method, path, params):
+        '''
+        Return a (status, headers, body) tuple of the response to a request
+        with the given method, URL path and {name => [value, ...]} dictionary
+        of query and form parameters.
+        '''
+
+        raise NotImplementedError()
+
+
+class SocrataServer(FakeServer):
+    '''
+    A Socrata SODA API serving a single dataset of the given rows, as read by
+    crimedb.socrata.dataset_rows(). Its URL is the root of the API.
+
+    Records are shuffled within each page, as paging by offset is all that's
+    guaranteed to be stable.
+    '''
+
+    def __init__(self, dataset_id, rows, **kwargs):
+        super().__init__(**kwargs)
+        self.dataset_id = dataset_id
+        self.rows = list(rows)
+
+    def handle(self, method, path, params):
+        if path != '/resource/{}.json'.format(self.dataset_id):
+            return _json_response(
+                    {'error': True, 'message': 'Not found'}, 404)
+
+        try:
+            offset = int(_param(params, '$offset', 0))
+            limit = int(_param(params, '$limit', 1000))
+        except ValueError as e:
+            return _json_response({'error': True, 'message': str(e)}, 400)
+
+        rows = self.rows[offset:offset + limit]
+        if _param(params, '$$exclude_system_fields', '').lower() == 'false':
+            rows = [
+                dict(r, **{':id': 'row-{}'.format(offset + i)})
+                    for i, r in enumerate(rows)]
+
+        return _json_response(self.faults.order(rows))
+
+
+class ArcGISServer(FakeServer):
+    '''
+    An ArcGIS feature service query endpoint serving the given features, as
+    read by crimedb.regions.stlco, at most max_record_count at a time.
+
+    Only where clauses of the form GlobalID>'<id>' are supported, and features
+    are always ordered by GlobalID; with shuffling they're served out of that
+    order, as if orderByFields were ignored.
+    '''
+
+    path = '/arcgis/rest/services/Police/AGS_Crimes/MapServer/0/query'
+
+    _WHERE_RE = re.compile(r"^GlobalID>'([^']*)'$")
+
+    def __init__(self, features, max_record_count=1000, **kwargs):
+        super().__init__(**kwargs)
+        self.features = sorted(
+                features, key=lambda f: f['attributes']['GlobalID'])
+        self.max_record_count = max_record_count
+
+        self._gids = [f['attributes']['GlobalID'] for f in self.features]
+
+    def handle(self, method, path, params):
+        # Errors are reported in the body of a successful response
+        def error(message):
+            return _json_response({'error': {
+                'code': 400,
+                'message': 'Unable to complete operation.',
+                'details': [message],
+            }})
+
+        if path != self.path:
+            return _json_response({'error': {
+                'code': 404, 'message': 'Not found', 'details': []}}, 404)
+
+        if _param(params, 'f') != 'json':
+            return error('unsupported format')
+
+        m = self._WHERE_RE.match(_param(params, 'where', ''))
+        if not m:
+            return error('unsupported where clause')
+
+        start = bisect.bisect_right(self._gids, m.group(1))
+        end = start + self.max_record_count
+        return _json_response({
+            'features': self.faults.order(self.features[start:end]),
+            'exceededTransferLimit': end < len(self.features),
+        })
+
+
+def _csv_month(file_name):
+    return datetime.datetime.strptime(file_name.split('.')[0], '%B%Y')
+
+
+class SlmpdServer(FakeServer):
+    '''
+    The SLMPD crime report page, listing the given {file name => contents}
+    monthly CSV files page_size at a time in reverse chronological order, as
+    read by crimedb.regions.stl.
+
+    Paging and downloads are ASP.NET postbacks; as with ASP.NET, each is only
+    honored along with the view state of the page that it came from. Rows of
+    each file are shuffled when downloaded.
+    '''
+
+    path = '/CrimeReport.aspx'
+
+    _DOWNLOAD_RE = re.compile(r'^GridView1\$ctl(\d+)\$downloadData$')
+
+    def __init__(self, files, page_size=10, **kwargs):
+        super().__init__(**kwargs)
+        self.files = files
+        self.page_size = page_size
+
+        self._names = sorted(files, key=_csv_month, reverse=True)
+        self._pages = max(1, -(-len(self._names) // page_size))
+
+    def _page(self, num):
+        names = self._names[(num - 1) * self.page_size:num * self.page_size]
+        rows = [
+            ('<tr><td><a id="GridView1_downloadData_{}" '
+             'href="javascript:__doPostBack(\'GridView1$ctl{:02d}$downloadData'
+             '\',\'\')">{}</a></td></tr>').format(
+                 i, i + 2, html.escape(name))
+                for i, name in enumerate(names)]
+        pager = [
+            '<td><span>{}</span></td>'.format(n) if n == num else
+                ('<td><a href="javascript:__doPostBack(\'GridView1\','
+                 '\'Page${0}\')">{0}</a></td>').format(n)
+                for n in range(1, self._pages + 1)]
+
+        return _text_response('''<html><body>
+<form method="post" action="./CrimeReport.aspx" id="form1">
+<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="" />
+<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="" />
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="page:{}" />
+<table id="GridView1">
+{}
+<tr><td><table><tr>{}</tr></table></td></tr>
+</table>
+</form>
+</body></html>
+'''.format(num, '\n'.join(rows), ''.join(pager)), content_type='text/html')
+
+    def _file(self, name):
+        header, *rows = self.files[name].splitlines(keepends=True)
+        return 200, {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': 'attachment; filename={}'.format(name),
+        }, b''.join([header] + self.faults.order(rows))
+
+    def handle(self, method, path, params):
+        if path != self.path:
+            return _text_response('Not found', 404)
+
+        if method == 'GET':
+            return self._page(1)
+
+        m = re.match(r'^page:(\d+)$', _param(params, '__VIEWSTATE', ''))
+        if not m or not 1 <= int(m.group(1)) <= self._pages:
+            return _text_response('Invalid viewstate', 500)
+        num = int(m.group(1))
+
+        target = _param(params, '__EVENTTARGET', '')
+        argument = _param(params, '__EVENTARGUMENT', '')
+        if target == 'GridView1':
+            m = re.match(r'^Page\$(\d+)$', argument)
+            if m and 1 <= int(m.group(1)) <= self._pages:
+                return self._page(int(m.group(1)))
+
+        m = self._DOWNLOAD_RE.match(target)
+        if m:
+            i = (num - 1) * self.page_size + int(m.group(1)) - 2
+            if (num - 1) * self.page_size <= i < min(
+                    num * self.page_size, len(self._names)):
+                return self._file(self._names[i])
+
+        return _text_response('Invalid postback', 500)
+
+
+class MapQuestServer(FakeServer):
+    '''
+    The MapQuest batch geocoding API, as used by
+    crimedb.geocoding.geocode_mapquest(), resolving each location to a point
+    derived from a hash of it, inside the requested bounding box if any.
+
+    Locations that are blank or in unresolvable aren't resolved. If key is
+    given, requests with any other key fail with a non-zero status code, as do
+    those for more than max_locations locations. Results are shuffled within
+    each response.
+    '''
+
+    path = '/geocoding/v1/batch'
+
+    def __init__(self, key=None, unresolvable=(), max_locations=100,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.key = key
+        self.unresolvable = set(unresolvable)
+        self.max_locations = max_locations
+
+    def _result(self, location, bounding_box):
+        locations = []
+        if location.strip() and location not in self.unresolvable:
+            top, left, bottom, right = bounding_box
+            h = hashlib.sha1(location.encode('utf-8')).digest()
+            fx = int.from_bytes(h[0:4], 'big') / 2 ** 32
+            fy = int.from_bytes(h[4:8], 'big') / 2 ** 32
+            locations = [{
+                'displayLatLng': {
+                    'lat': bottom + fy * (top - bottom),
+                    'lng': left + fx * (right - left),
+                },
+                'geocodeQualityCode': 'P1AAA',
+            }]
+
+        return {
+            'providedLocation': {'location': location},
+            'locations': locations,
+        }
+
+    def handle(self, method, path, params):
+        def status(code, message):
+            return _json_response({
+                'info': {'statuscode': code, 'messages': [message]},
+                'results': [],
+            })
+
+        if path != self.path:
+            return _text_response('Not found', 404)
+
+        if self.key is not None and _param(params, 'key') != self.key:
+            return status(403, 'This key is not authorized for this service.')
+
+        locations = params.get('location', [])
+        if not locations or len(locations) > self.max_locations:
+            return status(
+                    400, 'Between 1 and {} locations must be given.'.format(
+                        self.max_locations))
+
+        bounding_box = (90.0, -180.0, -90.0, 180.0)
+        if 'boundingBox' in params:
+            try:
+                bounding_box = tuple(
+                        float(v)
+                            for v in _param(params, 'boundingBox').split(','))
+                assert len(bounding_box) == 4
+            except (AssertionError, ValueError):
+                return status(400, 'Illegal bounding box.')
+
+        return _json_response({
+            'info': {'statuscode': 0, 'messages': []},
+            'results': self.faults.order(
+                self._result(l, bounding_box) for l in locations),
+        })
+
+
+def stl_files(incidents):
+    '''
+    Return a {file name => contents} dictionary of the monthly CSV files for
+    the given stl incidents, as served by SlmpdServer.
+    '''
+
+    files = {}
+    for file_name, row in crimedb.synthetic.stl_rows(incidents):
+        if file_name not in files:
+            f = io.StringIO(newline='')
+            w = csv.DictWriter(f, crimedb.synthetic.STL_COLUMNS)
+            w.writeheader()
+            files[file_name] = (f, w)
+
+        files[file_name][1].writerow(row)
+
+    return {fn: f.getvalue().encode('utf-8') for fn, (f, _) in files.items()}
+
+
+def servers(count, seed=0, faults={}, options={}, host='127.0.0.1'):
+    '''
+    Return a {endpoint name => FakeServer} dictionary of servers, not yet
+    started, for each endpoint in crimedb.endpoints, listening on the given
+    host and serving count synthetic incidents from each region.
+
+    The given {endpoint name => Faults} dictionary gives the faults of each
+    server, and the {endpoint name => {option => value}} dictionary any other
+    arguments to its constructor, e.g. {'stlco': {'max_record_count': 100}}.
+    '''
+
+    import crimedb.regions.dallas
+
+    def incidents(region_name):
+        return crimedb.synthetic.incidents(region_name, count, seed)
+
+    def kwargs(name):
+        return dict(options.get(name, {}), faults=faults.get(name), host=host)
+
+    return {
+        'dallas': SocrataServer(
+            crimedb.regions.dallas._SOCRATA_DATASET,
+            crimedb.synthetic.dallas_rows(incidents('dallas')),
+            **kwargs('dallas')),
+        'mapquest': MapQuestServer(**kwargs('mapquest')),
+        'stl': SlmpdServer(stl_files(incidents('stl')), **kwargs('stl')),
+        'stlco': ArcGISServer(
+            crimedb.synthetic.stlco_features(incidents('stlco')),
+            **kwargs('stlco')),
+    }
+
+
+class FakeServersTests(unittest.TestCase):
+    '''
+    Tests for fake servers, run against the code that consumes the real
+    ones.
+    '''
+
+    def setUp(self):
+        import tempfile
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        import crimedb.endpoints
+
+        crimedb.endpoints.set_endpoints(
+                {n: None for n in crimedb.endpoints.DEFAULT_ENDPOINTS})
+        self.temp_dir.cleanup()
+
+    def _region(self, name, server):
+        import crimedb.endpoints
+        import crimedb.regions
+
+        crimedb.endpoints.set_endpoints({name: server.url})
+        return crimedb.regions.region(name, self.temp_dir.name)
+
+    def test_socrata(self):
+        '''
+        Verify that dallas downloads every row, even when out of order, and
+        nothing new when downloading again.
+        '''
+
+        import crimedb.regions.dallas
+
+        rows = list(crimedb.synthetic.dallas_rows(
+                crimedb.synthetic.incidents('dallas', 50)))
+        with SocrataServer(crimedb.regions.dallas._SOCRATA_DATASET, rows,
+                           faults=Faults(shuffle=True)) as server:
+            region = self._region('dallas', server)
+            region.download()
+            self.assertEqual(server.requests, 1)
+            self.assertEqual(
+                    sorted(r['servicenum'] for r in region.raw_records()),
+                    sorted(r['servicenum'] for r in rows))
+
+            region.download()
+            self.assertEqual(server.requests, 2)
+            self.assertEqual(len(list(region.raw_records())), len(rows))
+
+    def test_arcgis(self):
+        '''
+        Verify that stlco pages through every feature.
+        '''
+
+        features = list(crimedb.synthetic.stlco_features(
+                crimedb.synthetic.incidents('stlco', 120)))
+        with ArcGISServer(features, max_record_count=50) as server:
+            region = self._region('stlco', server)
+            region.download()
+
+            # Three pages of features, then an empty one
+            self.assertEqual(server.requests, 4)
+            self.assertEqual(
+                    sorted(json.dumps(f) for f in region.raw_records()),
+                    sorted(json.dumps(f) for f in features))
+
+    def test_arcgis_interrupted(self):
+        '''
+        Verify that stlco keeps the pages that it fetched before a failure,
+        and picks up the rest on the next download.
+        '''
+
+        import crimedb.rawlog
+        import unittest.mock
+        import urllib.error
+
+        features = list(crimedb.synthetic.stlco_features(
+                crimedb.synthetic.incidents('stlco', 120)))
+        with ArcGISServer(features, max_record_count=50) as server, \
+                unittest.mock.patch.object(
+                    crimedb.rawlog, 'CHECKPOINT_INTERVAL', 0):
+            region = self._region('stlco', server)
+            fetched = region.fetch()
+            for _ in range(50):
+                next(fetched)
+
+            server.faults = Faults(error_rate=1)
+            with self.assertRaises(urllib.error.HTTPError):
+                next(fetched)
+            self.assertEqual(len(list(region.raw_records())), 50)
+
+            server.faults = Faults()
+            region.download()
+            self.assertEqual(len(list(region.raw_records())), 120)
+
+    def test_slmpd(self):
+        '''
+        Verify that stl pages through the TOC and downloads every file.
+        '''
+
+        import os
+
+        files = stl_files(crimedb.synthetic.incidents('stl', 200))
+        self.assertEqual(len(files), 12)
+        with SlmpdServer(files, page_size=5) as server:
+            region = self._region('stl', server)
+            region.download()
+
+            # Three TOC pages and twelve files
+            self.assertEqual(server.requests, 15)
+
+            cache_dir = region._cache_dir()
+            self.assertEqual(sorted(os.listdir(cache_dir)), sorted(files))
+            for fn, contents in files.items():
+                with open(os.path.join(cache_dir, fn), 'rb') as f:
+                    self.assertEqual(f.read(), contents)
+
+    def test_mapquest(self):
+        '''
+        Verify that geocoding resolves locations in the order that they were
+        requested, even when results are out of order, and resolves nothing
+        when the server reports an error.
+        '''
+
+        import crimedb.endpoints
+        import crimedb.geocoding
+        import shapely.geometry
+
+        shape = shapely.geometry.box(-90.3, 38.5, -90.1, 38.8)
+        locations = ['{} MARKET ST'.format(i) for i in range(7)]
+        with MapQuestServer(key='k', unresolvable=[locations[3]],
+                            faults=Faults(shuffle=True)) as server:
+            crimedb.endpoints.set_endpoints({'mapquest': server.url})
+
+            results = list(crimedb.geocoding.geocode_mapquest(
+                    'k', locations, shape=shape, batch_size=3))
+            self.assertEqual(server.requests, 3)
+            self.assertEqual(len(results), len(locations))
+            self.assertIsNone(results[3])
+            for i, r in enumerate(results):
+                if i != 3:
+                    self.assertTrue(shape.contains(
+                            shapely.geometry.Point(*r['coordinates'])))
+
+            self.assertEqual(
+                    list(crimedb.geocoding.geocode_mapquest(
+                        'k', locations, shape=shape, batch_size=3)),
+                    results)
+
+            with self.assertLogs('crimedb.geocoding', logging.WARN):
+                self.assertEqual(
+                        list(crimedb.geocoding.geocode_mapquest(
+                            'bad', locations, batch_size=5)),
+                        [None] * len(locations))
+
+    def test_faults(self):
+        '''
+        Verify that errors, rate limiting and latency are injected.
+        '''
+
+        import urllib.error
+        import urllib.request
+
+        with SocrataServer('x', [], faults=Faults(error_rate=1)) as server:
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(server.url + '/resource/x.json')
+            self.assertEqual(cm.exception.code, 500)
+
+        now = [0]
+        faults = Faults(rate_limit=2, clock=lambda: now[0])
+        with SocrataServer('x', [], faults=faults) as server:
+            url = server.url + '/resource/x.json'
+            urllib.request.urlopen(url).close()
+            urllib.request.urlopen(url).close()
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(url)
+            self.assertEqual(cm.exception.code, 429)
+            self.assertEqual(cm.exception.headers['Retry-After'], '1')
+
+            now[0] += 1
+            urllib.request.urlopen(url).close()
+            self.assertEqual(server.requests, 4)
+
+        with SocrataServer('x', [], faults=Faults(latency=0.2)) as server:
+            start = time.monotonic()
+            urllib.request.urlopen(server.url + '/resource/x.json').close()
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
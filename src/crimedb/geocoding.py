@@ -25,11 +25,11 @@ Geocoding utilities.
 '''
 
 from functools import cmp_to_key
+import crimedb.endpoints
 import io
 from itertools import islice
 import json
 import logging
-import shapely.geometry
 import traceback
 import urllib.error
 import urllib.parse
@@ -61,6 +61,8 @@ def __granularity_comparator(a, b):
 
 # Geocode the given set of addresses.
 def __geocode_batch(key, locations, shape=None):
+    import shapely.geometry
+
     def __location_comparator(a, b):
         # XXX: Take confidence into account as well?
         return __granularity_comparator(
@@ -79,28 +81,27 @@ def __geocode_batch(key, locations, shape=None):
                         shape.bounds[1],
                         shape.bounds[2]))]
 
-    url = 'http://open.mapquestapi.com/geocoding/v1/batch?' + \
+    url = crimedb.endpoints.endpoint('mapquest') + '?' + \
         urllib.parse.urlencode(query_params)
     ro = json.load(io.TextIOWrapper(urllib.request.urlopen(url),
                                     encoding='utf-8',
                                     errors='replace'))
 
     if ro['info']['statuscode'] != 0:
-        __LOGGER.warn('Geocoding failed with status %d; yielding empty results'.format(ro['info']['statuscode']))
+        __LOGGER.warn('Geocoding failed with status {}; yielding empty results'.format(ro['info']['statuscode']))
         for _ in locations:
             yield None
-            return
-
-    assert len(ro['results']) == len(locations), \
-            'Got {} results for {} locations'.format(len(ro['results']), len(locations))
+        return
 
-    for loc, result in zip(locations, ro['results']):
-        # XXX: The API doesn't guarantee that results are returned
-        #      in the same order that they were requested. However,
-        #      this seems to be the case in practice.
-        assert result['providedLocation']['location'] == loc
+    # The API doesn't guarantee that results are returned in the same order
+    # that they were requested, so match them up by location
+    results = {r['providedLocation']['location']: r for r in ro['results']}
+    assert set(results) == set(locations), \
+            'Got results for {} of {} locations'.format(
+                len(set(results) & set(locations)), len(set(locations)))
 
-        locs = result['locations']
+    for loc in locations:
+        locs = results[loc]['locations']
 
         # Filter out any locations not within our shape (if specified)
         if shape:
@@ -115,8 +116,7 @@ def __geocode_batch(key, locations, shape=None):
             continue
 
         # Pick the most specific location
-        locs = sorted(result['locations'],
-                      key=cmp_to_key(__location_comparator))
+        locs = sorted(locs, key=cmp_to_key(__location_comparator))
 
         yield {
             'type': 'Point',
@@ -140,7 +140,7 @@ def geocode_mapquest(key, locations, shape=None, batch_size=10, **kwargs):
     while True:
         loc_slice = [l for l in islice(loc_iter, batch_size)]
         if not loc_slice:
-            breae
+            break
         yield from __geocode_batch(key, loc_slice, shape)
 
 
@@ -0,0 +1,264 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Reading and writing of YYYY-MM.json month files.
+
+Month files are written with their crimes sorted by time, along with a
+YYYY-MM.index.json sidecar recording the byte offset and time (in epoch
+seconds) of every Nth crime. Readers interested in only part of a month can
+binary search the index and decode just the slice of the file that they need.
+'''
+
+import bisect
+import crimedb.timecodec
+import datetime
+import json
+import logging
+import os
+import os.path
+import tempfile
+import unittest
+
+__LOGGER = logging.getLogger(__name__)
+
+# Number of crimes between entries in the index
+MONTH_INDEX_STRIDE = 256
+
+# Separator between crimes in the 'crimes' array; this matches the default
+# used by json.dump()
+__CRIME_SEPARATOR = b', '
+
+
+def month_index_path(month_path):
+    '''
+    Return the path of the index file for the given YYYY-MM.json month file.
+    '''
+
+    root, ext = os.path.splitext(month_path)
+    return '{}.index{}'.format(root, ext)
+
+
+def month_filenames_for_date_range(begin, end):
+    '''
+    Return the set of YYYY-MM.json month file names containing crimes between
+    the given datetime.datetime objects.
+    '''
+
+    filenames = set()
+
+    current_date = begin
+    while current_date < end:
+        filenames.add(current_date.strftime('%Y-%m.json'))
+        current_date += datetime.timedelta(days=1)
+
+    return filenames
+
+
+def _crime_timestamp(crime_obj):
+    '''
+    Return the time of the given crime JSON object in epoch seconds.
+    '''
+
+    return crimedb.timecodec.parse_epoch(crime_obj['time'])
+
+
+def write_month_file(path, crime_objs, update_time,
+                     stride=MONTH_INDEX_STRIDE):
+    '''
+    Write the given list of crime JSON objects, which must be sorted by time,
+    to a month file along with its index.
+
+    The resulting file is identical in structure to one produced by
+    json.dump(), but we write it by hand so that we know where each crime
+    begins.
+    '''
+
+    offsets = []
+    times = []
+    with open(path, 'wb') as mf:
+        mf.write('{{"update_time": {}, "crimes": ['.format(
+                json.dumps(update_time)).encode('utf-8'))
+
+        for i, co in enumerate(crime_objs):
+            if i > 0:
+                mf.write(__CRIME_SEPARATOR)
+
+            if i % stride == 0:
+                offsets += [mf.tell()]
+                times += [_crime_timestamp(co)]
+
+            mf.write(json.dumps(co).encode('utf-8'))
+
+        end = mf.tell()
+        mf.write(b']}')
+        size = mf.tell()
+
+    with open(month_index_path(path), 'wt', encoding='utf-8') as xf:
+        json.dump({
+                'stride': stride,
+                'count': len(crime_objs),
+                'size': size,
+                'end': end,
+                'offsets': offsets,
+                'times': times,
+            },
+            xf)
+
+
+def _read_month_index(path):
+    '''
+    Return the index for the given month file, or None if it doesn't exist or
+    is out of date.
+    '''
+
+    ip = month_index_path(path)
+    if not os.path.isfile(ip):
+        return None
+
+    with open(ip, 'rt', encoding='utf-8') as xf:
+        index = json.load(xf)
+
+    if index['size'] != os.path.getsize(path):
+        __LOGGER.warning('ignoring stale index {}'.format(ip))
+        return None
+
+    return index
+
+
+def read_month_crimes(path, time_from=None, time_to=None):
+    '''
+    Return a list of the crime JSON objects in the given month file that
+    occurred within the (inclusive) range [time_from, time_to] of
+    datetime.datetime objects; either may be None to leave the range open.
+
+    If the month file has an index, only the part of the file that can contain
+    crimes in the requested range is read and decoded.
+    '''
+
+    ts_from = time_from.timestamp() if time_from else float('-inf')
+    ts_to = time_to.timestamp() if time_to else float('inf')
+
+    def in_range(co):
+        return ts_from <= _crime_timestamp(co) <= ts_to
+
+    index = _read_month_index(path)
+    if index is None:
+        with open(path, 'rt', encoding='utf-8') as mf:
+            crime_objs = json.load(mf)['crimes']
+
+        if time_from is None and time_to is None:
+            return crime_objs
+
+        return [co for co in crime_objs if in_range(co)]
+
+    # Find the range of blocks [lo, hi) that can contain crimes in our range.
+    # Every crime in a block has a time no less than that of the first crime in
+    # the block, and no greater than that of the first crime in the next block.
+    # Several blocks can start at the same time, in which case crimes at that
+    # time can also be at the end of the block before them, so we start from
+    # the last block that begins strictly before time_from.
+    times = index['times']
+    lo = max(bisect.bisect_left(times, ts_from) - 1, 0)
+    hi = bisect.bisect_right(times, ts_to)
+    if lo >= hi:
+        return []
+
+    start = index['offsets'][lo]
+    stop = index['offsets'][hi] if hi < len(times) else index['end']
+    with open(path, 'rb') as mf:
+        mf.seek(start)
+        data = mf.read(stop - start).rstrip(__CRIME_SEPARATOR)
+
+    crime_objs = json.loads(b'[' + data + b']')
+
+    # Only crimes in the first and last blocks can be outside of our range
+    last = (hi - lo - 1) * index['stride']
+    if last == 0:
+        return [co for co in crime_objs if in_range(co)]
+
+    return [co for co in crime_objs[:index['stride']] if in_range(co)] + \
+            crime_objs[index['stride']:last] + \
+            [co for co in crime_objs[last:] if in_range(co)]
+
+
+class MonthFileTests(unittest.TestCase):
+    '''
+    Tests for reading and writing month files.
+    '''
+
+    def test_read_month_crimes(self):
+        '''
+        Verify that reading a range via the index yields exactly the crimes
+        that reading the entire file does.
+        '''
+
+        crime_objs = [
+            {'description': 'crime {}'.format(i),
+             'time': '2014-01-{:02}T{:02}:00:00-0600'.format(
+                    1 + i // 24, i % 24)}
+                for i in range(24 * 31)]
+
+        with tempfile.TemporaryDirectory() as td:
+            mp = os.path.join(td, '2014-01.json')
+            write_month_file(mp, crime_objs, '2014-02-01T00:00:00+0000',
+                             stride=10)
+
+            with open(mp, 'rt', encoding='utf-8') as mf:
+                self.assertEqual(json.load(mf)['crimes'], crime_objs)
+
+            self.assertEqual(read_month_crimes(mp), crime_objs)
+
+            utc = datetime.timezone.utc
+            for tf, tt in [
+                    ((2014, 1, 1, 6), (2014, 1, 1, 6)),
+                    ((2014, 1, 3, 17), (2014, 1, 12, 2)),
+                    ((2013, 12, 1), (2014, 1, 2)),
+                    ((2014, 1, 30), (2014, 3, 1)),
+                    ((2014, 2, 2), (2014, 3, 1)),
+                    ((2013, 11, 1), (2013, 12, 1))]:
+                time_from = datetime.datetime(*tf, tzinfo=utc)
+                time_to = datetime.datetime(*tt, tzinfo=utc)
+
+                expected = [
+                    co for co in crime_objs
+                        if time_from.timestamp() <=
+                            _crime_timestamp(co) <=
+                            time_to.timestamp()]
+                self.assertEqual(
+                        read_month_crimes(mp, time_from, time_to),
+                        expected)
+
+            # Crimes sharing a time can span several blocks
+            same = [
+                {'description': 'crime {}'.format(i),
+                 'time': '2014-01-02T00:00:00-0600'}
+                    for i in range(30)]
+            later = [{'description': 'later',
+                      'time': '2014-01-03T00:00:00-0600'}]
+            write_month_file(mp, same + later, '2014-02-01T00:00:00+0000',
+                             stride=10)
+            t = datetime.datetime.fromtimestamp(
+                    _crime_timestamp(same[0]), utc)
+            self.assertEqual(read_month_crimes(mp, t), same + later)
+            self.assertEqual(read_month_crimes(mp, t, t), same)
+            self.assertEqual(
+                    read_month_crimes(
+                        mp, t + datetime.timedelta(seconds=1)),
+                    later)
+
+            # Indexes that don't match their month file are ignored
+            with open(mp, 'wt', encoding='utf-8') as mf:
+                json.dump({'crimes': crime_objs[:5]}, mf)
+            self.assertEqual(read_month_crimes(mp), crime_objs[:5])
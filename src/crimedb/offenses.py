@@ -0,0 +1,142 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Per-region dictionaries of offense descriptions.
+
+The descriptions of crimes in a region come from a small vocabulary that is
+repeated for every crime. Each region's data directory has an offenses.json
+file listing every description seen in the region; a description's index in
+this list is its offense code, which collation records in the 'offense' field
+of each crime. Codes are never re-assigned, so they are stable across
+collations and can be compared and used as keys in place of descriptions.
+'''
+
+import json
+import os.path
+import sys
+import tempfile
+import unittest
+
+
+def offense_dictionary_path(data_dir):
+    '''
+    Return the path of the offense dictionary in the given region data
+    directory.
+    '''
+
+    return os.path.join(data_dir, 'offenses.json')
+
+
+class OffenseDictionary(object):
+    '''
+    A mapping between offense descriptions and their integer codes, initially
+    containing the given list of descriptions in code order.
+    '''
+
+    def __init__(self, descriptions=[]):
+        self.descriptions = []
+        self._codes = {}
+        for d in descriptions:
+            self._add(d)
+
+    def _add(self, description):
+        if isinstance(description, str):
+            description = sys.intern(description)
+
+        self._codes[description] = len(self.descriptions)
+        self.descriptions += [description]
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def update(self, descriptions):
+        '''
+        Assign codes to any of the given descriptions that don't have one.
+        New descriptions are added in sorted order, so that the codes assigned
+        don't depend on the order in which crimes are seen.
+        '''
+
+        for d in sorted(set(descriptions) - self._codes.keys(), key=str):
+            self._add(d)
+
+    def code(self, description):
+        '''
+        Return the code for the given description, assigning it one if
+        necessary.
+        '''
+
+        if description not in self._codes:
+            self._add(description)
+
+        return self._codes[description]
+
+    def description(self, code):
+        '''
+        Return the description with the given code.
+        '''
+
+        return self.descriptions[code]
+
+
+def read_offense_dictionary(path):
+    '''
+    Read an offense dictionary from the given file, returning an empty
+    dictionary if there is none.
+    '''
+
+    if not os.path.isfile(path):
+        return OffenseDictionary()
+
+    with open(path, 'rt', encoding='utf-8') as of:
+        return OffenseDictionary(json.load(of)['offenses'])
+
+
+def offense_dictionary_json(od):
+    '''
+    Return the contents of the file for the given offense dictionary.
+    '''
+
+    return json.dumps({'offenses': od.descriptions})
+
+
+class OffenseDictionaryTests(unittest.TestCase):
+    '''
+    Tests for OffenseDictionary.
+    '''
+
+    def test_offense_dictionary(self):
+        '''
+        Verify that codes are assigned deterministically and survive a round
+        trip through a file.
+        '''
+
+        od = OffenseDictionary()
+        od.update(['THEFT', 'ASSAULT', 'THEFT'])
+        self.assertEqual(od.descriptions, ['ASSAULT', 'THEFT'])
+        self.assertEqual(od.code('THEFT'), 1)
+        self.assertEqual(od.code('BURGLARY'), 2)
+
+        with tempfile.TemporaryDirectory() as td:
+            op = offense_dictionary_path(td)
+            self.assertEqual(len(read_offense_dictionary(op)), 0)
+
+            with open(op, 'wt', encoding='utf-8') as of:
+                of.write(offense_dictionary_json(od))
+
+            od = read_offense_dictionary(op)
+            od.update(['ARSON', 'THEFT'])
+            self.assertEqual(
+                    od.descriptions, ['ASSAULT', 'THEFT', 'BURGLARY', 'ARSON'])
+            self.assertEqual(od.description(3), 'ARSON')
@@ -0,0 +1,283 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Utilities for writing output files that may be served while being updated.
+
+Files are replaced atomically via rename(2) so that readers never see a
+partially written file, and files whose contents haven't changed are left
+alone so that their modification times (and thus anything syncing them
+elsewhere) are undisturbed.
+
+Files can also be written with precompressed siblings (e.g. foo.json.gz next
+to foo.json) in any of the encodings in ENCODINGS, so that httpd can serve them
+without compressing every response itself. Siblings in encodings that weren't
+requested are removed whenever a file changes so that they never go stale.
+'''
+
+import concurrent.futures
+from functools import partial
+import gzip
+import os
+import os.path
+import tempfile
+import unittest
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Map of Content-Encoding names to (file extension, compression function)
+# tuples. Everything is compressed at the maximum level, as files are written
+# once and served many times.
+ENCODINGS = {
+    'gzip': ('.gz', partial(gzip.compress, compresslevel=9, mtime=0)),
+}
+if brotli:
+    ENCODINGS['br'] = ('.br', partial(brotli.compress, quality=11))
+
+# Extensions of files worth compressing; everything else (e.g. images) is
+# already compressed
+COMPRESSIBLE_EXTENSIONS = frozenset([
+    '.bin', '.css', '.html', '.js', '.json', '.svg', '.txt'])
+
+
+def encoded_path(path, encoding):
+    '''
+    Return the path of the precompressed sibling of the given file in the
+    given encoding.
+    '''
+
+    return path + ENCODINGS[encoding][0]
+
+
+def _is_compressible(path):
+    return os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS
+
+
+def write_file(path, data, encodings=()):
+    '''
+    Atomically replace the file at the given path with the given data, which
+    may be either bytes or a string (encoded as UTF-8). Parent directories are
+    created as necessary.
+
+    If any encodings are given, precompressed siblings are written in each of
+    them as well.
+
+    Returns True if the file was written, or False if it already had exactly
+    the given contents.
+    '''
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                # Fill in any siblings that we haven't written yet
+                for enc in encodings:
+                    if _is_compressible(path) and \
+                            not os.path.isfile(encoded_path(path, enc)):
+                        _write_encoded_files(path, data, encodings)
+                        break
+
+                return False
+    except FileNotFoundError:
+        pass
+
+    replace_file(path, data)
+    _write_encoded_files(path, data, encodings)
+
+    return True
+
+
+def _write_encoded_files(path, data, encodings):
+    '''
+    Write precompressed siblings of the given file in each of the given
+    encodings, removing any in other encodings.
+    '''
+
+    if not _is_compressible(path):
+        encodings = ()
+
+    for enc in ENCODINGS:
+        ep = encoded_path(path, enc)
+        if enc in encodings:
+            write_file(ep, ENCODINGS[enc][1](data))
+        else:
+            _unlink(ep)
+
+
+def replace_file(path, data):
+    '''
+    Atomically replace the file at the given path with the given bytes,
+    creating parent directories as necessary. Unlike write_file(), this does
+    not check for unchanged contents and leaves precompressed siblings alone.
+    '''
+
+    dp = os.path.dirname(path) or os.curdir
+    os.makedirs(dp, exist_ok=True)
+
+    fd, tp = tempfile.mkstemp(dir=dp, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        # The mkstemp() default of 0600 would prevent httpd from reading it
+        os.chmod(tp, 0o644)
+        os.replace(tp, path)
+    except:
+        os.unlink(tp)
+        raise
+
+
+def compress_file(path, encodings):
+    '''
+    Write precompressed siblings in each of the given encodings of an existing
+    file, which may have been written by something other than write_file()
+    (or be a symlink to such a file).
+
+    Siblings newer than the file itself are assumed to be up to date and are
+    left alone. Returns True if any siblings were written or removed.
+    '''
+
+    mtime = os.stat(path).st_mtime
+    stale = False
+    for enc in ENCODINGS:
+        ep = encoded_path(path, enc)
+        if (enc in encodings) != (os.path.isfile(ep) and
+                                  os.stat(ep).st_mtime >= mtime):
+            stale = True
+
+    if not stale:
+        return False
+
+    with open(path, 'rb') as f:
+        _write_encoded_files(path, f.read(), encodings)
+
+    return True
+
+
+def compress_files(paths, encodings, jobs=None):
+    '''
+    Call compress_file() on each of the given paths that is worth
+    compressing, using up to the given number of threads (default: the number
+    of CPUs).
+
+    Threads are sufficient here as the compression libraries release the GIL.
+    Returns the number of files whose siblings changed.
+    '''
+
+    paths = [p for p in paths if _is_compressible(p)]
+    if not encodings and not any(
+            os.path.exists(encoded_path(p, enc))
+                for p in paths for enc in ENCODINGS):
+        return 0
+
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count()) as ex:
+        return sum(ex.map(partial(compress_file, encodings=encodings), paths))
+
+
+def remove_file(path):
+    '''
+    Remove the file at the given path, if it exists, along with any
+    precompressed siblings of it.
+
+    Returns True if the file was removed.
+    '''
+
+    for enc in ENCODINGS:
+        _unlink(encoded_path(path, enc))
+
+    return _unlink(path)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def symlink(src, dest):
+    '''
+    Atomically create (or replace) a symlink at dest pointing to src.
+
+    Returns True if the symlink was created, or False if it already existed
+    and pointed to src.
+    '''
+
+    if os.path.islink(dest) and os.readlink(dest) == src:
+        return False
+
+    dp = os.path.dirname(dest) or os.curdir
+    os.makedirs(dp, exist_ok=True)
+
+    tp = os.path.join(dp, '.{}.tmp'.format(os.path.basename(dest)))
+    remove_file(tp)
+    os.symlink(src, tp)
+    os.replace(tp, dest)
+
+    return True
+
+
+class OutputTests(unittest.TestCase):
+    '''
+    Tests for writing output files.
+    '''
+
+    def test_write_file_encodings(self):
+        '''
+        Verify that precompressed siblings are written, kept up to date and
+        removed along with their file.
+        '''
+
+        with tempfile.TemporaryDirectory() as td:
+            fp = os.path.join(td, 'a', 'foo.json')
+            gp = encoded_path(fp, 'gzip')
+
+            self.assertTrue(write_file(fp, '{"a": 1}', ['gzip']))
+            with open(gp, 'rb') as gf:
+                self.assertEqual(gzip.decompress(gf.read()), b'{"a": 1}')
+
+            # Siblings are only written when missing or out of date
+            self.assertFalse(write_file(fp, '{"a": 1}', ['gzip']))
+            os.unlink(gp)
+            self.assertFalse(write_file(fp, '{"a": 1}', ['gzip']))
+            self.assertTrue(os.path.isfile(gp))
+
+            self.assertTrue(write_file(fp, '{"a": 2}', ['gzip']))
+            with open(gp, 'rb') as gf:
+                self.assertEqual(gzip.decompress(gf.read()), b'{"a": 2}')
+
+            # Siblings in encodings no longer requested are removed
+            self.assertTrue(write_file(fp, '{"a": 3}'))
+            self.assertFalse(os.path.exists(gp))
+
+            # Files that aren't worth compressing are left alone
+            pp = os.path.join(td, 'a', 'foo.png')
+            write_file(pp, b'png', ['gzip'])
+            self.assertFalse(os.path.exists(encoded_path(pp, 'gzip')))
+
+            self.assertEqual(compress_files([fp, pp], ['gzip']), 1)
+            self.assertEqual(compress_files([fp, pp], ['gzip']), 0)
+            with open(gp, 'rb') as gf:
+                self.assertEqual(gzip.decompress(gf.read()), b'{"a": 3}')
+
+            self.assertTrue(remove_file(fp))
+            self.assertEqual(os.listdir(os.path.join(td, 'a')), ['foo.png'])
@@ -0,0 +1,335 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Run the download, process and collate phases of a crawl as a single pipeline.
+
+Run one after another, each phase waits for the previous one to finish for
+every region, then re-reads everything that it wrote. The pipeline instead
+runs all regions at once. For regions that stream their records (see
+crimedb.regions.base.Region.streams_records), records flow from the download
+through bounded queues to be turned into crimes (parsed, reprojected and
+checked against the region's shape) and written to intermediate files as they
+arrive, so that the network, parsing and writing all overlap. Records already
+downloaded by earlier crawls are fed in alongside the new ones. Each region is
+collated as soon as its crimes are written, while others are still
+downloading. Other regions run their download() and process() in turn.
+
+Queues hold a few batches of records at most, so a slow stage holds back
+those before it rather than letting records pile up in memory.
+'''
+
+import asyncio
+import concurrent.futures
+import crimedb.core
+import crimedb.regions.base
+import datetime
+import logging
+import os.path
+import tempfile
+import threading
+import unittest
+
+__LOGGER = logging.getLogger(__name__)
+
+# Number of records passed between stages at a time
+BATCH_SIZE = 500
+
+# Number of batches that each queue holds before its producer has to wait
+QUEUE_BATCHES = 8
+
+
+def _feed(it, queue, loop, stop):
+    '''
+    Put batches of items from the given iterator onto the given asyncio.Queue,
+    running in the given loop, waiting while the queue is full. This is run
+    outside of the loop. Stop early if the given threading.Event is set.
+    '''
+
+    try:
+        batch = []
+        for item in it:
+            if stop.is_set():
+                return
+
+            batch.append(item)
+            if len(batch) >= BATCH_SIZE:
+                asyncio.run_coroutine_threadsafe(
+                        queue.put(batch), loop).result()
+                batch = []
+
+        if batch and not stop.is_set():
+            asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+    finally:
+        # Let generators clean up, e.g. discarding uncommitted raw records
+        close = getattr(it, 'close', None)
+        if close:
+            close()
+
+
+def _record_crimes(region, records):
+    return [
+        c for c in (region.record_crime(r) for r in records)
+            if c is not None]
+
+
+def _write_crimes(region, crimes):
+    for c in crimes:
+        region._write_intermediate(c)
+
+
+async def _stream_region(region, feeders, collate):
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    records = asyncio.Queue(QUEUE_BATCHES)
+    crimes = asyncio.Queue(QUEUE_BATCHES)
+
+    # Crimes are all written afresh from the raw records, so start from
+    # scratch. They're staged until they're all written, so that if we fail,
+    # the intermediate files from the last successful run are left for
+    # collating.
+    await loop.run_in_executor(None, region._clear_intermediate, True)
+
+    # Take a snapshot of the records already downloaded before fetching any
+    # new ones, so that none are seen twice
+    producers = [
+        loop.run_in_executor(feeders, _feed, it, records, loop, stop)
+            for it in [region.raw_records(), region.fetch()]]
+
+    async def download():
+        await asyncio.gather(*producers)
+        await records.put(None)
+
+    async def transform():
+        while True:
+            batch = await records.get()
+            if batch is None:
+                await crimes.put(None)
+                return
+
+            await crimes.put(await loop.run_in_executor(
+                    None, _record_crimes, region, batch))
+
+    async def write():
+        while True:
+            batch = await crimes.get()
+            if batch is None:
+                return
+
+            await loop.run_in_executor(None, _write_crimes, region, batch)
+
+    stages = [
+        asyncio.ensure_future(s) for s in [download(), transform(), write()]]
+    try:
+        await asyncio.gather(*stages)
+    except BaseException:
+        stop.set()
+        for s in stages:
+            s.cancel()
+
+        # Producers may be waiting for room in the queue; keep making room
+        # until they notice that they've been stopped
+        while not all(p.done() for p in producers):
+            while not records.empty():
+                records.get_nowait()
+            await asyncio.wait(producers, timeout=0.1)
+
+        region._discard_intermediate()
+        raise
+
+    await loop.run_in_executor(None, region._finish_intermediate)
+    __LOGGER.info('processed data from region {}'.format(region.name))
+
+    await loop.run_in_executor(None, collate, region.name, region)
+
+
+async def _run_region(region, feeders, collate):
+    loop = asyncio.get_running_loop()
+
+    __LOGGER.info('running pipeline for region {}'.format(region.name))
+    if region.streams_records:
+        await _stream_region(region, feeders, collate)
+    else:
+        await loop.run_in_executor(None, region.download)
+        await loop.run_in_executor(None, region.process)
+        await loop.run_in_executor(None, collate, region.name, region)
+
+    __LOGGER.info('finished pipeline for region {}'.format(region.name))
+
+
+async def _run_regions(regions, collate):
+    # Each streaming region has two producers blocked on their iterators for
+    # as long as it runs; give them their own threads so that they can't
+    # starve the other stages
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=2 * max(len(regions), 1)) as feeders:
+        # Let every region finish or fail on its own, rather than having the
+        # first failure cancel the others
+        results = await asyncio.gather(
+                *[_run_region(r, feeders, collate) for r in regions],
+                return_exceptions=True)
+
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+
+
+def run_pipeline(regions, collate):
+    '''
+    Download and process the crimes of the given iterable of
+    crimedb.regions.base.Region objects, calling the given function with the
+    name of each region and the region itself once its crimes are ready to
+    collate. This may be called from any thread.
+
+    Every region runs until it finishes or fails, regardless of how the
+    others fare; once they all have, the exception raised by the first region
+    to fail, in the order given, is raised.
+    '''
+
+    asyncio.run(_run_regions(list(regions), collate))
+
+
+class _StreamingRegion(crimedb.regions.base.Region):
+    '''
+    Region streaming records from lists, for testing.
+    '''
+
+    streams_records = True
+
+    def __init__(self, work_dir, old, new, fail_at=None):
+        super().__init__('test', work_dir=work_dir)
+        self.log = list(old)
+        self.new = new
+        self.fail_at = fail_at
+
+    def fetch(self):
+        for r in self.new:
+            if r == self.fail_at:
+                raise RuntimeError('failed to fetch')
+
+            self.log.append(r)
+            yield r
+
+    def raw_records(self):
+        return iter(list(self.log))
+
+    def record_crime(self, r):
+        if r % 7 == 0:
+            return None
+
+        return crimedb.core.Crime(
+                'crime {}'.format(r % 3),
+                datetime.datetime.fromtimestamp(
+                    1388534400 + r * 3600, datetime.timezone.utc),
+                (-90 + r / 10000, 38))
+
+
+class PipelineTests(unittest.TestCase):
+    '''
+    Tests for the pipeline.
+    '''
+
+    def test_run_pipeline(self):
+        '''
+        Verify that streamed regions end up with the same crimes as they do
+        when downloaded and processed, and are collated.
+        '''
+
+        old = list(range(0, 2000))
+        new = list(range(2000, 3100))
+
+        def key(c):
+            return (c.description, c.time, c.location)
+
+        with tempfile.TemporaryDirectory() as td:
+            expected = _StreamingRegion(os.path.join(td, 'a'), old, new)
+            expected.download()
+            expected.process()
+
+            collated = []
+            actual = _StreamingRegion(os.path.join(td, 'b'), old, new)
+            run_pipeline(
+                    [actual], lambda name, region: collated.append(name))
+
+            self.assertEqual(
+                    sorted(map(key, actual.crimes())),
+                    sorted(map(key, expected.crimes())))
+            self.assertEqual(len(list(actual.crimes())), 3100 - 443)
+            self.assertEqual(collated, ['test'])
+
+    def test_run_pipeline_failure(self):
+        '''
+        Verify that download failures are raised, and that the region isn't
+        collated.
+        '''
+
+        old = list(range(0, 20000))
+        new = list(range(20000, 21000))
+
+        with tempfile.TemporaryDirectory() as td:
+            collated = []
+            region = _StreamingRegion(td, old, new, fail_at=20001)
+            with self.assertRaises(RuntimeError):
+                run_pipeline(
+                        [region], lambda name, region: collated.append(name))
+
+            self.assertEqual(collated, [])
+
+    def test_run_pipeline_failure_others_finish(self):
+        '''
+        Verify that a region failing doesn't stop others from finishing.
+        '''
+
+        with tempfile.TemporaryDirectory() as td:
+            collated = []
+            failing = _StreamingRegion(
+                    os.path.join(td, 'a'), [], list(range(5000)), fail_at=10)
+            slow = _StreamingRegion(
+                    os.path.join(td, 'b'), list(range(20000)),
+                    list(range(20000, 21000)))
+            slow.name = 'slow'
+            with self.assertRaises(RuntimeError):
+                run_pipeline(
+                        [failing, slow],
+                        lambda name, region: collated.append(name))
+
+            self.assertEqual(collated, ['slow'])
+            self.assertEqual(len(list(slow.crimes())), 21000 - 3000)
+
+    def test_run_pipeline_failure_keeps_intermediate(self):
+        '''
+        Verify that a failed run leaves the intermediate files of the last
+        successful one in place.
+        '''
+
+        def key(c):
+            return (c.description, c.time, c.location)
+
+        old = list(range(0, 20000))
+        new = list(range(20000, 21000))
+
+        with tempfile.TemporaryDirectory() as td:
+            region = _StreamingRegion(td, old, [])
+            run_pipeline([region], lambda name, region: None)
+            expected = sorted(map(key, region.crimes()))
+            extents = region._read_intermediate_extents()
+            self.assertTrue(extents)
+
+            region = _StreamingRegion(td, old, new, fail_at=20001)
+            with self.assertRaises(RuntimeError):
+                run_pipeline([region], lambda name, region: None)
+
+            self.assertEqual(sorted(map(key, region.crimes())), expected)
+            self.assertEqual(region._read_intermediate_extents(), extents)
+            self.assertEqual(sorted(os.listdir(td)), ['intermediate'])
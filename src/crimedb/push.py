@@ -0,0 +1,361 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Pushing directory trees to a destination based on a local manifest.
+
+A manifest is a {relative path => {'sha1', 'size', 'mtime_ns'}} dictionary of
+the files in a directory tree. The manifest of each successful push to a
+destination is saved locally, so the next push can work out which files to
+upload and delete by comparing manifests, rather than by listing and comparing
+the entire destination. Files whose size and modification time are unchanged
+since the last push are not even re-hashed.
+
+Destinations can be local directories or s3:// URLs, which are written using
+s3cmd(1); pointing that at a local S3 stand-in allows testing without S3.
+'''
+
+import concurrent.futures
+import crimedb.output
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import os.path
+import re
+import subprocess
+import tempfile
+import unittest
+import urllib.parse
+
+_LOGGER = logging.getLogger(__name__)
+
+# Number of paths to delete per s3cmd invocation
+_S3_DELETE_BATCH_SIZE = 100
+
+# Content-Types not known to (all versions of) the mimetypes module
+_CONTENT_TYPES = {
+    '.bin': 'application/octet-stream',
+    '.json': 'application/json',
+    '.mbtiles': 'application/x-sqlite3',
+}
+
+
+def _excluded(fn):
+    '''
+    Return whether the given file name should never be pushed; these are
+    editor swap files, temporary files written by crimedb.output and
+    SQLite's journals.
+    '''
+
+    return fn.startswith('.') or \
+            fn.endswith('.swp') or \
+            fn.endswith('-wal') or \
+            fn.endswith('-shm') or \
+            fn.endswith('-journal')
+
+
+def _hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(1 << 20), b''):
+            h.update(b)
+
+    return h.hexdigest()
+
+
+def scan(src_dir, previous={}):
+    '''
+    Return the manifest of the given directory tree, following symlinks.
+
+    Files whose size and modification time match their entry in the previous
+    manifest are assumed to be unchanged and are not re-hashed.
+    '''
+
+    manifest = {}
+    for dp, dnames, fnames in os.walk(src_dir, followlinks=True):
+        dnames[:] = [dn for dn in dnames if not _excluded(dn)]
+        for fn in fnames:
+            if _excluded(fn):
+                continue
+
+            fp = os.path.join(dp, fn)
+            rp = os.path.relpath(fp, src_dir).replace(os.sep, '/')
+            st = os.stat(fp)
+
+            pe = previous.get(rp)
+            if pe and pe['size'] == st.st_size and \
+                    pe['mtime_ns'] == st.st_mtime_ns:
+                manifest[rp] = pe
+                continue
+
+            manifest[rp] = {
+                'sha1': _hash_file(fp),
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+            }
+
+    return manifest
+
+
+def diff_manifests(old, new):
+    '''
+    Return a (changed, removed) tuple of sorted lists of the paths whose
+    contents differ between the two manifests, and those that are no longer
+    present.
+    '''
+
+    changed = sorted(
+            rp for rp, e in new.items()
+                if rp not in old or old[rp]['sha1'] != e['sha1'])
+    removed = sorted(rp for rp in old if rp not in new)
+
+    return changed, removed
+
+
+def read_manifest(path):
+    '''
+    Read a manifest saved with write_manifest(), returning an empty manifest
+    if there is none.
+    '''
+
+    try:
+        with open(path, 'rt', encoding='utf-8') as mf:
+            return json.load(mf)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(path, manifest):
+    '''
+    Save the given manifest.
+    '''
+
+    crimedb.output.write_file(path, json.dumps(manifest, sort_keys=True))
+
+
+def manifest_path(manifest_dir, dest):
+    '''
+    Return the path of the manifest for the given destination.
+    '''
+
+    return os.path.join(
+            manifest_dir, '{}.json'.format(re.sub(r'[^\w.-]', '_', dest)))
+
+
+def content_headers(path):
+    '''
+    Return a (Content-Type, Content-Encoding) tuple for the given path; the
+    latter is None unless the path is a precompressed file written by
+    crimedb.output.
+    '''
+
+    encoding = None
+    for enc, (ext, _) in crimedb.output.ENCODINGS.items():
+        if path.endswith(ext):
+            encoding = enc
+            path = path[:-len(ext)]
+            break
+
+    content_type = _CONTENT_TYPES.get(os.path.splitext(path)[1])
+    if content_type is None:
+        content_type = mimetypes.guess_type(path, strict=False)[0] or \
+                'application/octet-stream'
+
+    return content_type, encoding
+
+
+class DirectoryDestination(object):
+    '''
+    A destination that is a local directory.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, src_path, path):
+        with open(src_path, 'rb') as f:
+            crimedb.output.replace_file(
+                    os.path.join(self.path, path), f.read())
+
+    def delete(self, paths):
+        for p in paths:
+            try:
+                os.unlink(os.path.join(self.path, p))
+            except FileNotFoundError:
+                pass
+
+
+class S3Destination(object):
+    '''
+    A destination that is an s3://<bucket>/<prefix> URL, written with
+    s3cmd(1). If given, endpoint is the http[s]://<host>[:<port>] URL of an
+    S3-compatible service to use instead of S3 itself.
+    '''
+
+    def __init__(self, url, endpoint=None, s3cmd='s3cmd'):
+        self.url = url.rstrip('/')
+        self.command = [s3cmd]
+        if endpoint:
+            eu = urllib.parse.urlsplit(endpoint)
+            self.command += [
+                '--host={}'.format(eu.netloc),
+                '--host-bucket={}'.format(eu.netloc)]
+            if eu.scheme == 'http':
+                self.command += ['--no-ssl']
+
+    def _run(self, args):
+        _LOGGER.debug('running {}'.format(self.command + args))
+        subprocess.run(
+                self.command + args, check=True, stdout=subprocess.DEVNULL)
+
+    def put(self, src_path, path):
+        content_type, encoding = content_headers(path)
+        args = [
+            'put', '--acl-public', '--no-guess-mime-type',
+            '--mime-type={}'.format(content_type)]
+        if encoding:
+            args += ['--add-header=Content-Encoding:{}'.format(encoding)]
+
+        self._run(args + [src_path, '{}/{}'.format(self.url, path)])
+
+    def delete(self, paths):
+        for i in range(0, len(paths), _S3_DELETE_BATCH_SIZE):
+            self._run(['del'] + [
+                '{}/{}'.format(self.url, p)
+                    for p in paths[i:i + _S3_DELETE_BATCH_SIZE]])
+
+
+def destination_for_url(url, s3_endpoint=None):
+    '''
+    Return a destination object for the given s3:// URL or directory path.
+    '''
+
+    if url.startswith('s3://'):
+        return S3Destination(url, s3_endpoint)
+
+    return DirectoryDestination(url)
+
+
+def push(src_dir, dest, manifest_path, jobs=8):
+    '''
+    Push the given directory tree to the given destination object, uploading
+    files using up to the given number of threads, based on the manifest of
+    the last push saved at the given path.
+
+    The saved manifest is updated to reflect whatever was pushed, even if
+    some uploads fail. Returns an (uploaded, deleted) tuple of the number of
+    files affected.
+    '''
+
+    old = read_manifest(manifest_path)
+    new = scan(src_dir, old)
+    changed, removed = diff_manifests(old, new)
+
+    _LOGGER.info('pushing {}: {} files changed, {} files removed'.format(
+            src_dir, len(changed), len(removed)))
+
+    # Uploads are done before deletes so that nothing is missing from the
+    # destination in the meantime
+    #
+    # The manifest that we save starts out describing the destination as it
+    # is now: unchanged files (with their current size and modification time,
+    # so that they needn't be re-hashed next time) and the old versions of
+    # everything else
+    pushed = dict(old)
+    pushed.update({rp: e for rp, e in new.items() if rp in old})
+    pushed.update({rp: old[rp] for rp in changed if rp in old})
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as ex:
+            futures = {
+                ex.submit(dest.put, os.path.join(src_dir, rp), rp): rp
+                    for rp in changed}
+            for f in concurrent.futures.as_completed(futures):
+                f.result()
+                pushed[futures[f]] = new[futures[f]]
+
+        dest.delete(removed)
+        for rp in removed:
+            del pushed[rp]
+    finally:
+        write_manifest(manifest_path, pushed)
+
+    return len(changed), len(removed)
+
+
+class PushTests(unittest.TestCase):
+    '''
+    Tests for push().
+    '''
+
+    def test_push(self):
+        '''
+        Verify that only changed files are uploaded and that removed files are
+        deleted.
+        '''
+
+        class RecordingDestination(DirectoryDestination):
+            def put(self, src_path, path):
+                self.puts += [path]
+                super().put(src_path, path)
+
+        def write(path, data):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wt') as f:
+                f.write(data)
+
+        with tempfile.TemporaryDirectory() as td:
+            src = os.path.join(td, 'src')
+            mp = os.path.join(td, 'manifest.json')
+            dest = RecordingDestination(os.path.join(td, 'dest'))
+
+            write(os.path.join(src, 'a.json'), 'a')
+            write(os.path.join(src, 'b', 'c.json'), 'c')
+            write(os.path.join(src, 'b', '.c.json.tmp'), 'tmp')
+
+            dest.puts = []
+            self.assertEqual(push(src, dest, mp), (2, 0))
+            self.assertEqual(sorted(dest.puts), ['a.json', 'b/c.json'])
+
+            # Re-writing a file with the same contents doesn't re-upload it
+            write(os.path.join(src, 'a.json'), 'a')
+            write(os.path.join(src, 'b', 'c.json'), 'C')
+            write(os.path.join(src, 'd.json'), 'd')
+            dest.puts = []
+            self.assertEqual(push(src, dest, mp), (2, 0))
+            self.assertEqual(sorted(dest.puts), ['b/c.json', 'd.json'])
+
+            os.unlink(os.path.join(src, 'a.json'))
+            dest.puts = []
+            self.assertEqual(push(src, dest, mp), (0, 1))
+            self.assertEqual(dest.puts, [])
+
+            self.assertEqual(
+                    {rp: e['sha1']
+                        for rp, e in scan(os.path.join(td, 'dest')).items()},
+                    {rp: e['sha1'] for rp, e in read_manifest(mp).items()})
+
+    def test_content_headers(self):
+        '''
+        Verify the headers with which files are uploaded.
+        '''
+
+        self.assertEqual(
+                content_headers('grid-data/1/2/3.json.gz'),
+                ('application/json', 'gzip'))
+        self.assertEqual(
+                content_headers('grid-data/1/2/3.bin'),
+                ('application/octet-stream', None))
+        self.assertEqual(content_headers('index.html'), ('text/html', None))
@@ -0,0 +1,1123 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Ad-hoc queries over collated crime data, as served by bin/serve.
+
+A CrimeIndex holds the crimes in the month files of every region in a data
+directory written by 'bin/crawl collate'. The crimes of each month are kept
+in columns sorted by the Morton code (i.e. the quadkey as an integer; see
+crimedb.chunks.quadkey()) of their cell at crimedb.www.GRID_BASE_ZOOM. The
+crimes within a bounding box are then found by binary searching the few
+ranges of codes covering it rather than by scanning every crime, and months
+outside of the requested time range are skipped entirely.
+
+CrimeIndex.tile_cells() computes the cells of a grid-data/ tile (see
+crimedb.tiles) from the crimes in any time range. A tile covers a single range
+of Morton codes, so finding its crimes takes one binary search per month.
+
+A ResponseCache is an LRU cache of responses which coalesces concurrent
+requests for the same response, so that each is computed only once no matter
+how many clients ask for it at the same time. A DiskCache does the same, but
+keeps a bounded number of bytes of responses on disk so that they survive
+restarts.
+'''
+
+import array
+import bisect
+import concurrent.futures
+from collections import Counter, defaultdict, OrderedDict
+import crimedb.timecodec
+import crimedb.www
+from functools import partial
+import hashlib
+import json
+import logging
+import os
+import os.path
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+_LOGGER = logging.getLogger(__name__)
+
+# Morton code of crimes without a location, which sorts after all others
+_UNLOCATED = 2 ** 63 - 1
+
+# Maximum latitude covered by Slippy map tiles
+_MAX_LATITUDE = 85.0511
+
+# Maximum number of tiles used to cover the bounding box of a query; fewer
+# tiles means fewer binary searches, but more crimes outside of the box to
+# filter out
+_MAX_COVER_TILES = 16
+
+# Number of features returned by CrimeIndex.features() if no limit is given
+DEFAULT_LIMIT = 10000
+
+# Maximum zoom level of tiles computed by CrimeIndex.tile_cells(); crimes are
+# indexed by their cell at this zoom level
+MAX_TILE_ZOOM = crimedb.www.GRID_BASE_ZOOM
+
+# Spread the bits of a byte apart, i.e. bit i of b is bit 2 * i of _SPREAD[b]
+_SPREAD = [
+    sum(((b >> i) & 1) << (2 * i) for i in range(8)) for b in range(256)]
+
+
+def morton_code(x, y):
+    '''
+    Return the Morton code of the given Slippy map tile coordinates, which
+    must be less than 2 ** 24.
+    '''
+
+    return _SPREAD[x & 0xff] | \
+            _SPREAD[(x >> 8) & 0xff] << 16 | \
+            _SPREAD[x >> 16] << 32 | \
+            (_SPREAD[y & 0xff] | \
+                _SPREAD[(y >> 8) & 0xff] << 16 | \
+                _SPREAD[y >> 16] << 32) << 1
+
+
+def _morton_xy(code):
+    '''
+    Return the Slippy map tile coordinates with the given Morton code.
+    '''
+
+    x = y = 0
+    bit = 0
+    while code:
+        x |= (code & 1) << bit
+        y |= ((code >> 1) & 1) << bit
+        code >>= 2
+        bit += 1
+
+    return x, y
+
+
+def _morton_ranges(bbox, zoom=crimedb.www.GRID_BASE_ZOOM):
+    '''
+    Return a sorted list of [lo, hi) ranges of the Morton codes at the given
+    zoom level of cells that may be within the given (minx, miny, maxx, maxy)
+    bounding box.
+    '''
+
+    # Clamp the box to the area covered by Slippy map tiles
+    minx, miny, maxx, maxy = bbox
+    minx, maxx = (min(max(v, -180.0), 180.0) for v in (minx, maxx))
+    miny, maxy = (min(max(v, -_MAX_LATITUDE), _MAX_LATITUDE)
+                  for v in (miny, maxy))
+
+    side = 2 ** zoom
+    x0, y1 = (min(max(v, 0), side - 1) for v in
+              crimedb.www.slippy_tile_coordinates_from_point(minx, miny, zoom))
+    x1, y0 = (min(max(v, 0), side - 1) for v in
+              crimedb.www.slippy_tile_coordinates_from_point(maxx, maxy, zoom))
+
+    # Cover the box with the tiles at the finest zoom level at which it takes
+    # no more than _MAX_COVER_TILES of them
+    shift = 0
+    while ((x1 >> shift) - (x0 >> shift) + 1) * \
+            ((y1 >> shift) - (y0 >> shift) + 1) > _MAX_COVER_TILES:
+        shift += 1
+
+    codes = sorted(
+        morton_code(x, y)
+            for x in range(x0 >> shift, (x1 >> shift) + 1)
+            for y in range(y0 >> shift, (y1 >> shift) + 1))
+
+    # Merge adjacent tiles into a single range
+    ranges = []
+    for c in codes:
+        lo, hi = c << (2 * shift), (c + 1) << (2 * shift)
+        if ranges and ranges[-1][1] == lo:
+            ranges[-1][1] = hi
+        else:
+            ranges += [[lo, hi]]
+
+    return ranges
+
+
+def _intersects_xy(polygon, xs, ys):
+    '''
+    Return a list of whether each of the points with the given coordinates is
+    within the given polygon or on its boundary, like bounding boxes.
+    '''
+
+    import shapely
+
+    # Shapely 2 can test all of the points at once, which is much faster
+    if hasattr(shapely, 'intersects_xy'):
+        return shapely.intersects_xy(polygon, xs, ys).tolist()
+
+    import shapely.geometry
+    import shapely.prepared
+
+    prepared = shapely.prepared.prep(polygon)
+    return [
+        prepared.intersects(shapely.geometry.Point(x, y))
+            for x, y in zip(xs, ys)]
+
+
+class Query(object):
+    '''
+    A query for crimes in the given list of regions (default: all) within the
+    given (minx, miny, maxx, maxy) bounding box and/or shapely polygon, in
+    the (inclusive) range [time_from, time_to] of epoch seconds, and with one
+    of the given offense codes. Constraints that are None are not applied;
+    crimes without a location only match queries without a bounding box or
+    polygon.
+
+    As offense codes are assigned per-region (see crimedb.offenses), queries
+    by offense must be for exactly one region.
+    '''
+
+    def __init__(self, regions=None, bbox=None, polygon=None, time_from=None,
+                 time_to=None, offenses=None, limit=None):
+        if offenses is not None and (regions is None or len(regions) != 1):
+            raise ValueError('offenses can only be queried in a single region')
+
+        if polygon is not None:
+            bbox = polygon.bounds
+
+        self.regions = regions
+        self.bbox = bbox
+        self.polygon = polygon
+        self.time_from = time_from if time_from is not None else float('-inf')
+        self.time_to = time_to if time_to is not None else float('inf')
+        self.offenses = offenses
+        self.limit = limit
+
+
+def _parse_time(s):
+    '''
+    Parse a time given either in epoch seconds or as an RFC3339 timestamp,
+    returning epoch seconds.
+    '''
+
+    try:
+        return float(s)
+    except ValueError:
+        return crimedb.timecodec.parse_epoch(s)
+
+
+def _parse_floats(s, count=None):
+    floats = [float(v) for v in s.split(',')]
+    if count is not None and len(floats) != count:
+        raise ValueError('expected {} values: {}'.format(count, s))
+
+    return floats
+
+
+def parse_query(params):
+    '''
+    Return a Query for the given {name => value} dictionary of query string
+    parameters, raising ValueError if they are not valid. Parameters are:
+
+      - region: comma-separated list of region names
+      - bbox: minx,miny,maxx,maxy
+      - polygon: lon,lat,lon,lat,... vertices of a polygon
+      - from, to: epoch seconds or RFC3339 timestamps
+      - offense: comma-separated list of offense codes
+      - limit: maximum number of crimes to return
+    '''
+
+    unknown = set(params) - \
+            {'region', 'bbox', 'polygon', 'from', 'to', 'offense', 'limit'}
+    if unknown:
+        raise ValueError('unknown parameters: {}'.format(
+                ', '.join(sorted(unknown))))
+
+    polygon = None
+    if 'polygon' in params:
+        import shapely.geometry
+
+        coords = _parse_floats(params['polygon'])
+        if len(coords) < 6 or len(coords) % 2:
+            raise ValueError('invalid polygon: {}'.format(params['polygon']))
+
+        polygon = shapely.geometry.Polygon(zip(coords[0::2], coords[1::2]))
+        if not polygon.is_valid:
+            raise ValueError('invalid polygon: {}'.format(params['polygon']))
+
+    return Query(
+            regions=params['region'].split(',') if 'region' in params else None,
+            bbox=_parse_floats(params['bbox'], 4) if 'bbox' in params else None,
+            polygon=polygon,
+            time_from=_parse_time(params['from']) if 'from' in params else None,
+            time_to=_parse_time(params['to']) if 'to' in params else None,
+            offenses={int(v) for v in params['offense'].split(',')}
+                if 'offense' in params else None,
+            limit=int(params['limit']) if 'limit' in params else None)
+
+
+class _Month(object):
+    '''
+    The crimes in a single month file, held in columns sorted by Morton code.
+    '''
+
+    def __init__(self, crime_objs, mtime):
+        self.mtime = mtime
+
+        rows = []
+        for co in crime_objs:
+            code = _UNLOCATED
+            lon = lat = 0.0
+            if 'geo' in co:
+                lon, lat = co['geo']['coordinates']
+                code = morton_code(*crimedb.www.slippy_tile_coordinates_from_point(
+                        lon, lat, crimedb.www.GRID_BASE_ZOOM))
+
+            rows += [(
+                code,
+                crimedb.timecodec.parse_epoch(co['time']),
+                lon,
+                lat,
+                co.get('offense', -1),
+                co['time'],
+                sys.intern(co['description']))]
+
+        rows.sort(key=lambda r: r[:2])
+
+        self.codes = array.array('Q', (r[0] for r in rows))
+        self.times = array.array('d', (r[1] for r in rows))
+        self.lons = array.array('d', (r[2] for r in rows))
+        self.lats = array.array('d', (r[3] for r in rows))
+        self.offenses = array.array('l', (r[4] for r in rows))
+        self.time_strings = [r[5] for r in rows]
+        self.descriptions = [r[6] for r in rows]
+
+        self.time_min = min(self.times) if rows else None
+        self.time_max = max(self.times) if rows else None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _may_match(self, query):
+        return self.codes and \
+                self.time_max >= query.time_from and \
+                self.time_min <= query.time_to
+
+    def _range_matches(self, query, lo, hi):
+        '''
+        Return a generator of the indexes of crimes with Morton codes in the
+        range [lo, hi) matching the given query, ignoring its bounding box.
+        '''
+
+        times = self.times
+        offenses = self.offenses
+        time_from = query.time_from
+        time_to = query.time_to
+        wanted_offenses = query.offenses
+
+        for i in range(
+                bisect.bisect_left(self.codes, lo),
+                bisect.bisect_left(self.codes, hi)):
+            if time_from <= times[i] <= time_to and \
+                    (wanted_offenses is None or offenses[i] in wanted_offenses):
+                yield i
+
+    def matches(self, query):
+        '''
+        Return a generator of the indexes of crimes matching the given query.
+        '''
+
+        if not self._may_match(query):
+            return
+
+        if query.bbox is None:
+            yield from self._range_matches(query, 0, _UNLOCATED + 1)
+            return
+
+        minx, miny, maxx, maxy = query.bbox
+        lons = self.lons
+        lats = self.lats
+        for lo, hi in _morton_ranges(query.bbox):
+            for i in self._range_matches(query, lo, hi):
+                if minx <= lons[i] <= maxx and miny <= lats[i] <= maxy:
+                    yield i
+
+    def tile_matches(self, query, z, x, y):
+        '''
+        Return a generator of the indexes of crimes in the given tile, at a
+        zoom level of at most crimedb.www.GRID_BASE_ZOOM, matching the given
+        query, ignoring its bounding box.
+        '''
+
+        if not self._may_match(query):
+            return
+
+        shift = 2 * (crimedb.www.GRID_BASE_ZOOM - z)
+        yield from self._range_matches(
+                query, morton_code(x, y) << shift,
+                (morton_code(x, y) + 1) << shift)
+
+
+class CrimeIndex(object):
+    '''
+    An in-memory index of the crimes in the given data directory.
+
+    The index is loaded by refresh(), which must be called before querying
+    it, and can be called again at any time to pick up changes made by
+    collation since. Queries can be made from multiple threads.
+    '''
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+        # {region name => {month file name => _Month}}; this is replaced
+        # rather than modified so that queries can run during a refresh
+        self._regions = {}
+        self._refresh_lock = threading.Lock()
+
+        # Identifies the data loaded; see version()
+        self._version = None
+
+    def regions(self):
+        '''
+        Return a sorted list of the names of regions in the index.
+        '''
+
+        return sorted(self._regions)
+
+    def version(self):
+        '''
+        Return a string identifying the data in the index, which changes
+        whenever refresh() loads anything new. Responses computed from the
+        index can be cached under a key including it.
+        '''
+
+        return self._version
+
+    def refresh(self):
+        '''
+        (Re-)load any month files that have changed since they were last
+        loaded, returning True if anything changed.
+        '''
+
+        with self._refresh_lock:
+            regions = {}
+            changed = False
+
+            ip = os.path.join(self.data_dir, 'index.json')
+            with open(ip, 'rt', encoding='utf-8') as mf:
+                region_names = json.load(mf)['regions']
+
+            for rn in region_names:
+                rp = os.path.join(self.data_dir, rn)
+                with open(os.path.join(rp, 'index.json'), 'rt',
+                          encoding='utf-8') as mf:
+                    filenames = json.load(mf).get('files', [])
+
+                old_months = self._regions.get(rn, {})
+                months = {}
+                for fn in filenames:
+                    mp = os.path.join(rp, fn)
+                    mtime = os.stat(mp).st_mtime
+                    if fn in old_months and old_months[fn].mtime == mtime:
+                        months[fn] = old_months[fn]
+                        continue
+
+                    with open(mp, 'rt', encoding='utf-8') as mf:
+                        months[fn] = _Month(json.load(mf)['crimes'], mtime)
+                    changed = True
+
+                changed |= set(months) != set(old_months)
+                regions[rn] = months
+
+            changed |= set(regions) != set(self._regions)
+            if changed:
+                self._regions = regions
+                self._version = hashlib.sha1(json.dumps([
+                    [rn, fn, m.mtime]
+                        for rn, months in sorted(regions.items())
+                        for fn, m in sorted(months.items())]).encode(
+                            'utf-8')).hexdigest()[:16]
+                _LOGGER.info('loaded {} crimes in {} regions'.format(
+                        sum(len(m) for ms in regions.values()
+                            for m in ms.values()),
+                        len(regions)))
+
+            return changed
+
+    def _query_regions(self, query):
+        '''
+        Return a sorted list of the names of the regions to which the given
+        query applies, raising ValueError if it names any unknown regions.
+        '''
+
+        if query.regions is None:
+            return sorted(self._regions)
+
+        unknown = set(query.regions) - set(self._regions)
+        if unknown:
+            raise ValueError('unknown regions: {}'.format(
+                    ', '.join(sorted(unknown))))
+
+        return sorted(set(query.regions))
+
+    def _matches(self, query):
+        '''
+        Return a generator of (region name, _Month, index) tuples of the
+        crimes matching the given query.
+        '''
+
+        regions = self._regions
+        for rn in self._query_regions(query):
+            for fn, m in sorted(regions[rn].items()):
+                indexes = list(m.matches(query))
+                if query.polygon is not None and indexes:
+                    inside = _intersects_xy(
+                            query.polygon,
+                            [m.lons[i] for i in indexes],
+                            [m.lats[i] for i in indexes])
+                    indexes = [i for i, ii in zip(indexes, inside) if ii]
+
+                for i in indexes:
+                    yield rn, m, i
+
+    def tile_cells(self, query, z, x, y,
+                   zoom_depth=crimedb.www.GRID_CELL_ZOOM_DEPTH):
+        '''
+        Return an {xx => {yy => count}} grid of the number of crimes matching
+        the given query, whose bounding box and polygon must be None, in each
+        of the cells at zoom level z + zoom_depth of the given tile, where
+        (xx, yy) are the coordinates of the cell within the tile. As in tiles
+        rendered by bin/render, cells with no crimes but within the boundary
+        of a region are present with a count of 0.
+        '''
+
+        assert query.bbox is None
+        if not 0 <= z <= MAX_TILE_ZOOM or \
+                not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            raise ValueError('invalid tile: {}/{}/{}'.format(z, x, y))
+
+        regions = self._query_regions(query)
+        cell_zoom = z + zoom_depth
+        base_zoom = crimedb.www.GRID_BASE_ZOOM
+        side = 2 ** zoom_depth
+
+        cell_counts = Counter()
+        for rn in regions:
+            for fn, m in sorted(self._regions[rn].items()):
+                indexes = m.tile_matches(query, z, x, y)
+                if cell_zoom <= base_zoom:
+                    # The Morton code of a cell at a coarser zoom level is a
+                    # prefix of that of each crime in it
+                    shift = 2 * (base_zoom - cell_zoom)
+                    codes = m.codes
+                    cell_counts.update(codes[i] >> shift for i in indexes)
+                else:
+                    for i in indexes:
+                        cx, cy = crimedb.www.slippy_tile_coordinates_from_point(
+                                m.lons[i], m.lats[i], cell_zoom)
+                        cell_counts[morton_code(cx, cy)] += 1
+
+        cells = defaultdict(partial(defaultdict, int))
+        for code, count in cell_counts.items():
+            cx, cy = _morton_xy(code)
+            cells[cx - x * side][cy - y * side] += count
+
+        self._add_empty_cells(cells, regions, z, x, y, zoom_depth)
+
+        return cells
+
+    def _add_empty_cells(self, cells, regions, z, x, y, zoom_depth):
+        '''
+        Add empty cells to the given tile for each cell within the boundary
+        of any of the given regions. Regions without a known boundary are
+        ignored.
+        '''
+
+        import crimedb.regions
+        import crimedb.regions.boundary
+
+        tile_shape = None
+        side = 2 ** zoom_depth
+        for rn in regions:
+            if rn not in crimedb.regions.region_names():
+                continue
+
+            boundary = crimedb.regions.boundary.boundary(rn)
+            if tile_shape is None:
+                tile_shape = crimedb.www.bbox_from_slippy_tile_coordinates(
+                        x, y, z)
+            if not boundary.intersects(tile_shape):
+                continue
+
+            for xx in range(0, side):
+                for yy in range(0, side):
+                    if yy in cells[xx]:
+                        continue
+
+                    cell_shape = crimedb.www.bbox_from_slippy_tile_coordinates(
+                            x * side + xx, y * side + yy, z + zoom_depth)
+                    if boundary.intersects(cell_shape):
+                        cells[xx][yy] += 0
+
+    def features(self, query):
+        '''
+        Return a GeoJSON FeatureCollection object of the crimes matching the
+        given query, sorted by time. If there are more than the query's limit
+        (default: DEFAULT_LIMIT), only the earliest are returned and the
+        collection's 'truncated' field is True.
+        '''
+
+        limit = query.limit if query.limit is not None else DEFAULT_LIMIT
+
+        matches = sorted(
+                self._matches(query), key=lambda match: match[1].times[match[2]])
+
+        features = []
+        for rn, m, i in matches[:limit]:
+            f = {
+                'type': 'Feature',
+                'geometry': None,
+                'properties': {
+                    'region': rn,
+                    'description': m.descriptions[i],
+                    'time': m.time_strings[i],
+                },
+            }
+            if m.codes[i] != _UNLOCATED:
+                f['geometry'] = {
+                    'type': 'Point',
+                    'coordinates': [m.lons[i], m.lats[i]],
+                }
+            if m.offenses[i] >= 0:
+                f['properties']['offense'] = m.offenses[i]
+
+            features += [f]
+
+        return {
+            'type': 'FeatureCollection',
+            'features': features,
+            'truncated': len(matches) > limit,
+        }
+
+    def counts(self, query):
+        '''
+        Return an object with the total number of crimes matching the given
+        query, and for each region, the number of them, the number on each
+        (local) day, and the number with each offense code.
+        '''
+
+        regions = defaultdict(lambda: {
+            'count': 0,
+            'days': defaultdict(int),
+            'offenses': defaultdict(int),
+        })
+
+        count = 0
+        for rn, m, i in self._matches(query):
+            count += 1
+
+            rc = regions[rn]
+            rc['count'] += 1
+            rc['days'][m.time_strings[i][:10]] += 1
+            if m.offenses[i] >= 0:
+                rc['offenses'][str(m.offenses[i])] += 1
+
+        return {
+            'count': count,
+            'regions': {
+                rn: {
+                    'count': rc['count'],
+                    'days': dict(sorted(rc['days'].items())),
+                    'offenses': dict(sorted(
+                        rc['offenses'].items(), key=lambda i: int(i[0]))),
+                }
+                    for rn, rc in sorted(regions.items())},
+        }
+
+
+class ResponseCache(object):
+    '''
+    An LRU cache of up to the given number of responses.
+    '''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def _lookup(self, key):
+        '''
+        Return the cached response for the given key, or None if there is
+        none. This is called with the lock held.
+        '''
+
+        if key not in self._entries:
+            return None
+
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def _store(self, key, response):
+        '''
+        Cache the given response, evicting others as needed. This is called
+        with the lock held.
+        '''
+
+        self._entries[key] = response
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, compute):
+        '''
+        Return the response for the given key, calling compute() to produce
+        it if it is not in the cache. If another thread is already computing
+        the response, wait for it rather than computing it again; exceptions
+        raised by compute() are raised in every waiting thread and nothing is
+        cached. Responses must not be None.
+        '''
+
+        with self._lock:
+            response = self._lookup(key)
+            if response is not None:
+                return response
+
+            future = self._pending.get(key)
+            if future is None:
+                future = concurrent.futures.Future()
+                self._pending[key] = future
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return future.result()
+
+        try:
+            response = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            self._store(key, response)
+
+        future.set_result(response)
+        return response
+
+    def clear(self):
+        '''
+        Remove all responses from the cache.
+        '''
+
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache(ResponseCache):
+    '''
+    A ResponseCache of bytes responses to string keys, which keeps up to the
+    given number of bytes of them in files in the given directory. Responses
+    in the directory from previous instances are re-used.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        super().__init__(None)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # {file name => size} of cached responses, least recently used
+        # first; file modification times record when each was last used so
+        # that this survives restarts
+        files = []
+        for fn in os.listdir(cache_dir):
+            if fn.startswith('.'):
+                continue
+
+            st = os.stat(os.path.join(cache_dir, fn))
+            files += [(st.st_mtime, fn, st.st_size)]
+
+        self._files = OrderedDict(
+                (fn, size) for _, fn, size in sorted(files))
+        self._size = sum(self._files.values())
+
+    def _path(self, key):
+        return os.path.join(
+                self.cache_dir,
+                hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _lookup(self, key):
+        path = self._path(key)
+        fn = os.path.basename(path)
+        if fn not in self._files:
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                response = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._size -= self._files.pop(fn)
+            return None
+
+        self._files.move_to_end(fn)
+        return response
+
+    def _store(self, key, response):
+        path = self._path(key)
+        fn = os.path.basename(path)
+
+        # Write to a hidden temporary file first so that a crash can't leave
+        # a partial response behind
+        with tempfile.NamedTemporaryFile(
+                dir=self.cache_dir, prefix='.', delete=False) as f:
+            f.write(response)
+        os.replace(f.name, path)
+
+        self._size += len(response) - self._files.pop(fn, 0)
+        self._files[fn] = len(response)
+
+        while self._size > self.max_bytes and self._files:
+            old_fn, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(os.path.join(self.cache_dir, old_fn))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for fn in self._files:
+                try:
+                    os.unlink(os.path.join(self.cache_dir, fn))
+                except FileNotFoundError:
+                    pass
+
+            self._files.clear()
+            self._size = 0
+
+
+class QueryTests(unittest.TestCase):
+    '''
+    Tests for CrimeIndex.
+    '''
+
+    def setUp(self):
+        self.crime_objs = [
+            {'description': 'crime {}'.format(i),
+             'time': '2014-01-{:02}T{:02}:00:00-0600'.format(
+                    1 + i % 28, i % 24),
+             'geo': {
+                'type': 'Point',
+                'coordinates': [-90.4 + (i % 17) * 0.02,
+                                38.5 + (i % 13) * 0.02]},
+             'offense': i % 3}
+                for i in range(500)] + \
+            [{'description': 'unlocated',
+              'time': '2014-01-01T00:00:00-0600',
+              'offense': 0}]
+
+        self.td = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.td.name, 'index.json'), 'wt') as f:
+            json.dump({'regions': ['stl']}, f)
+
+        os.makedirs(os.path.join(self.td.name, 'stl'))
+        with open(os.path.join(self.td.name, 'stl', 'index.json'), 'wt') as f:
+            json.dump({'files': ['2014-01.json']}, f)
+        with open(os.path.join(self.td.name, 'stl', '2014-01.json'), 'wt') as f:
+            json.dump({'crimes': self.crime_objs}, f)
+
+        self.index = CrimeIndex(self.td.name)
+        self.assertTrue(self.index.refresh())
+        self.assertFalse(self.index.refresh())
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def _expected(self, bbox=None, time_from=None, time_to=None,
+                  offenses=None):
+        expected = []
+        for co in self.crime_objs:
+            if bbox is not None:
+                if 'geo' not in co:
+                    continue
+
+                lon, lat = co['geo']['coordinates']
+                if not (bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]):
+                    continue
+
+            t = crimedb.timecodec.parse_epoch(co['time'])
+            if time_from is not None and t < time_from:
+                continue
+            if time_to is not None and t > time_to:
+                continue
+            if offenses is not None and co['offense'] not in offenses:
+                continue
+
+            expected += [co['description']]
+
+        return sorted(expected)
+
+    def test_morton_code(self):
+        '''
+        Verify that Morton codes are quadkeys.
+        '''
+
+        import crimedb.chunks
+
+        for x, y, z in [(3, 5, 3), (0, 0, 17), (131071, 1, 17),
+                        (33012, 50607, 17)]:
+            self.assertEqual(
+                    morton_code(x, y), int(crimedb.chunks.quadkey(x, y, z), 4))
+
+    def test_features(self):
+        '''
+        Verify that queries return the matching crimes.
+        '''
+
+        t0 = crimedb.timecodec.parse_epoch('2014-01-03T00:00:00-0600')
+        t1 = crimedb.timecodec.parse_epoch('2014-01-10T00:00:00-0600')
+        for bbox, time_from, time_to, offenses in [
+                (None, None, None, None),
+                ((-90.3, 38.55, -90.2, 38.6), None, None, None),
+                ((-90.35, 38.51, -90.1, 38.62), t0, t1, None),
+                ((-91, 38, -89, 39), t0, t1, {1}),
+                (None, t0, None, {0, 2}),
+                ((-90.3, 38.55, -90.3, 38.55), None, None, None),
+                ((-180, -90, 180, 90), None, None, None)]:
+            query = Query(
+                    regions=['stl'] if offenses else None, bbox=bbox,
+                    time_from=time_from, time_to=time_to, offenses=offenses)
+
+            fc = self.index.features(query)
+            self.assertFalse(fc['truncated'])
+            self.assertEqual(
+                    sorted(f['properties']['description']
+                        for f in fc['features']),
+                    self._expected(bbox, time_from, time_to, offenses))
+
+            self.assertEqual(
+                    self.index.counts(query)['count'],
+                    len(fc['features']))
+
+        fc = self.index.features(Query(limit=10))
+        self.assertTrue(fc['truncated'])
+        self.assertEqual(len(fc['features']), 10)
+        self.assertEqual(
+                [f['properties']['time'] for f in fc['features']],
+                sorted(f['properties']['time'] for f in fc['features']))
+
+        with self.assertRaises(ValueError):
+            self.index.features(Query(regions=['nowhere']))
+
+    def test_counts(self):
+        '''
+        Verify aggregate counts, including within a polygon.
+        '''
+
+        counts = self.index.counts(parse_query({
+            'region': 'stl',
+            'polygon': '-90.3,38.55,-90.2,38.55,-90.2,38.6,-90.3,38.6',
+            'from': '2014-01-01T00:00:00-0600',
+        }))
+
+        self.assertEqual(
+                counts['count'],
+                len(self._expected((-90.3, 38.55, -90.2, 38.6))))
+        stl = counts['regions']['stl']
+        self.assertEqual(sum(stl['days'].values()), counts['count'])
+        self.assertEqual(sum(stl['offenses'].values()), counts['count'])
+
+        with self.assertRaises(ValueError):
+            parse_query({'offense': '1'})
+        with self.assertRaises(ValueError):
+            parse_query({'bbox': '1,2,3'})
+        with self.assertRaises(ValueError):
+            parse_query({'where': 'here'})
+
+    def test_refresh(self):
+        '''
+        Verify that refresh() picks up changed month files.
+        '''
+
+        mp = os.path.join(self.td.name, 'stl', '2014-01.json')
+        with open(mp, 'wt') as f:
+            json.dump({'crimes': self.crime_objs[:5]}, f)
+        os.utime(mp, (0, 0))
+
+        version = self.index.version()
+        self.assertTrue(self.index.refresh())
+        self.assertEqual(self.index.counts(Query())['count'], 5)
+        self.assertNotEqual(self.index.version(), version)
+
+    def test_tile_cells(self):
+        '''
+        Verify that tiles computed on demand have the same cells as those
+        rendered from a grid of the matching crimes, plus empty cells within
+        the region's boundary.
+        '''
+
+        import crimedb.tiles
+
+        t0 = crimedb.timecodec.parse_epoch('2014-01-03T00:00:00-0600')
+        t1 = crimedb.timecodec.parse_epoch('2014-01-10T00:00:00-0600')
+        query = Query(time_from=t0, time_to=t1)
+
+        grid = crimedb.www.grid_from_crimes(
+                [co for co in self.crime_objs
+                    if 'geo' in co and
+                       t0 <= crimedb.timecodec.parse_epoch(co['time']) <= t1],
+                crimedb.www.GRID_BASE_ZOOM)
+        zgrid = crimedb.www.zgrid_from_grid(grid, crimedb.www.GRID_BASE_ZOOM, 0)
+        rzgrid = crimedb.www.rzgrid_from_zgrid(
+                zgrid, crimedb.www.GRID_CELL_ZOOM_DEPTH)
+
+        tiles = [(z, x, y)
+                    for z in [0, 6, 11, 14]
+                    for x, ys in rzgrid[z].items()
+                    for y in ys]
+        self.assertGreater(len(tiles), 20)
+
+        for z, x, y in tiles:
+            cells = self.index.tile_cells(query, z, x, y)
+            self.assertEqual(
+                    {(xx, yy, c)
+                        for xx, ycounts in cells.items()
+                        for yy, c in ycounts.items() if c},
+                    {(xx, yy, c)
+                        for xx, ycounts in rzgrid[z][x][y].items()
+                        for yy, c in ycounts.items()})
+            self.assertEqual(
+                    crimedb.tiles.encode_tile(
+                            {xx: {yy: c for yy, c in ycounts.items() if c}
+                                for xx, ycounts in cells.items()},
+                            z, x, y, 'binary'),
+                    crimedb.www.rzgrid_to_binary(
+                            rzgrid, x, y, z, crimedb.www.GRID_CELL_ZOOM_DEPTH))
+
+        # Cells beyond the base zoom level are computed from coordinates
+        z, x, y = tiles[-1]
+        deep_cells = self.index.tile_cells(
+                query, z + 3, x * 8, y * 8, zoom_depth=1)
+        self.assertLessEqual(
+                sum(sum(ycounts.values()) for ycounts in deep_cells.values()),
+                sum(sum(ycounts.values())
+                    for ycounts in rzgrid[z][x][y].values()))
+
+        # The city of St. Louis is fully contained by this tile, so it has
+        # empty cells
+        cells = self.index.tile_cells(query, 9, 127, 196)
+        self.assertIn(0, [c for ycounts in cells.values()
+                            for c in ycounts.values()])
+
+        with self.assertRaises(ValueError):
+            self.index.tile_cells(query, 18, 0, 0)
+        with self.assertRaises(ValueError):
+            self.index.tile_cells(query, 1, 2, 0)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    '''
+    Tests for ResponseCache.
+    '''
+
+    def test_lru(self):
+        '''
+        Verify that the least recently used responses are evicted.
+        '''
+
+        rc = ResponseCache(2)
+        rc.get('a', lambda: 1)
+        rc.get('b', lambda: 2)
+        rc.get('a', lambda: None)
+        rc.get('c', lambda: 3)
+        self.assertEqual(rc.get('a', lambda: None), 1)
+        self.assertEqual(rc.get('b', lambda: None), None)
+
+    def test_coalescing(self):
+        '''
+        Verify that concurrent requests for the same response compute it only
+        once, and that failures are not cached.
+        '''
+
+        rc = ResponseCache(10)
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'response'
+
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            first = pool.submit(rc.get, 'k', compute)
+            started.wait()
+            rest = [pool.submit(rc.get, 'k', compute) for _ in range(7)]
+
+            # Give the other threads a chance to start waiting
+            time.sleep(0.1)
+            release.set()
+
+            self.assertEqual(
+                    [f.result() for f in [first] + rest], ['response'] * 8)
+
+        self.assertEqual(len(calls), 1)
+
+        def fail():
+            raise ValueError('oops')
+
+        with self.assertRaises(ValueError):
+            rc.get('f', fail)
+        self.assertEqual(rc.get('f', lambda: 'ok'), 'ok')
+
+
+class DiskCacheTests(unittest.TestCase):
+    '''
+    Tests for DiskCache.
+    '''
+
+    def test_disk_cache(self):
+        '''
+        Verify that the least recently used responses are evicted to keep the
+        cache under its size, and that responses survive re-opening it.
+        '''
+
+        with tempfile.TemporaryDirectory() as td:
+            dc = DiskCache(td, 10)
+            self.assertEqual(dc.get('a', lambda: b'1234'), b'1234')
+            self.assertEqual(dc.get('b', lambda: b'5678'), b'5678')
+            self.assertEqual(dc.get('a', lambda: None), b'1234')
+            self.assertEqual(dc.get('c', lambda: b'90'), b'90')
+            self.assertEqual(dc.get('e', lambda: b''), b'')
+            self.assertEqual(len(os.listdir(td)), 4)
+
+            # Exceeding the size evicts the least recently used response
+            dc.get('d', lambda: b'x')
+            self.assertEqual(dc.get('b', lambda: b'new'), b'new')
+            self.assertEqual(
+                    sorted(os.path.getsize(os.path.join(td, fn))
+                        for fn in os.listdir(td)),
+                    [0, 1, 2, 3, 4])
+
+            dc = DiskCache(td, 10)
+            self.assertEqual(dc.get('b', lambda: None), b'new')
+            self.assertEqual(dc.get('d', lambda: None), b'x')
+
+            dc.clear()
+            self.assertEqual(os.listdir(td), [])
@@ -0,0 +1,632 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Segmented, compressed logs of raw records downloaded from a region's source.
+
+A log is a directory of segments, each holding up to about SEGMENT_SIZE bytes
+of records as compressed JSON lines, alongside a compressed list of the ID of
+each record in it so that the IDs of everything in the log can be read
+without decoding every record. The index.json file lists the segments in
+order, with the codec, number of records and range of record IDs and times
+(in epoch seconds) of each.
+
+The index is the only source of truth: segments are written to temporary
+files and renamed into place before the index is atomically replaced to
+include them, and anything in the directory that the index doesn't mention
+is left over from an interrupted write and is removed. Readers therefore
+always see whole segments, and can stream the log or process its segments
+independently (e.g. in parallel) by calling read_segment() on each entry of
+segments().
+
+Writers hold an exclusive flock() on the lock file in the directory, so only
+one process writes a log at a time, and leftover files are only removed while
+no one is writing.
+
+Segments are compressed with zstd if the zstandard module is available, or
+gzip otherwise.
+'''
+
+import crimedb.output
+import fcntl
+import gzip
+import io
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+import unittest
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# Approximate number of uncompressed bytes of records in each segment
+SEGMENT_SIZE = 64 * 2 ** 20
+
+# Least number of seconds between commits of records appended by writers that
+# checkpoint; see _RawLogWriter.checkpoint()
+CHECKPOINT_INTERVAL = 30
+
+# Version of the index format written by RawLog
+_INDEX_VERSION = 1
+
+# Name of the file in each log directory that writers lock
+_LOCK_FILE_NAME = 'lock'
+
+
+def _gzip_open(path, mode):
+    return gzip.open(path, mode, compresslevel=6)
+
+
+def _zstd_open(path, mode):
+    f = zstandard.open(path, mode)
+
+    # Decompression readers can't be read line by line themselves
+    if mode == 'rb':
+        f = io.BufferedReader(f)
+
+    return f
+
+
+# Map of codec names to (file extension, open function) tuples. Open functions
+# take a path and a binary mode ('rb' or 'wb') and return a file object.
+CODECS = {
+    'gzip': ('.gz', _gzip_open),
+}
+if zstandard:
+    CODECS['zstd'] = ('.zst', _zstd_open)
+
+# Codec with which new segments are written
+DEFAULT_CODEC = 'zstd' if 'zstd' in CODECS else 'gzip'
+
+
+def _segment_entry(name, codec):
+    return {
+        'name': name,
+        'codec': codec,
+        'count': 0,
+        'bytes': 0,
+        'id_min': None,
+        'id_max': None,
+        'time_min': None,
+        'time_max': None,
+    }
+
+
+def _segment_paths(log_dir, entry):
+    '''
+    Return a (records path, IDs path) tuple for the given segment.
+    '''
+
+    ext = CODECS[entry['codec']][0]
+    return (
+        os.path.join(log_dir, '{}.jsonl{}'.format(entry['name'], ext)),
+        os.path.join(log_dir, '{}.ids{}'.format(entry['name'], ext)))
+
+
+def read_segment(log_dir, entry):
+    '''
+    Return a generator of the records in the given segment of the log in the
+    given directory, as listed by RawLog.segments().
+    '''
+
+    rp, _ = _segment_paths(log_dir, entry)
+    with CODECS[entry['codec']][1](rp, 'rb') as f:
+        for l in f:
+            yield json.loads(l.decode('utf-8'))
+
+
+def read_segment_ids(log_dir, entry):
+    '''
+    Return a list of the IDs of the records in the given segment of the log in
+    the given directory, in the same order as the records themselves.
+    '''
+
+    _, ip = _segment_paths(log_dir, entry)
+    with CODECS[entry['codec']][1](ip, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+class RawLog(object):
+    '''
+    A log of raw records in the given directory, created if necessary. Each
+    record is a JSON object; the given key function returns its ID, and the
+    given time function returns its time in epoch seconds, or None if it
+    doesn't have one.
+
+    The log may be read while it's being written, though readers only see the
+    segments committed when they started, or, in other processes, when they
+    opened the log. Writers wait for any writer in another process (or using
+    another RawLog for the same directory) to finish first.
+    '''
+
+    def __init__(self, log_dir, key, time=lambda record: None,
+                 segment_size=SEGMENT_SIZE, codec=DEFAULT_CODEC):
+        self.log_dir = log_dir
+        self.key = key
+        self.time = time
+        self.segment_size = segment_size
+        self.codec = codec
+
+        os.makedirs(log_dir, exist_ok=True)
+
+        self._load_index()
+
+        # Leave the files of a write in progress alone
+        lock = self._lock(blocking=False)
+        if lock is not None:
+            with lock:
+                self._remove_unindexed()
+
+    def _index_path(self):
+        return os.path.join(self.log_dir, 'index.json')
+
+    def _load_index(self):
+        self._index = {'version': _INDEX_VERSION, 'next': 0, 'segments': []}
+        ip = self._index_path()
+        if os.path.isfile(ip):
+            with open(ip, 'rt', encoding='utf-8') as f:
+                self._index = json.load(f)
+
+    def _lock(self, blocking=True):
+        '''
+        Return the lock file, opened and exclusively locked; the lock is
+        released when it's closed. If blocking is False and someone else holds
+        the lock, return None rather than waiting for it.
+        '''
+
+        f = open(os.path.join(self.log_dir, _LOCK_FILE_NAME), 'ab')
+        try:
+            fcntl.flock(
+                    f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            f.close()
+            return None
+        except:
+            f.close()
+            raise
+
+        return f
+
+    def _remove_unindexed(self):
+        '''
+        Remove files left behind by interrupted writes. The caller must hold
+        the lock.
+        '''
+
+        keep = {'index.json', _LOCK_FILE_NAME}
+        for entry in self._index['segments']:
+            keep.update(
+                    os.path.basename(p)
+                        for p in _segment_paths(self.log_dir, entry))
+
+        for fn in os.listdir(self.log_dir):
+            if fn not in keep:
+                _LOGGER.debug('removing unindexed file {}'.format(fn))
+                os.unlink(os.path.join(self.log_dir, fn))
+
+    def segments(self):
+        '''
+        Return a list of index entries for the segments in the log, oldest
+        first. Each is a dictionary with the segment's 'name', 'codec', the
+        'count' and uncompressed 'bytes' of records in it, and the 'id_min',
+        'id_max', 'time_min' and 'time_max' of those records.
+        '''
+
+        return list(self._index['segments'])
+
+    def __len__(self):
+        return sum(e['count'] for e in self._index['segments'])
+
+    def records(self):
+        '''
+        Return an iterator of all records in the log, in the order in which
+        they were appended, as of when this is called.
+        '''
+
+        segments = self.segments()
+        return (r for entry in segments
+                    for r in read_segment(self.log_dir, entry))
+
+    def ids(self):
+        '''
+        Return a set of the IDs of all records in the log.
+        '''
+
+        ids = set()
+        for entry in self.segments():
+            ids.update(read_segment_ids(self.log_dir, entry))
+
+        return ids
+
+    def writer(self, checkpoint_interval=None, clock=time.monotonic):
+        '''
+        Return a context manager for appending records to the log. Records
+        appended are visible to readers once each segment is full, once the
+        writer checkpoints (by default, at most every CHECKPOINT_INTERVAL
+        seconds), and once the writer is closed. If the body of the with
+        statement raises an exception, records not yet committed in one of
+        these ways are discarded.
+        '''
+
+        if checkpoint_interval is None:
+            checkpoint_interval = CHECKPOINT_INTERVAL
+
+        return _RawLogWriter(self, checkpoint_interval, clock)
+
+    def _commit(self, replaced, entry):
+        '''
+        Atomically add the given, already written, segment to the index,
+        replacing the one named by the given entry if it isn't None.
+
+        The files of the replaced segment are left alone in case anything is
+        still reading them; they're removed the next time that the log is
+        opened.
+        '''
+
+        segments = list(self._index['segments'])
+        if replaced is not None:
+            assert segments[-1]['name'] == replaced['name']
+            segments.pop()
+        segments.append(entry)
+
+        index = dict(self._index, segments=segments)
+        crimedb.output.replace_file(
+                self._index_path(), json.dumps(index).encode('utf-8'))
+        self._index = index
+
+
+class _RawLogWriter(object):
+    '''
+    Appends records to a RawLog, rolling over to a new segment whenever the
+    current one is full.
+
+    Rather than leaving a small segment behind every time that the log is
+    appended to or checkpointed, a writer starts by copying the records of the
+    last segment, if it isn't full, into the segment that it's writing, which
+    replaces that segment when committed. It does the same after each
+    checkpoint.
+    '''
+
+    def __init__(self, log, checkpoint_interval, clock):
+        self.log = log
+        self.checkpoint_interval = checkpoint_interval
+        self.clock = clock
+        self._files = None
+        self._last_commit = clock()
+
+    def __enter__(self):
+        self._lock = self.log._lock()
+        try:
+            # Pick up whatever other processes have committed
+            self.log._load_index()
+
+            tail = self.log.segments()[-1:]
+            self._refill(tail[0] if tail else None)
+        except:
+            self._lock.close()
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            # Leave the log alone if nothing was appended to it
+            if exc_type is None and self._entry['count'] > self._copied:
+                self._roll(reopen=False)
+            else:
+                self._discard()
+        finally:
+            self._lock.close()
+
+    def _refill(self, last):
+        '''
+        Start a new segment, copying the records of the given last segment of
+        the log into it if that segment isn't full.
+        '''
+
+        if last is None or last['bytes'] >= self.log.segment_size:
+            self._open(None)
+            return
+
+        self._open(last)
+        for r in read_segment(self.log.log_dir, last):
+            self.append(r)
+        self._copied = self._entry['count']
+
+    def _open(self, replaces):
+        index = self.log._index
+        self._replaces = replaces
+        self._entry = _segment_entry(
+                '{:08d}'.format(index['next']), self.log.codec)
+        index['next'] += 1
+
+        self._ids = []
+        self._copied = 0
+        self._paths = _segment_paths(self.log.log_dir, self._entry)
+        fd, self._tmp_path = tempfile.mkstemp(
+                dir=self.log.log_dir, prefix='.', suffix='.tmp')
+        os.close(fd)
+        self._file = CODECS[self.log.codec][1](self._tmp_path, 'wb')
+
+    def append(self, record):
+        '''
+        Append the given record to the log.
+        '''
+
+        data = (json.dumps(record) + '\n').encode('utf-8')
+        self._file.write(data)
+
+        e = self._entry
+        rid = self.log.key(record)
+        rt = self.log.time(record)
+        self._ids.append(rid)
+        e['count'] += 1
+        e['bytes'] += len(data)
+        if e['id_min'] is None or rid < e['id_min']:
+            e['id_min'] = rid
+        if e['id_max'] is None or rid > e['id_max']:
+            e['id_max'] = rid
+        if rt is not None:
+            if e['time_min'] is None or rt < e['time_min']:
+                e['time_min'] = rt
+            if e['time_max'] is None or rt > e['time_max']:
+                e['time_max'] = rt
+
+        if e['bytes'] >= self.log.segment_size:
+            self._roll(reopen=True)
+
+    def checkpoint(self):
+        '''
+        Commit the records appended so far if it's been at least
+        checkpoint_interval seconds since they were last committed, so that
+        they survive the writer failing later on.
+
+        Downloads call this as they go, e.g. after each page of records, so
+        that an interrupted download keeps what it fetched. The interval
+        bounds how much can be lost, and how often the partial segment being
+        written is copied again to carry on filling it after each commit.
+        '''
+
+        if self._entry['count'] > self._copied and \
+                self.clock() - self._last_commit >= self.checkpoint_interval:
+            committed = self._entry
+            self._roll(reopen=False)
+            self._refill(committed)
+
+    def _roll(self, reopen):
+        '''
+        Commit the segment being written, if it has any records, and start a
+        new one if requested.
+        '''
+
+        self._file.close()
+
+        if self._entry['count']:
+            rp, ip = self._paths
+            with CODECS[self.log.codec][1](ip, 'wb') as f:
+                f.write(json.dumps(self._ids).encode('utf-8'))
+            os.replace(self._tmp_path, rp)
+            self.log._commit(self._replaces, self._entry)
+            self._last_commit = self.clock()
+        else:
+            os.unlink(self._tmp_path)
+
+        if reopen:
+            self._open(None)
+
+    def _discard(self):
+        self._file.close()
+        os.unlink(self._tmp_path)
+
+
+def import_lines(log, path):
+    '''
+    Append the records in the given file of JSON lines, as written by earlier
+    versions of the region modules, to the given log. Records whose IDs are
+    already in the log are skipped.
+    '''
+
+    ids = log.ids()
+    with log.writer() as w, open(path, 'rt', encoding='utf-8') as f:
+        for l in f:
+            record = json.loads(l)
+            rid = log.key(record)
+            if rid in ids:
+                continue
+
+            ids.add(rid)
+            w.append(record)
+
+
+class RawLogTests(unittest.TestCase):
+    '''
+    Tests for RawLog, using the gzip codec; subclasses test other codecs.
+    '''
+
+    codec = 'gzip'
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.log_dir = os.path.join(self.td.name, 'incidents')
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def _log(self):
+        return RawLog(
+                self.log_dir, key=lambda r: r['id'], time=lambda r: r.get('t'),
+                segment_size=1000, codec=self.codec)
+
+    def test_append(self):
+        '''
+        Verify that records are split into indexed segments, that appending
+        fills up the last segment rather than starting a new one, and that
+        the log reads back the records in order.
+        '''
+
+        records = [{'id': 'r{:04d}'.format(i), 't': i * 10, 'pad': 'x' * 40}
+                        for i in range(100)]
+
+        log = self._log()
+        with log.writer() as w:
+            for r in records[:60]:
+                w.append(r)
+
+        segments = log.segments()
+        self.assertEqual(sum(e['count'] for e in segments), 60)
+        self.assertGreater(len(segments), 2)
+        self.assertLess(segments[-1]['bytes'], 1000)
+        self.assertEqual(segments[0]['id_min'], 'r0000')
+        self.assertEqual(segments[0]['time_min'], 0)
+
+        log = self._log()
+        with log.writer() as w:
+            for r in records[60:]:
+                w.append(r)
+
+        self.assertEqual(list(log.records()), records)
+        self.assertEqual(log.ids(), {r['id'] for r in records})
+        self.assertEqual(len(log), 100)
+        self.assertTrue(all(
+                e['bytes'] >= 1000 for e in log.segments()[:-1]))
+        for e in log.segments():
+            self.assertEqual(
+                    [r['id'] for r in read_segment(self.log_dir, e)],
+                    read_segment_ids(self.log_dir, e))
+
+        # Writers that don't append anything leave the log alone
+        segments = log.segments()
+        with log.writer():
+            pass
+        self.assertEqual(log.segments(), segments)
+
+        # Only the files of indexed segments are left
+        log = self._log()
+        self.assertEqual(
+                len(os.listdir(self.log_dir)), 2 * len(log.segments()) + 2)
+
+    def test_interrupted(self):
+        '''
+        Verify that failed writes leave the log as it was, and that files left
+        over from them are cleaned up.
+        '''
+
+        log = self._log()
+        with log.writer() as w:
+            w.append({'id': 'a'})
+
+        with self.assertRaises(RuntimeError):
+            with log.writer() as w:
+                w.append({'id': 'b'})
+                raise RuntimeError()
+
+        with open(os.path.join(self.log_dir, '99999999.jsonl{}'.format(
+                CODECS[self.codec][0])), 'wb'):
+            pass
+
+        log = self._log()
+        self.assertEqual(list(log.records()), [{'id': 'a'}])
+        self.assertEqual(
+                len(os.listdir(self.log_dir)), 2 * len(log.segments()) + 2)
+
+    def test_checkpoint(self):
+        '''
+        Verify that checkpoints commit records appended so far, but no more
+        often than the checkpoint interval.
+        '''
+
+        now = [0]
+        log = self._log()
+        with self.assertRaises(RuntimeError):
+            with log.writer(checkpoint_interval=10,
+                            clock=lambda: now[0]) as w:
+                w.append({'id': 'a'})
+                w.checkpoint()
+                self.assertEqual(len(log), 0)
+
+                now[0] += 10
+                w.checkpoint()
+                self.assertEqual(len(log), 1)
+
+                w.append({'id': 'b'})
+                now[0] += 5
+                w.checkpoint()
+                w.append({'id': 'c'})
+                now[0] += 5
+                w.checkpoint()
+                w.append({'id': 'd'})
+                raise RuntimeError()
+
+        log = self._log()
+        self.assertEqual(
+                [r['id'] for r in log.records()], ['a', 'b', 'c'])
+
+        # Checkpoints carry on filling the partial segment rather than
+        # leaving it behind
+        self.assertEqual(len(log.segments()), 1)
+        self.assertEqual(
+                len(os.listdir(self.log_dir)), 2 * len(log.segments()) + 2)
+
+    def test_concurrent(self):
+        '''
+        Verify that opening a log leaves the files of a write in progress
+        alone, and that writers pick up what other writers have committed.
+        '''
+
+        log = self._log()
+        with log.writer() as w:
+            w.append({'id': 'a'})
+            files = set(os.listdir(self.log_dir))
+
+            other = self._log()
+            self.assertEqual(set(os.listdir(self.log_dir)), files)
+
+        with other.writer() as w:
+            w.append({'id': 'b'})
+
+        self.assertEqual([r['id'] for r in other.records()], ['a', 'b'])
+        self.assertEqual(len(other.segments()), 1)
+
+    def test_import_lines(self):
+        '''
+        Verify that importing a file of JSON lines skips records that are
+        already in the log.
+        '''
+
+        lp = os.path.join(self.td.name, 'incidents.jsonl')
+        with open(lp, 'wt', encoding='utf-8') as f:
+            for rid in ['a', 'b', 'a', 'c']:
+                f.write(json.dumps({'id': rid}) + '\n')
+
+        log = self._log()
+        import_lines(log, lp)
+        import_lines(log, lp)
+        self.assertEqual(
+                [r['id'] for r in log.records()], ['a', 'b', 'c'])
+
+
+@unittest.skipUnless(zstandard, 'zstandard module not available')
+class ZstdRawLogTests(RawLogTests):
+    '''
+    Tests for RawLog, using the zstd codec.
+    '''
+
+    codec = 'zstd'
@@ -0,0 +1,74 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Registry of region implementations.
+
+Regions are registered by name and module, each module defining a Region
+class. Modules are only imported when a region is actually used, since they
+pull in heavyweight dependencies (pyproj, Shapely, lxml, etc.) that most
+invocations of our scripts don't need, or need for only a single region.
+'''
+
+import importlib
+import unittest
+
+# Map of region names to the modules implementing them
+REGION_MODULES = {
+    'dallas': 'crimedb.regions.dallas',
+    'stl': 'crimedb.regions.stl',
+    'stlco': 'crimedb.regions.stlco',
+}
+
+
+def region_names():
+    '''
+    Return a sorted list of the names of all known regions.
+    '''
+
+    return sorted(REGION_MODULES.keys())
+
+
+def region_class(name):
+    '''
+    Return the Region class for the region with the given name, importing its
+    module if necessary. Raises KeyError for unknown regions.
+    '''
+
+    return importlib.import_module(REGION_MODULES[name]).Region
+
+
+def region(name, *args, **kwargs):
+    '''
+    Return a new Region object for the region with the given name, passing
+    any other arguments to its constructor.
+    '''
+
+    return region_class(name)(*args, **kwargs)
+
+
+class RegionRegistryTests(unittest.TestCase):
+    '''
+    Tests for the region registry.
+    '''
+
+    def test_regions(self):
+        '''
+        Verify that every registered region can be resolved by name.
+        '''
+
+        for rn in region_names():
+            self.assertEqual(region(rn).name, rn)
+
+        self.assertRaises(KeyError, region_class, 'nowhere')
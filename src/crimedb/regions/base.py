@@ -14,15 +14,90 @@
 
 '''
 Base class for region implementations.
+
+Regions process their downloaded data into intermediate files of crimes, one
+per (local) month in which the crimes occurred, named YYYY-MM. The time range
+and bounding box of the crimes in each file are recorded alongside them, so
+that crimes() can skip files that can't contain crimes of interest.
 '''
 
+import crimedb.core
 import crimedb.geocoding
-import io
+import crimedb.rawlog
+import crimedb.regions.boundary
+import crimedb.timecodec
+import datetime
 import json
 import os
 import os.path
-import pkg_resources
-import shapely.geometry
+import shutil
+import tempfile
+import unittest
+
+# Name of the intermediate file for crimes without a time
+_UNKNOWN_PARTITION = 'UNKNOWN'
+
+# Name of the file in the intermediate directory recording the extent of each
+# intermediate file
+_EXTENTS_FILE = '.extents.json'
+
+# Prefix of the time field in each line of an intermediate file, as written by
+# json.dumps(); JSON escaping means that this can't appear anywhere else
+_TIME_PREFIX = '"time": "'
+
+
+def _partition_time_range(name):
+    '''
+    Return a (min, max) tuple of epoch seconds bounding the times of crimes in
+    the intermediate file of the given name, based on the month in its name,
+    or None if the name isn't that of a month. Older intermediate files were
+    named YY-MM.
+    '''
+
+    for fmt in ['%Y-%m', '%y-%m']:
+        try:
+            month = datetime.datetime.strptime(name, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        return None
+
+    # Crimes are partitioned by their local month, so allow a day either side
+    # of the month in UTC
+    next_month = (month + datetime.timedelta(days=32)).replace(day=1)
+    utc = datetime.timezone.utc
+    return (
+        (month.replace(tzinfo=utc) - datetime.timedelta(days=1)).timestamp(),
+        (next_month.replace(tzinfo=utc) +
+            datetime.timedelta(days=1)).timestamp())
+
+
+def _line_time(line):
+    '''
+    Return the time of the crime on the given line of an intermediate file in
+    epoch seconds, without decoding the rest of it, or None if it can't be
+    found.
+    '''
+
+    start = line.find(_TIME_PREFIX)
+    if start < 0:
+        return None
+
+    start += len(_TIME_PREFIX)
+    end = line.find('"', start)
+    if end < 0:
+        return None
+
+    try:
+        return crimedb.timecodec.parse_epoch(line[start:end])
+    except ValueError:
+        return None
+
+
+def _in_bbox(location, bbox):
+    minx, miny, maxx, maxy = bbox
+    return minx <= location[0] <= maxx and miny <= location[1] <= maxy
 
 
 class Region(object):
@@ -31,19 +106,35 @@ class Region(object):
 
     Provides support for common operations and provides a common API for use in
     other code.
+
+    Regions whose sources can be downloaded one record at a time should set
+    streams_records and implement fetch(), raw_records() and record_crime()
+    rather than download() and process(); this lets crimedb.pipeline process
+    records as they're downloaded.
     '''
 
+    # Whether this region implements fetch(), raw_records() and record_crime()
+    streams_records = False
+
     def __init__(self, name, work_dir=None, shape=None, geocoder=None):
         self.name = name
         self.work_dir = work_dir
 
-        if shape is None:
-            pkg = 'crimedb.regions.__data__'
-            rsrc = '{}.geojson'.format(name)
-            with pkg_resources.resource_stream(pkg, rsrc) as f:
-                tf = io.TextIOWrapper(f, encoding='utf-8', errors='replace')
-                shape = shapely.geometry.shape(json.load(tf))
-        self.shape = shape
+        # Unless a shape is given, our boundary is only loaded when needed
+        self._shape = shape
+
+        # Extents of the intermediate files written by this process() call,
+        # or None if they're unknown
+        self._extents = {}
+
+        # Names of the intermediate files written to by this process() call
+        self._written = set()
+
+        # Directory to which intermediate files are being staged, if any
+        self._staging_dir = None
+
+        # Raw logs opened by _raw_log(), by name
+        self._raw_logs = {}
 
         if geocoder is None:
             geocoder = crimedb.geocoding.geocode_null
@@ -52,6 +143,35 @@ class Region(object):
         self.human_name = None
         self.human_url = None
 
+    @property
+    def boundary(self):
+        '''
+        The crimedb.regions.boundary.Boundary of this region.
+        '''
+
+        return crimedb.regions.boundary.boundary(self.name)
+
+    @property
+    def shape(self):
+        '''
+        The Shapely object for the boundary of this region.
+        '''
+
+        if self._shape is not None:
+            return self._shape
+
+        return self.boundary.shape
+
+    def contains(self, geom):
+        '''
+        Return whether this region contains the given Shapely object.
+        '''
+
+        if self._shape is not None:
+            return self._shape.contains(geom)
+
+        return self.boundary.contains(geom)
+
     def download(self):
         '''
         Download any new crime incidents.
@@ -61,7 +181,9 @@ class Region(object):
         have faster/slower access methods).
         '''
 
-        pass
+        if self.streams_records:
+            for _ in self.fetch():
+                pass
 
     def process(self):
         '''
@@ -76,14 +198,178 @@ class Region(object):
         complete previously.
         '''
 
-        pass
+        if not self.streams_records:
+            return
+
+        # Since we are just blindly appending all incidents to the data
+        # files (even if we've seen then before), clean everything up
+        # before processing so that we don't have duplicates.
+        self._clear_intermediate()
+
+        for record in self.raw_records():
+            crime = self.record_crime(record)
+            if crime is not None:
+                self._write_intermediate(crime)
+
+        self._finish_intermediate()
 
-    def crimes(self):
+    def update(self):
+        '''
+        Download any new crime incidents and add them to the intermediate
+        files written by an earlier process() call, without processing those
+        already downloaded again. Return the first month (as a
+        datetime.datetime) of any new crimes with a time, or None if there
+        aren't any.
+
+        If this fails, the intermediate files may be missing crimes or have
+        duplicates, so call process() to rebuild them.
+
+        Regions that don't stream their records process everything again if
+        anything new was downloaded, unless they override this.
+        '''
+
+        if not self.streams_records:
+            state = self.raw_state()
+            self.download()
+            if self.raw_state() == state:
+                return None
+
+            self.process()
+            return self._first_written_month()
+
+        self._append_intermediate()
+
+        records = self.fetch()
+        try:
+            for record in records:
+                crime = self.record_crime(record)
+                if crime is not None:
+                    self._write_intermediate(crime)
+        finally:
+            records.close()
+
+        self._finish_intermediate()
+        return self._first_written_month()
+
+    def fetch(self):
+        '''
+        Return an iterator of the raw records of any new crime incidents,
+        downloading them as it goes. Each record is saved to the raw cache as
+        it's yielded; if the iterator is closed before it's exhausted, those
+        not yet committed to the cache may be lost, but will be downloaded
+        again next time.
+        '''
+
+        raise NotImplementedError()
+
+    def raw_records(self):
+        '''
+        Return an iterator of all raw records already downloaded, as of when
+        this is called.
+        '''
+
+        raise NotImplementedError()
+
+    def record_crime(self, record):
+        '''
+        Return the crimedb.core.Crime for the given raw record, or None if it
+        should be skipped. This may be called from any thread.
+        '''
+
+        raise NotImplementedError()
+
+    def raw_state(self):
+        '''
+        Return a value that changes whenever the downloaded data does, e.g. to
+        tell whether download() found anything new.
+        '''
+
+        cache_dir = self._cache_dir()
+        state = []
+        for dp, dnames, fnames in os.walk(cache_dir):
+            dnames.sort()
+            for fn in sorted(fnames):
+                st = os.stat(os.path.join(dp, fn))
+                state.append((
+                    os.path.relpath(os.path.join(dp, fn), cache_dir),
+                    st.st_size, st.st_mtime_ns))
+
+        return state
+
+    def crimes(self, time_from=None, time_to=None, bbox=None):
         '''
         Iterator that yields crimedb.core.Crime objects.
+
+        If given, only crimes that occurred within the (inclusive) range
+        [time_from, time_to] of datetime.datetime objects, or whose location
+        is within the (minx, miny, maxx, maxy) bounding box, are yielded;
+        crimes without a time or location never match these. Intermediate
+        files that can't contain matching crimes aren't read, and crimes
+        outside of the time range aren't decoded.
+        '''
+
+        ts_from = time_from.timestamp() if time_from else float('-inf')
+        ts_to = time_to.timestamp() if time_to else float('inf')
+        time_filter = time_from is not None or time_to is not None
+
+        int_dir = self._intermediate_dir()
+        extents = self._read_intermediate_extents()
+        for file_name in sorted(os.listdir(int_dir)):
+            if file_name.startswith('.'):
+                continue
+
+            if not self._intermediate_may_match(
+                    file_name, extents.get(file_name),
+                    time_filter, ts_from, ts_to, bbox):
+                continue
+
+            fp = os.path.join(int_dir, file_name)
+            with open(fp, 'rt', encoding='utf-8', errors='replace') as rf:
+                for l in rf:
+                    if time_filter:
+                        lt = _line_time(l)
+                        if lt is not None and not ts_from <= lt <= ts_to:
+                            continue
+
+                    c = crimedb.core.json_obj2crime(json.loads(l.strip()))
+                    if time_filter and (c.time is None or
+                            not ts_from <= c.time.timestamp() <= ts_to):
+                        continue
+
+                    if bbox and (c.location is None or
+                            not _in_bbox(c.location, bbox)):
+                        continue
+
+                    yield c
+
+    def _intermediate_may_match(self, file_name, extent, time_filter,
+                                ts_from, ts_to, bbox):
+        '''
+        Return whether the given intermediate file, with the given extent (if
+        known), can contain crimes matching the given filters.
         '''
 
-        pass
+        if time_filter:
+            if extent is not None:
+                if extent['time_min'] is None or \
+                        extent['time_max'] < ts_from or \
+                        extent['time_min'] > ts_to:
+                    return False
+            else:
+                tr = _partition_time_range(file_name)
+                if tr is not None and (tr[1] < ts_from or tr[0] > ts_to):
+                    return False
+
+        if bbox and extent is not None:
+            if extent['bbox'] is None:
+                return False
+
+            minx, miny, maxx, maxy = extent['bbox']
+            if maxx < bbox[0] or maxy < bbox[1] or \
+                    minx > bbox[2] or miny > bbox[3]:
+                return False
+
+        return True
 
     def _cache_dir(self):
         '''
@@ -96,6 +382,38 @@ class Region(object):
 
         return cache_dir
 
+    def _raw_log(self, name, key, time=lambda record: None):
+        '''
+        Return the crimedb.rawlog.RawLog of the given name in the cache
+        directory, with the given key and time functions.
+
+        Earlier versions of this code kept raw records in a single file of
+        JSON lines with the same name; if one exists, it's imported into the
+        log and removed.
+
+        The log is only opened once, so that it can be read while being
+        written to (see crimedb.rawlog.RawLog).
+        '''
+
+        if name in self._raw_logs:
+            return self._raw_logs[name]
+
+        path = os.path.join(self._cache_dir(), name)
+        lines_path = path + '.jsonl'
+        if os.path.isfile(path):
+            os.replace(path, lines_path)
+
+        log = crimedb.rawlog.RawLog(path, key, time)
+
+        # Importing skips records already in the log, so if we were
+        # interrupted doing this last time, we can just start over
+        if os.path.isfile(lines_path):
+            crimedb.rawlog.import_lines(log, lines_path)
+            os.unlink(lines_path)
+
+        self._raw_logs[name] = log
+        return log
+
     def _intermediate_dir(self):
         '''
         Return the directory to be used for storing intermediate files. Creates
@@ -103,6 +421,274 @@ class Region(object):
         '''
 
         int_dir = os.path.join(self.work_dir, 'intermediate')
+
+        # Finish replacing the directory with staged files if we were
+        # interrupted in the middle of doing so
+        old_dir = int_dir + '.old'
+        if not os.path.isdir(int_dir) and os.path.isdir(old_dir):
+            os.replace(old_dir, int_dir)
+
         os.makedirs(int_dir, exist_ok=True)
 
         return int_dir
+
+    def _intermediate_write_dir(self):
+        '''
+        Return the directory to which intermediate files are being written.
+        '''
+
+        return self._staging_dir or self._intermediate_dir()
+
+    def _clear_intermediate(self, staged=False):
+        '''
+        Remove all intermediate files, before re-processing.
+
+        If staged is set, the existing files are left in place until
+        _finish_intermediate() replaces them with those written since, so that
+        readers never see a partial set of files, even if processing fails.
+        Call _discard_intermediate() if it does.
+        '''
+
+        if staged:
+            self._staging_dir = os.path.join(self.work_dir, 'intermediate.new')
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            os.makedirs(self._staging_dir)
+        else:
+            self._staging_dir = None
+            shutil.rmtree(self._intermediate_dir())
+
+        self._extents = {}
+        self._written = set()
+
+    def _append_intermediate(self):
+        '''
+        Prepare to add crimes to the existing intermediate files, rather than
+        clearing them first.
+        '''
+
+        self._staging_dir = None
+        self._written = set()
+
+        # Files that we append to won't match their recorded extents until
+        # we're finished, so readers shouldn't rely on them until then
+        ep = os.path.join(self._intermediate_dir(), _EXTENTS_FILE)
+        if os.path.isfile(ep):
+            with open(ep, 'rt', encoding='utf-8') as ef:
+                self._extents = json.load(ef)
+            os.unlink(ep)
+        else:
+            self._extents = None
+
+    def _discard_intermediate(self):
+        '''
+        Remove intermediate files staged since _clear_intermediate(), leaving
+        the existing ones alone.
+        '''
+
+        if self._staging_dir is not None:
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            self._staging_dir = None
+
+    def _write_intermediate(self, crime):
+        '''
+        Append the given crimedb.core.Crime to the intermediate file for the
+        month in which it occurred, and update that file's extent. Call
+        _finish_intermediate() once all crimes have been written.
+        '''
+
+        file_name = _UNKNOWN_PARTITION
+        if crime.time:
+            file_name = crime.time.strftime('%Y-%m')
+
+        int_fp = os.path.join(self._intermediate_write_dir(), file_name)
+        with open(int_fp, 'at', encoding='utf-8', errors='replace') as f:
+            f.write(json.dumps(crimedb.core.crime2json_obj(crime)))
+            f.write('\n')
+
+        self._written.add(file_name)
+        if self._extents is None:
+            return
+
+        extent = self._extents.setdefault(
+                file_name, {'time_min': None, 'time_max': None, 'bbox': None})
+        if crime.time:
+            ts = crime.time.timestamp()
+            if extent['time_min'] is None or ts < extent['time_min']:
+                extent['time_min'] = ts
+            if extent['time_max'] is None or ts > extent['time_max']:
+                extent['time_max'] = ts
+
+        if crime.location:
+            lon, lat = crime.location
+            if extent['bbox'] is None:
+                extent['bbox'] = [lon, lat, lon, lat]
+            else:
+                b = extent['bbox']
+                extent['bbox'] = [
+                    min(b[0], lon), min(b[1], lat),
+                    max(b[2], lon), max(b[3], lat)]
+
+    def _finish_intermediate(self):
+        '''
+        Record the extents of the intermediate files written since they were
+        last cleared, and replace the existing files with them if they were
+        staged.
+        '''
+
+        if self._extents is not None:
+            ep = os.path.join(self._intermediate_write_dir(), _EXTENTS_FILE)
+            with open(ep, 'wt', encoding='utf-8') as ef:
+                json.dump(self._extents, ef)
+
+        if self._staging_dir is None:
+            return
+
+        int_dir = self._intermediate_dir()
+        old_dir = int_dir + '.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(int_dir, old_dir)
+        os.replace(self._staging_dir, int_dir)
+        shutil.rmtree(old_dir)
+        self._staging_dir = None
+
+    def _first_written_month(self):
+        '''
+        Return the first month (as a datetime.datetime) of the intermediate
+        files written since they were last cleared or appended to, or None if
+        there aren't any, ignoring the partition of crimes without a time.
+        '''
+
+        months = [fn for fn in self._written if fn != _UNKNOWN_PARTITION]
+        if not months:
+            return None
+
+        return datetime.datetime.strptime(min(months), '%Y-%m')
+
+    def _read_intermediate_extents(self):
+        '''
+        Return the recorded extents of the intermediate files, or an empty
+        dictionary if there are none (e.g. if they were written by an older
+        version of this code, or processing was interrupted).
+        '''
+
+        ep = os.path.join(self._intermediate_dir(), _EXTENTS_FILE)
+        if not os.path.isfile(ep):
+            return {}
+
+        with open(ep, 'rt', encoding='utf-8') as ef:
+            return json.load(ef)
+
+
+class RegionTests(unittest.TestCase):
+    '''
+    Tests for Region.
+    '''
+
+    def test_crimes(self):
+        '''
+        Verify that filtering crimes yields exactly the crimes matching the
+        filters, with or without recorded extents.
+        '''
+
+        utc = datetime.timezone.utc
+        crimes = [
+            crimedb.core.Crime(
+                'crime {}'.format(i),
+                datetime.datetime(2014, 1 + i % 12, 1 + i % 28, i % 24,
+                                  tzinfo=utc),
+                (-90 - (i % 7) * 0.1, 38 + (i % 5) * 0.1) if i % 3 else None)
+                for i in range(200)] + \
+            [crimedb.core.Crime('no time', None, (-90, 38))]
+
+        def key(c):
+            return (c.description, c.time, c.location)
+
+        with tempfile.TemporaryDirectory() as td:
+            r = Region('test', td)
+            r._clear_intermediate()
+            for c in crimes:
+                r._write_intermediate(c)
+
+            self.assertEqual(
+                    sorted(map(key, r.crimes())), sorted(map(key, crimes)))
+
+            for time_from, time_to, bbox in [
+                    (datetime.datetime(2014, 3, 5, tzinfo=utc),
+                     datetime.datetime(2014, 6, 1, 12, tzinfo=utc),
+                     None),
+                    (datetime.datetime(2014, 11, 1, tzinfo=utc), None, None),
+                    (None, None, (-90.25, 38.05, -90.05, 38.25)),
+                    (None,
+                     datetime.datetime(2014, 2, 1, tzinfo=utc),
+                     (-90.05, 37.95, -89.95, 38.05)),
+                    (None, None, (-80, 30, -79, 31))]:
+                expected = sorted(
+                    key(c) for c in crimes
+                        if (time_from is None or
+                            (c.time and c.time >= time_from)) and
+                           (time_to is None or
+                            (c.time and c.time <= time_to)) and
+                           (bbox is None or
+                            (c.location and _in_bbox(c.location, bbox))))
+
+                self.assertEqual(
+                        sorted(map(key, r.crimes(time_from, time_to, bbox))),
+                        expected)
+
+                r._finish_intermediate()
+                self.assertEqual(
+                        sorted(map(key, r.crimes(time_from, time_to, bbox))),
+                        expected)
+                os.unlink(os.path.join(r._intermediate_dir(), _EXTENTS_FILE))
+
+    def test_update(self):
+        '''
+        Verify that updating adds only the new crimes to the intermediate
+        files, and returns the first month that they fall in.
+        '''
+
+        class StreamingRegion(Region):
+            streams_records = True
+
+            def fetch(self):
+                new, self.new = self.new, []
+                for r in new:
+                    self.log.append(r)
+                    yield r
+
+            def raw_records(self):
+                return iter(list(self.log))
+
+            def record_crime(self, r):
+                if r % 7 == 0:
+                    return None
+
+                return crimedb.core.Crime(
+                        'crime {}'.format(r % 3),
+                        datetime.datetime.fromtimestamp(
+                            1388534400 + r * 86400, datetime.timezone.utc),
+                        (-90 + r / 1000, 38))
+
+        def key(c):
+            return (c.description, c.time, c.location)
+
+        with tempfile.TemporaryDirectory() as td:
+            r = StreamingRegion('test', td)
+            r.log = list(range(100))
+            r.new = []
+            r.process()
+
+            r.new = list(range(100, 200))
+            self.assertEqual(r.update(), datetime.datetime(2014, 4, 1))
+            self.assertEqual(r.update(), None)
+
+            expected = StreamingRegion('test', os.path.join(td, 'expected'))
+            expected.log = list(range(200))
+            expected.process()
+
+            self.assertEqual(
+                    sorted(map(key, r.crimes())),
+                    sorted(map(key, expected.crimes())))
+            self.assertEqual(
+                    r._read_intermediate_extents(),
+                    expected._read_intermediate_extents())
@@ -0,0 +1,342 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Cached region boundaries.
+
+Region boundaries are distributed as GeoJSON in crimedb.regions.__data__, some
+of which are quite large. Parsing them is slow, so the first time a boundary is
+needed it is compiled into a cache file holding its bounding box and the WKB of
+the boundary and each of its simplified variants (see BOUNDARY_VARIANTS).
+Cache files are named by the hash of their GeoJSON, so they never go stale.
+
+Boundaries are loaded lazily, piece by piece, and memoized per process by
+boundary(). Shapely itself is only imported once a geometry is needed, so
+using just the bounding box of a cached boundary is cheap.
+'''
+
+import crimedb.output
+import functools
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import unittest
+
+_LOGGER = logging.getLogger(__name__)
+
+# Version of the cache file format; bump this to invalidate existing caches
+_CACHE_VERSION = 2
+
+# Tolerance, in degrees, to which the 'coarse' variant is simplified
+_COARSE_TOLERANCE = 0.005
+
+
+def _coarse(shape):
+    '''
+    Return a superset of the given shape with far fewer vertices.
+
+    Simplification moves edges by up to the tolerance, in either direction, so
+    we buffer by twice that to cover the shape. Should that still not contain
+    the whole shape, e.g. due to rounding, we fall back to its convex hull.
+    '''
+
+    coarse = shape.simplify(
+            _COARSE_TOLERANCE, preserve_topology=True).buffer(
+                    2 * _COARSE_TOLERANCE)
+    if not coarse.contains(shape):
+        _LOGGER.warning(
+                'coarse boundary does not contain the full boundary; '
+                'using its convex hull')
+        coarse = shape.convex_hull
+
+    return coarse
+
+
+# Map of simplified variant names to functions computing them from the full
+# boundary. The 'coarse' variant is a superset of the boundary with far fewer
+# vertices, for quickly rejecting points that are nowhere near it. The 'web'
+# variant is for display by clients, where detail much below 50m is invisible.
+BOUNDARY_VARIANTS = {
+    'coarse': _coarse,
+    'web': lambda s: s.simplify(0.0005, preserve_topology=True),
+}
+
+
+def boundary_source_path(name):
+    '''
+    Return the path of the GeoJSON boundary for the given region.
+    '''
+
+    return os.path.join(
+            os.path.dirname(__file__), '__data__', '{}.geojson'.format(name))
+
+
+def boundary_cache_dir():
+    '''
+    Return the directory in which compiled boundaries are cached; this is
+    $CRIMEDB_CACHE_DIR/boundaries if set, or the XDG cache directory
+    otherwise.
+    '''
+
+    cache_dir = os.environ.get('CRIMEDB_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or
+                    os.path.join(os.path.expanduser('~'), '.cache'),
+                'crimedb')
+
+    return os.path.join(cache_dir, 'boundaries')
+
+
+def compile_boundary(gjo):
+    '''
+    Return the contents of a cache file for the given GeoJSON boundary.
+
+    This consists of a line of JSON describing the bounding box and the
+    [offset, length] of each variant's WKB, followed by the WKB itself.
+    '''
+
+    import shapely.geometry
+    import shapely.wkb
+
+    shape = shapely.geometry.shape(gjo)
+    variants = {'full': shape}
+    for vn, vf in sorted(BOUNDARY_VARIANTS.items()):
+        variants[vn] = vf(shape)
+
+    header = {'version': _CACHE_VERSION, 'bbox': list(shape.bounds)}
+    blobs = []
+    offset = 0
+    header['variants'] = {}
+    for vn, vs in sorted(variants.items()):
+        blob = shapely.wkb.dumps(vs)
+        header['variants'][vn] = [offset, len(blob)]
+        offset += len(blob)
+        blobs += [blob]
+
+    return json.dumps(header).encode('utf-8') + b'\n' + b''.join(blobs)
+
+
+class Boundary(object):
+    '''
+    The boundary of a region, read from the given GeoJSON file and cached in
+    the given directory.
+
+    Nothing is read until needed, and the full boundary is never parsed if
+    only the bounding box or a simplified variant is used.
+    '''
+
+    def __init__(self, source_path, cache_dir=None):
+        self.source_path = source_path
+        self.cache_dir = cache_dir or boundary_cache_dir()
+        self._header = None
+        self._blobs = None
+        self._shapes = {}
+        self._prepared = {}
+
+    def _load(self):
+        if self._header is not None:
+            return
+
+        with open(self.source_path, 'rb') as sf:
+            source = sf.read()
+
+        cp = os.path.join(
+                self.cache_dir,
+                '{}-{}.wkb'.format(
+                    os.path.splitext(os.path.basename(self.source_path))[0],
+                    hashlib.sha1(source).hexdigest()))
+
+        data = None
+        try:
+            with open(cp, 'rb') as cf:
+                data = cf.read()
+        except FileNotFoundError:
+            pass
+
+        if data is not None:
+            header, blobs = data.split(b'\n', 1)
+            self._header = json.loads(header.decode('utf-8'))
+            self._blobs = blobs
+            if self._header['version'] == _CACHE_VERSION:
+                return
+
+        _LOGGER.info('compiling boundary {} into {}'.format(
+                self.source_path, cp))
+        data = compile_boundary(json.loads(source.decode('utf-8', 'replace')))
+        try:
+            crimedb.output.replace_file(cp, data)
+        except OSError as e:
+            _LOGGER.warning('failed to cache boundary: {}'.format(e))
+
+        header, self._blobs = data.split(b'\n', 1)
+        self._header = json.loads(header.decode('utf-8'))
+
+    @property
+    def bbox(self):
+        '''
+        The (minx, miny, maxx, maxy) bounding box of the boundary.
+        '''
+
+        self._load()
+        return tuple(self._header['bbox'])
+
+    def variant(self, name):
+        '''
+        Return the Shapely object for the given variant of the boundary:
+        either 'full' or one of BOUNDARY_VARIANTS.
+        '''
+
+        if name not in self._shapes:
+            import shapely.wkb
+
+            self._load()
+            offset, length = self._header['variants'][name]
+            self._shapes[name] = shapely.wkb.loads(
+                    self._blobs[offset:offset + length])
+
+        return self._shapes[name]
+
+    def prepared(self, name):
+        '''
+        Return a prepared geometry for the given variant, for efficient
+        repeated predicates.
+        '''
+
+        if name not in self._prepared:
+            import shapely.prepared
+
+            self._prepared[name] = shapely.prepared.prep(self.variant(name))
+
+        return self._prepared[name]
+
+    @property
+    def shape(self):
+        '''
+        The Shapely object for the full boundary.
+        '''
+
+        return self.variant('full')
+
+    def contains(self, geom):
+        '''
+        Return whether the boundary contains the given Shapely object.
+        '''
+
+        minx, miny, maxx, maxy = self.bbox
+        gminx, gminy, gmaxx, gmaxy = geom.bounds
+        if gminx < minx or gminy < miny or gmaxx > maxx or gmaxy > maxy:
+            return False
+
+        return self.prepared('coarse').contains(geom) and \
+                self.prepared('full').contains(geom)
+
+    def intersects(self, geom):
+        '''
+        Return whether the boundary intersects the given Shapely object.
+        '''
+
+        minx, miny, maxx, maxy = self.bbox
+        gminx, gminy, gmaxx, gmaxy = geom.bounds
+        if gmaxx < minx or gmaxy < miny or gminx > maxx or gminy > maxy:
+            return False
+
+        return self.prepared('coarse').intersects(geom) and \
+                self.prepared('full').intersects(geom)
+
+
+@functools.lru_cache(maxsize=None)
+def boundary(name):
+    '''
+    Return the Boundary of the given region, shared by all callers in this
+    process.
+    '''
+
+    return Boundary(boundary_source_path(name))
+
+
+class BoundaryTests(unittest.TestCase):
+    '''
+    Tests for Boundary.
+    '''
+
+    def test_boundary(self):
+        '''
+        Verify that boundaries are cached and agree with their GeoJSON.
+        '''
+
+        import shapely.geometry
+
+        gjo = {
+            'type': 'Polygon',
+            'coordinates': [[
+                [0, 0], [1, 0], [1, 0.5], [0.5, 0.5001], [0, 0.5], [0, 0]]],
+        }
+        shape = shapely.geometry.shape(gjo)
+
+        with tempfile.TemporaryDirectory() as td:
+            sp = os.path.join(td, 'test.geojson')
+            with open(sp, 'wt') as sf:
+                json.dump(gjo, sf)
+
+            cd = os.path.join(td, 'cache')
+            b = Boundary(sp, cd)
+            self.assertEqual(b.bbox, shape.bounds)
+            self.assertEqual(len(os.listdir(cd)), 1)
+
+            # A new Boundary reads the cache rather than the GeoJSON
+            b = Boundary(sp, cd)
+            b._load()
+            self.assertEqual(b.bbox, shape.bounds)
+            self.assertNotIn('full', b._shapes)
+            self.assertTrue(b.shape.equals(shape))
+            self.assertTrue(b.variant('coarse').contains(shape))
+            self.assertLess(
+                    len(b.variant('web').exterior.coords),
+                    len(shape.exterior.coords))
+
+            for p, expected in [
+                    ((0.25, 0.25), True),
+                    ((0.5, 0.50005), True),
+                    ((0.25, 0.5001), False),
+                    ((2, 2), False)]:
+                self.assertEqual(
+                        b.contains(shapely.geometry.Point(*p)), expected)
+
+            self.assertTrue(b.intersects(shapely.geometry.box(0.9, 0.4, 2, 2)))
+            self.assertFalse(b.intersects(shapely.geometry.box(2, 2, 3, 3)))
+
+            # Changing the GeoJSON results in a new cache file
+            with open(sp, 'wt') as sf:
+                json.dump(shapely.geometry.mapping(shape.buffer(1)), sf)
+            b = Boundary(sp, cd)
+            self.assertEqual(b.bbox, shape.buffer(1).bounds)
+            self.assertEqual(len(os.listdir(cd)), 2)
+
+    def test_coarse(self):
+        '''
+        Verify that the coarse variant of every region's boundary contains
+        the full boundary, so that it never rejects points inside it.
+        '''
+
+        import crimedb.regions
+
+        with tempfile.TemporaryDirectory() as td:
+            for rn in crimedb.regions.region_names():
+                b = Boundary(boundary_source_path(rn), td)
+                self.assertTrue(
+                        b.prepared('coarse').contains(b.shape), rn)
@@ -17,30 +17,40 @@ Process crime data from Dallas, TX Police Department.
 '''
 
 import crimedb.core
+import crimedb.endpoints
 import crimedb.regions.base
 import crimedb.socrata
-import datetime
-import json
+import functools
 import logging
-import os
-import os.path
-import pyproj
-import pytz
-import shapely.geometry
-import shutil
 
 
-_SOCRATA_HOSTNAME = 'www.dallasopendata.com'
-
 _SOCRATA_DATASET = 'tbnj-w5hb'
 
 _LOGGER = logging.getLogger(__name__)
 
-_TZ = pytz.timezone('US/Central')
+@functools.lru_cache(maxsize=None)
+def _tz():
+    import pytz
+    return pytz.timezone('US/Central')
 
 # Guessed that PointX, PointY are in SPCS/NAD83. This appears correct based on
 # spot-checking a few locations with their geocoded addresses.
-_PROJ = pyproj.Proj(init='nad83:4202', units='us-ft', preserve_units=True)
+@functools.lru_cache(maxsize=None)
+def _proj():
+    import pyproj
+    return pyproj.Proj(init='nad83:4202', units='us-ft', preserve_units=True)
+
+
+def _incident_id(cr):
+    return cr['servicenum']
+
+
+def _incident_time(cr):
+    if 'startdatetime' not in cr:
+        return None
+
+    return crimedb.socrata.floating_timestamp_to_datetime(
+            cr['startdatetime'], _tz()).timestamp()
 
 
 class Region(crimedb.regions.base.Region):
@@ -51,19 +61,17 @@ class Region(crimedb.regions.base.Region):
         self.human_name = 'Dallas, TX'
         self.human_url = 'http://www.dallaspolice.net/'
 
-    def download(self):
+    streams_records = True
+
+    def fetch(self):
         # Get the list of IDs that we've already seen
-        gids = set()
-        if os.path.exists(self._incidents_path()):
-            with open(self._incidents_path(), 'rt', encoding='utf-8') as f:
-                for l in f:
-                    incident = json.loads(l)
-                    gids.add(incident['servicenum'])
-
-        # Write our all new incidents that don't already appear in the file
-        with open(self._incidents_path(), 'at', encoding='utf-8') as f:
+        log = self._incidents_log()
+        gids = log.ids()
+
+        # Write our all new incidents that don't already appear in the log
+        with log.writer() as w:
             for cr in crimedb.socrata.dataset_rows(
-                    _SOCRATA_HOSTNAME, _SOCRATA_DATASET):
+                    crimedb.endpoints.endpoint('dallas'), _SOCRATA_DATASET):
                 if 'servicenum' not in cr:
                     _LOGGER.warning(
                             ("crime does not contain a 'servicenum' field; "
@@ -73,60 +81,41 @@ class Region(crimedb.regions.base.Region):
                 if cr['servicenum'] in gids:
                     continue
 
-                f.write(json.dumps(cr) + '\n')
-
-    def process(self):
-        if not os.path.exists(self._incidents_path()):
-            return
-
-        # Since we are just blindly appending all incidents to the data
-        # files (even if we've seen then before), clean everything up 
-        # before processing so that we don't have duplicates.
-        shutil.rmtree(self._intermediate_dir());
+                gids.add(cr['servicenum'])
+                w.append(cr)
+                yield cr
+
+                # Keep what we've fetched so far if the download fails later
+                w.checkpoint()
+
+    def raw_records(self):
+        return self._incidents_log().records()
+
+    def record_crime(self, cr):
+        import shapely.geometry
+
+        date = None
+        if 'startdatetime' in cr:
+            date = crimedb.socrata.floating_timestamp_to_datetime(
+                    cr['startdatetime'], _tz())
+
+        loc = None
+        if 'pointx' in cr and 'pointy' in cr:
+            loc = _proj()(float(cr['pointx']),
+                    float(cr['pointy']),
+                    inverse=True,
+                    errcheck=True)
+
+        if loc:
+            point = shapely.geometry.Point(*loc)
+            if not self.contains(point):
+                _LOGGER.debug(
+                        ('crime at ({lon}, {lat}) is outside of our '
+                         'shape; stripping location').format(
+                             lon=loc[0], lat=loc[1]))
+                loc = None
 
-        with open(self._incidents_path(), 'rt', encoding='utf-8') as f:
-            for cr in map(json.loads, f):
-                date = None
-                if 'startdatetime' in cr:
-                    date = crimedb.socrata.floating_timestamp_to_datetime(
-                            cr['startdatetime'], _TZ)
+        return crimedb.core.Crime(cr['offincident'], date, loc)
 
-                loc = None
-                if 'pointx' in cr and 'pointy' in cr:
-                    loc = _PROJ(float(cr['pointx']),
-                            float(cr['pointy']),
-                            inverse=True,
-                            errcheck=True)
-
-                if loc:
-                    point = shapely.geometry.Point(*loc)
-                    if self.shape and not self.shape.contains(point):
-                        _LOGGER.debug(
-                                ('crime at ({lon}, {lat}) is outside of our '
-                                 'shape; stripping location').format(
-                                     lon=loc[0], lat=loc[1]))
-                        loc = None
-
-                c = crimedb.core.Crime(cr['offincident'], date, loc)
-
-                int_fp = os.path.join(self._intermediate_dir(), 'UNKNOWN')
-                if date:
-                    int_fp = os.path.join(
-                            self._intermediate_dir(),
-                            datetime.datetime.strftime(date, '%y-%m'))
-
-                with open(int_fp, 'at', encoding='utf-8', errors='replace') as f:
-                    f.write(json.dumps(crimedb.core.crime2json_obj(c)))
-                    f.write('\n')
-
-
-    def crimes(self):
-        for file_name in os.listdir(self._intermediate_dir()):
-            fp = os.path.join(self._intermediate_dir(), file_name)
-            with open(fp, 'rt', encoding='utf-8', errors='replace') as rf:
-                for l in rf:
-                    yield crimedb.core.json_obj2crime(
-                            json.loads(l.strip()))
-
-    def _incidents_path(self):
-        return os.path.join(self._cache_dir(), 'incidents')
+    def _incidents_log(self):
+        return self._raw_log('incidents', _incident_id, _incident_time)
@@ -20,30 +20,31 @@ http://www.slmpd.org/Crimereports.shtml.
 import contextlib
 import csv
 import crimedb.core
+import crimedb.endpoints
 import crimedb.geocoding
 import crimedb.regions.base
+import crimedb.timecodec
 import datetime
+import functools
 import io
-import json
 import logging
-import lxml, lxml.etree
 import os.path
-import pyproj
-import pytz
 import re
-import shapely.geometry
-import shutil
 import urllib.request, urllib.parse
 
 
-_BASE_URL = 'http://www.slmpd.org/CrimeReport.aspx'
-
 # Per the FAQ http://www.slmpd.org/Crime/CrimeDataFrequentlyAskedQuestions.pdf,
 # (XCoord, YCoord) is NAD83.
-_PROJ = pyproj.Proj(
-    init='nad83:2401', units='us-ft', preserve_units=True)
+@functools.lru_cache(maxsize=None)
+def _proj():
+    import pyproj
+    return pyproj.Proj(
+        init='nad83:2401', units='us-ft', preserve_units=True)
 
-_TZ = pytz.timezone('US/Central')
+@functools.lru_cache(maxsize=None)
+def _tz():
+    import pytz
+    return pytz.timezone('US/Central')
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -63,20 +64,26 @@ class Region(crimedb.regions.base.Region):
         # Since we are just blindly appending all incidents to the data
         # files (even if we've seen then before), clean everything up 
         # before processing so that we don't have duplicates.
-        shutil.rmtree(self._intermediate_dir());
+        self._clear_intermediate()
 
         for fn in os.listdir(self._cache_dir()):
             self._process_raw_file(os.path.join(self._cache_dir(), fn))
 
-    def crimes(self):
-        int_dir = self._intermediate_dir()
+        self._finish_intermediate()
+
+    def update(self):
+        # Each file is processed independently of the others, so only those
+        # that we haven't seen before need processing
+        seen = set(os.listdir(self._cache_dir()))
+        self._download_raw_files()
+        new = sorted(set(os.listdir(self._cache_dir())) - seen)
+
+        self._append_intermediate()
+        for fn in new:
+            self._process_raw_file(os.path.join(self._cache_dir(), fn))
+        self._finish_intermediate()
 
-        for file_name in os.listdir(int_dir):
-            fp = os.path.join(int_dir, file_name)
-            with open(fp, 'rt', encoding='utf-8', errors='replace') as rf:
-                for l in rf:
-                    yield crimedb.core.json_obj2crime(
-                            json.loads(l.strip()))
+        return self._first_written_month()
 
     def _download_raw_files(self):
         '''
@@ -115,11 +122,14 @@ class Region(crimedb.regions.base.Region):
         TOC pages, in reverse chronological order.
         '''
 
+        import lxml.etree
+
         next_num = 2
         form_data = None
 
         while True:
-            with contextlib.closing(urllib.request.urlopen(_BASE_URL, data=form_data)) as r:
+            with contextlib.closing(urllib.request.urlopen(
+                    crimedb.endpoints.endpoint('stl'), data=form_data)) as r:
                 body = r.read()
                 yield io.BytesIO(body)
 
@@ -146,6 +156,8 @@ class Region(crimedb.regions.base.Region):
         contents.
         '''
 
+        import lxml.etree
+
         et = lxml.etree.parse(tp, lxml.etree.HTMLParser())
         global_form_fields = self._toc_global_form_fields(et)
 
@@ -170,7 +182,8 @@ class Region(crimedb.regions.base.Region):
                 file_form_fields['__EVENTTARGET'] = m.group(1)
                 form_data = urllib.parse.urlencode(file_form_fields).encode('utf-8')
 
-                return urllib.request.urlopen(_BASE_URL, data=form_data)
+                return urllib.request.urlopen(
+                        crimedb.endpoints.endpoint('stl'), data=form_data)
 
             yield fa.text, download_file
 
@@ -180,6 +193,8 @@ class Region(crimedb.regions.base.Region):
         directory.
         '''
 
+        import shapely.geometry
+
         file_name = os.path.basename(file_path)
         _LOGGER.info('processing STL file {}'.format(file_name))
 
@@ -190,7 +205,7 @@ class Region(crimedb.regions.base.Region):
         def write_crime_dict(crime_dict, loc):
             if loc:
                 crime_point = shapely.geometry.Point(*loc)
-                if self.shape and not self.shape.contains(crime_point):
+                if not self.contains(crime_point):
                     _LOGGER.debug(
                             ('crime at ({lon}, {lat}) is outside '
                              'of our shape; stripping location').format(
@@ -201,17 +216,9 @@ class Region(crimedb.regions.base.Region):
                     crime_dict['DateOccur'],
                     '%m/%d/%Y %H:%M')
 
-            c = crimedb.core.Crime(
+            self._write_intermediate(crimedb.core.Crime(
                     crime_dict['Description'],
-                    _TZ.localize(date), loc)
-
-            int_fp = os.path.join(
-                    self._intermediate_dir(),
-                    datetime.datetime.strftime(date, '%Y-%m'))
-
-            with open(int_fp, 'at', encoding='utf-8', errors='replace') as f:
-                f.write(json.dumps(crimedb.core.crime2json_obj(c)))
-                f.write('\n')
+                    crimedb.timecodec.localize(date, _tz()), loc))
 
 
         def crime_dict_loc(cd):
@@ -249,7 +256,7 @@ class Region(crimedb.regions.base.Region):
                         geocoding_needed += [crime_dict]
                         continue
                 else:
-                    loc = _PROJ(
+                    loc = _proj()(
                             float(crime_dict['XCoord']),
                             float(crime_dict['YCoord']),
                             inverse=True, errcheck=True)
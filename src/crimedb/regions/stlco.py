@@ -28,9 +28,9 @@
 #       - Maintain a list of all GlobalIDs seen
 #       - Page through all GlobalIDs 5k at a time (max page size) to see
 #         what's new
-#       - Append records as JSON objects (one per line) to a single master
-#         file. This can serve as both our record of all GlobalIDs seen, and
-#         a cache to allow re-processing
+#       - Append records as JSON objects to a raw log (see crimedb.rawlog).
+#         This can serve as both our record of all GlobalIDs seen, and a
+#         cache to allow re-processing
 
 '''
 Process crime data from the St. Louis County Police Department at
@@ -38,24 +38,21 @@ http://maps.stlouisco.com/police.
 '''
 
 import crimedb.core
+import crimedb.endpoints
 import crimedb.regions.base
 import datetime
+import functools
 import io
 import json
 import logging
-import os.path
-import pyproj
-import pytz
-import shapely.geometry
-import shutil
 import urllib.parse
 import urllib.request
 
 
-_QUERY_URL = ('http://maps.stlouisco.com/arcgis/rest/services/'
-               'Police/AGS_Crimes/MapServer/0/query')
-
-_TZ = pytz.timezone('US/Central')
+@functools.lru_cache(maxsize=None)
+def _tz():
+    import pytz
+    return pytz.timezone('US/Central')
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -63,7 +60,10 @@ _LOGGER = logging.getLogger(__name__)
 #      'latestWkid' field in the results object. Unfortunately
 #      the current fetching/caching strategy doesn't really
 #      accommodate this very well. Probably worth re-visiting.
-_PROJ = pyproj.Proj(init='epsg:3857')
+@functools.lru_cache(maxsize=None)
+def _proj():
+    import pyproj
+    return pyproj.Proj(init='epsg:3857')
 
 
 class Region(crimedb.regions.base.Region):
@@ -74,14 +74,12 @@ class Region(crimedb.regions.base.Region):
         self.human_name = 'St. Louis County, MO'
         self.human_url = 'http://www.stlouisco.com/LawandPublicSafety/PoliceDepartment'
 
-    def download(self):
+    streams_records = True
+
+    def fetch(self):
         # Get the list of GlobalIDs that we've already seen
-        gids = set()
-        if os.path.exists(self._incidents_path()):
-            with open(self._incidents_path(), 'rt', encoding='utf-8') as f:
-                for l in f:
-                    incident = json.loads(l)
-                    gids.add(incident['attributes']['GlobalID'])
+        log = self._incidents_log()
+        gids = log.ids()
 
         # Page through the list of incidents, saving any of those that
         # we haven't already seen
@@ -94,72 +92,59 @@ class Region(crimedb.regions.base.Region):
         }
 
         last_gid = '{00000000-0000-0000-0000-000000000000}'
-        while True:
-            _LOGGER.debug('fetching GlobalIDs > {}'.format(last_gid))
-            query_params['where'] = "GlobalID>'{}'".format(last_gid)
-            url = '{}?{}'.format(_QUERY_URL, urllib.parse.urlencode(query_params))
-            ro = json.load(io.TextIOWrapper(urllib.request.urlopen(url),
-                                            encoding='utf-8',
-                                            errors='replace'))
-
-            _LOGGER.debug('got {} features'.format(len(ro['features'])))
-
-            # No records with a larger GlobalID; we're done
-            if not ro['features']:
-                break
+        with log.writer() as w:
+            while True:
+                _LOGGER.debug('fetching GlobalIDs > {}'.format(last_gid))
+                query_params['where'] = "GlobalID>'{}'".format(last_gid)
+                url = '{}?{}'.format(
+                        crimedb.endpoints.endpoint('stlco'),
+                        urllib.parse.urlencode(query_params))
+                ro = json.load(io.TextIOWrapper(urllib.request.urlopen(url),
+                                                encoding='utf-8',
+                                                errors='replace'))
+
+                _LOGGER.debug('got {} features'.format(len(ro['features'])))
+
+                # No records with a larger GlobalID; we're done
+                if not ro['features']:
+                    break
 
-            with open(self._incidents_path(), 'at', encoding='utf-8') as f:
                 for feature in ro['features']:
                     last_gid = feature['attributes']['GlobalID']
                     if last_gid in gids:
                         continue
 
-                    f.write(json.dumps(feature) + '\n')
-
-    def process(self):
-        if not os.path.exists(self._incidents_path()):
-            return
-
-        # Since we are just blindly appending all incidents to the data
-        # files (even if we've seen then before), clean everything up 
-        # before processing so that we don't have duplicates.
-        shutil.rmtree(self._intermediate_dir());
-
-        with open(self._incidents_path(), 'rt', encoding='utf-8') as f:
-            for l in f:
-                fo = json.loads(l)
+                    gids.add(last_gid)
+                    w.append(feature)
+                    yield feature
 
-                attrs = fo['attributes']
-                geom = fo['geometry']
+                # Keep what we've fetched so far if a later page fails
+                w.checkpoint()
 
-                loc = _PROJ(geom['x'], geom['y'], inverse=True, errcheck=True)
-                point = shapely.geometry.Point(*loc)
-                if self.shape and not self.shape.contains(point):
-                    _LOGGER.debug(
-                            ('crime {cid} at ({lon}, {lat}) is outside of our '
-                             'shape; stripping location').format(
-                                 cid=attrs['GlobalID'], lon=loc[0], lat=loc[1]))
-                    loc = None
+    def raw_records(self):
+        return self._incidents_log().records()
 
-                date = datetime.datetime.fromtimestamp(attrs['Date'] / 1000, _TZ)
+    def record_crime(self, fo):
+        import shapely.geometry
 
-                c = crimedb.core.Crime(attrs['Offense'], date, loc)
+        attrs = fo['attributes']
+        geom = fo['geometry']
 
-                int_fp = os.path.join(
-                        self._intermediate_dir(),
-                        datetime.datetime.strftime(date, '%y-%m'))
+        loc = _proj()(geom['x'], geom['y'], inverse=True, errcheck=True)
+        point = shapely.geometry.Point(*loc)
+        if not self.contains(point):
+            _LOGGER.debug(
+                    ('crime {cid} at ({lon}, {lat}) is outside of our '
+                     'shape; stripping location').format(
+                         cid=attrs['GlobalID'], lon=loc[0], lat=loc[1]))
+            loc = None
 
-                with open(int_fp, 'at', encoding='utf-8', errors='replace') as f:
-                    f.write(json.dumps(crimedb.core.crime2json_obj(c)))
-                    f.write('\n')
+        date = datetime.datetime.fromtimestamp(attrs['Date'] / 1000, _tz())
 
-    def crimes(self):
-        for file_name in os.listdir(self._intermediate_dir()):
-            fp = os.path.join(self._intermediate_dir(), file_name)
-            with open(fp, 'rt', encoding='utf-8', errors='replace') as rf:
-                for l in rf:
-                    yield crimedb.core.json_obj2crime(
-                            json.loads(l.strip()))
+        return crimedb.core.Crime(attrs['Offense'], date, loc)
 
-    def _incidents_path(self):
-        return os.path.join(self._cache_dir(), 'incidents')
+    def _incidents_log(self):
+        return self._raw_log(
+                'incidents',
+                lambda fo: fo['attributes']['GlobalID'],
+                lambda fo: fo['attributes']['Date'] / 1000)
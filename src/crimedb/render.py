@@ -0,0 +1,631 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Render the collated data of every region, along with the files of the www
+directory, into the site served to clients.
+
+The output directory gets a symlink to every file in the www directory, grid
+tiles of the crimes in each region (see crimedb.tiles), and per-region
+timeseries, offense aggregates, boundaries and pages rendered from the
+templates in www/_templates/. The crimes of each region are read once, in a
+single pass that feeds all of REGION_AGGREGATORS.
+
+Renders can be incremental, updating the output directory in place and
+re-writing only the tiles affected by cells of the grid that have changed
+since the last render. The grid is saved to a state file alongside the output
+directory for the next render to compare against; long-running processes can
+keep it in memory instead.
+'''
+
+import crimedb.aggregate
+import crimedb.collate
+import crimedb.core
+import crimedb.offenses
+import crimedb.output
+import crimedb.regions
+import crimedb.tiles
+import crimedb.regions.base
+import crimedb.www
+import datetime
+import functools
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import types
+import unittest
+
+__LOGGER = logging.getLogger(__name__)
+
+# Aggregators computed for each region in a single pass over its crimes. New
+# per-region outputs should add an aggregator here rather than reading month
+# files themselves.
+REGION_AGGREGATORS = {
+    'grid': functools.partial(
+            crimedb.aggregate.GridAggregator, crimedb.www.GRID_BASE_ZOOM),
+    'by_month': crimedb.aggregate.MonthAggregator,
+    'by_weekday': crimedb.aggregate.WeekdayAggregator,
+    'grid_by_offense': functools.partial(
+            crimedb.aggregate.OffenseAggregator,
+            functools.partial(
+                crimedb.aggregate.GridAggregator, crimedb.www.GRID_BASE_ZOOM)),
+    'by_month_by_offense': functools.partial(
+            crimedb.aggregate.OffenseAggregator,
+            crimedb.aggregate.MonthAggregator),
+}
+
+
+def default_state_file(output_dir):
+    '''
+    Return the path of the file in which the state of renders to the given
+    output directory is saved by default. This is kept outside of the output
+    directory so that it isn't published.
+    '''
+
+    return '{}.render-state.json'.format(os.path.normpath(output_dir))
+
+
+def call_per_region(region_dir, f):
+    '''
+    Run a function on every known region, calling it with a single argument:
+    the name of the region.
+    '''
+
+    for rn in os.listdir(region_dir):
+        if rn.startswith('.'):
+            continue
+
+        rp = os.path.join(region_dir, rn)
+        if not os.path.isdir(rp):
+            continue
+
+        f(region_name=rn, region_path=rp)
+
+
+def aggregate_region(opts, region_aggregates, region_name, region_path,
+                     **kwopts):
+    '''
+    Compute all REGION_AGGREGATORS for the given region in a single pass over
+    its crimes, storing them in region_aggregates[region_name].
+    '''
+
+    __LOGGER.info('Reading raw data for {}'.format(region_name))
+
+    aggregators = {n: f() for n, f in REGION_AGGREGATORS.items()}
+    crimedb.aggregate.aggregate_month_files(
+            region_path, opts.time_from, opts.time_to, aggregators.values())
+
+    region_aggregates[region_name] = aggregators
+
+
+def grid_for_region(region, grid, zoom):
+    '''
+    Add empty cells to the given grid for every cell at our zoom level that
+    intersects the region but has no crimes.
+    '''
+
+    # Compute the range of (x, y) tile coordinates at our zoom level that are
+    # within the region.
+    #
+    # NOTE: Since the Slippy map coordinate system has its origin at (-180W, +85N)
+    #       the maximum latitude is our minimum Y value while the maximum longitude
+    #       is our maximum X value.
+    lon_min, lat_min, lon_max, lat_max = region.boundary.bbox
+    minx, maxy = crimedb.www.slippy_tile_coordinates_from_point(
+            lon_min, lat_min, zoom)
+    maxx, miny = crimedb.www.slippy_tile_coordinates_from_point(
+            lon_max, lat_max, zoom)
+
+    for x in range(minx, maxx + 1):
+        for y in range(miny, maxy + 1):
+            cell_shape = crimedb.www.bbox_from_slippy_tile_coordinates(x, y, zoom)
+            if y not in grid[x] and \
+                    region.boundary.intersects(cell_shape):
+                grid[x][y] += 0
+
+    return grid
+
+
+def render_grid(opts, region_aggregates, previous_grid=None):
+    '''
+    Render tiles for the grid-data/ output directory, returning the grid that
+    they were rendered from.
+
+    If the grid from a previous render is given, only tiles affected by cells
+    that have changed since then are re-written.
+    '''
+
+    initial_zoom_level = crimedb.www.GRID_BASE_ZOOM
+    grid = crimedb.www.grid_from_crimes([], initial_zoom_level)
+    for rn, aggregators in region_aggregates.items():
+        region = crimedb.regions.region(rn)
+        region_grid = grid_for_region(
+                region, aggregators['grid'].grid, initial_zoom_level)
+        grid = crimedb.www.grid_add(grid, region_grid)
+
+    tiles = None
+    if previous_grid is not None:
+        tiles = crimedb.tiles.dirty_tiles(
+                previous_grid,
+                grid,
+                initial_zoom_level,
+                crimedb.www.MAX_ZOOM_LEVEL)
+        __LOGGER.info('{} tiles affected by changes since the last render'.format(
+                sum(len(xys) for xys in tiles.values())))
+
+    crimedb.tiles.render_tiles(
+            opts.output_dir, grid, tiles,
+            split_zoom=opts.split_zoom, jobs=opts.jobs,
+            formats=opts.tile_formats, encodings=opts.encodings,
+            archive=opts.tile_archive)
+
+    # Bundles of binary tile files; bin/tileserver assembles these on the fly
+    # from tile archives
+    if 'binary' in opts.tile_formats and not opts.tile_archive:
+        crimedb.tiles.write_bundles(
+                opts.output_dir, tiles, encodings=opts.encodings)
+
+    crimedb.tiles.write_breakpoints(
+            opts.output_dir, grid, encodings=opts.encodings)
+    crimedb.tiles.write_grid_state(
+            opts.state_file, grid, opts.tile_formats, opts.encodings,
+            opts.tile_archive)
+
+    return grid
+
+
+def render_global_templates(opts):
+    '''
+    Render files from the _templates/ directory (but ommitting the r/
+    subdirectory).
+    '''
+
+    import pystache
+
+    # Create our pystache context object
+    regions = []
+    for rn in os.listdir(opts.data_dir):
+        if rn.startswith('.'):
+            continue
+
+        if not os.path.isdir(os.path.join(opts.data_dir, rn)):
+            continue
+
+
+        region = crimedb.regions.region(rn)
+
+        regions += [{
+            'name': region.name,
+            'human_name': region.human_name,
+            'human_url': region.human_url,
+        }]
+
+    context = {
+        'regions': regions
+    }
+
+    # Walk the template directory rendering any template files to the
+    # destination
+    template_path = os.path.join(opts.www_dir, '_templates')
+    for root, dirs, files in os.walk(template_path):
+        if root == template_path:
+            del dirs[dirs.index('_r')]
+
+        for fn in files:
+            if fn.startswith('.'):
+                continue
+
+            sp = os.path.join(root, fn)
+            __LOGGER.debug('loading template {}'.format(sp))
+            with open(sp, 'rt', encoding='utf-8') as sf:
+                source_data = sf.read()
+
+            rp = os.path.relpath(sp, template_path)
+            dp = os.path.join(opts.output_dir, rp)
+            crimedb.output.write_file(
+                    dp, pystache.render(source_data, context),
+                    opts.encodings)
+
+
+def render_region_timeseries(opts, region_aggregates, region_name,
+                             region_path, **kwopts):
+    '''
+    Render JSON files to be used for rendering a HighCharts timeseries in the
+    /r/<region>/index.html page and write it to /r/<region>/timeseries.json.
+    '''
+
+    crimes_by_month = region_aggregates[region_name]['by_month'].counts
+    crimes_by_weekday = region_aggregates[region_name]['by_weekday'].counts
+
+    # Render the JSON output file
+    jo = {
+        'by_month': {
+            'chart': {
+                'type': 'line',
+            },
+            'title': {
+                'text': 'Crimes by Month',
+            },
+            'xAxis': {
+                'categories': [
+                    'Jan',
+                    'Feb',
+                    'Mar',
+                    'Apr',
+                    'May',
+                    'Jun',
+                    'Jul',
+                    'Aug',
+                    'Sep',
+                    'Oct',
+                    'Nov',
+                    'Dec',
+                ],
+            },
+            'yAxis': {
+                'title': {
+                    'text': 'Number of crimes',
+                },
+            },
+            'series': [
+                {'name': x, 'data': crimes_by_month[x]} for x in crimes_by_weekday],
+        },
+        'by_weekday': {
+            'chart': {
+                'type': 'line',
+            },
+            'title': {
+                'text': 'Crimes by Weekday',
+            },
+            'xAxis': {
+                'categories': [
+                    'Mon',
+                    'Tue',
+                    'Wed',
+                    'Thu',
+                    'Fri',
+                    'Sat',
+                    'Sun',
+                ],
+            },
+            'yAxis': {
+                'title': {
+                    'text': 'Number of crimes',
+                },
+            },
+            'series': [
+                {'name': x, 'data': crimes_by_weekday[x]} for x in crimes_by_weekday],
+        },
+    }
+
+    crimedb.output.write_file(
+            os.path.join(opts.output_dir, 'r', region_name, 'timeseries.json'),
+            json.dumps(jo),
+            opts.encodings)
+
+
+def render_region_offenses(opts, region_aggregates, region_name, region_path,
+                           **kwopts):
+    '''
+    Write per-offense aggregates for the region: /r/<region>/offenses.json,
+    with the region's offense dictionary and the number of crimes of each
+    offense per month, and a grid of each offense's crimes at
+    crimedb.www.GRID_BASE_ZOOM in /r/<region>/offense-grids/<code>.json.
+    '''
+
+    offenses = crimedb.offenses.read_offense_dictionary(
+            crimedb.offenses.offense_dictionary_path(region_path))
+    aggregators = region_aggregates[region_name]
+
+    jo = {
+        'offenses': offenses.descriptions,
+        'by_month': {
+            str(code): dict(a.counts)
+                for code, a in sorted(
+                    aggregators['by_month_by_offense'].offenses.items())},
+    }
+    crimedb.output.write_file(
+            os.path.join(opts.output_dir, 'r', region_name, 'offenses.json'),
+            json.dumps(jo, sort_keys=True),
+            opts.encodings)
+
+    grids_dir = os.path.join(
+            opts.output_dir, 'r', region_name, 'offense-grids')
+    written = set()
+    for code, a in aggregators['grid_by_offense'].offenses.items():
+        fn = '{}.json'.format(code)
+        crimedb.output.write_file(
+                os.path.join(grids_dir, fn),
+                json.dumps({
+                    'zoom': a.zoom,
+                    'grid': [
+                        [x, y, count]
+                            for x, ycounts in sorted(a.grid.items())
+                            for y, count in sorted(ycounts.items())],
+                }),
+                opts.encodings)
+        written.add(fn)
+
+    # Remove grids of offenses with no crimes in this render
+    if os.path.isdir(grids_dir):
+        for fn in os.listdir(grids_dir):
+            if fn.endswith('.json') and fn not in written:
+                crimedb.output.remove_file(os.path.join(grids_dir, fn))
+
+
+def render_region_boundary(opts, region_name, region_path, **kwopts):
+    '''
+    Write a simplified GeoJSON boundary of the region for use by clients.
+    '''
+
+    import shapely.geometry
+
+    region = crimedb.regions.region(region_name)
+    crimedb.output.write_file(
+            os.path.join(opts.output_dir, 'r', region_name, 'boundary.json'),
+            json.dumps(shapely.geometry.mapping(
+                region.boundary.variant('web'))),
+            opts.encodings)
+
+
+def render_region_templates(opts, region_name, region_path, **kwopts):
+    '''
+    Render files from the _templates/r/ directory
+    '''
+
+    import pystache
+    import shapely.geometry
+
+    # Create our pystache context object
+    ip = os.path.join(region_path, 'index.json')
+    with open(ip, 'rt', encoding='utf-8') as rf:
+        ro = json.load(rf)
+
+    rs = shapely.geometry.shape(ro['geo'])
+
+    context = {
+        'region': region_name,
+        'name': ro['name'],
+        'timeslice': 'from {} to {}'.format(
+                opts.time_from.strftime('%B %d, %Y'),
+                opts.time_to.strftime('%B %d, %Y')),
+        'source': ro['source'],
+        'center_lon': rs.centroid.x,
+        'center_lat': rs.centroid.y,
+    }
+
+    # Walk the template directory rendering any template files to the
+    # destination
+    template_path = os.path.join(opts.www_dir, '_templates', '_r')
+    for root, dirs, files in os.walk(template_path):
+        for fn in files:
+            if fn.startswith('.'):
+                continue
+
+            sp = os.path.join(root, fn)
+            __LOGGER.debug('loading template {}'.format(sp))
+            with open(sp, 'rt', encoding='utf-8') as sf:
+                source_data = sf.read()
+
+            rp = os.path.relpath(sp, template_path)
+            dp = os.path.join(opts.output_dir, 'r', region_name, rp)
+            crimedb.output.write_file(
+                    dp, pystache.render(source_data, context),
+                    opts.encodings)
+
+
+def render(data_dir, www_dir, output_dir, time_from, time_to,
+           incremental=False, previous_grid=None, state_file=None, jobs=None,
+           split_zoom=10, tile_formats=crimedb.tiles.DEFAULT_TILE_FORMATS,
+           tile_archive=False, encodings=()):
+    '''
+    Render the crimes in the given data directory that occurred within the
+    (inclusive) range [time_from, time_to] of datetime.datetime objects, along
+    with the files in the given www directory, to the given output directory,
+    returning the {x => {y => count}} grid that tiles were rendered from.
+
+    If incremental is set, the output directory is updated in place, and
+    only those tiles affected by changes to the grid since the last render
+    are re-written; this falls back to a full render if there is no previous
+    render, or it wrote tiles with different options. The grid of the last
+    render is read from the given state file (default: as per
+    default_state_file()), unless it's given. Tiles are rendered with up to
+    the given number of processes (default: the number of CPUs), in subtrees
+    rooted at the given zoom level, and written in the given formats, to
+    archives if tile_archive is set. Files are precompressed in the given
+    encodings as per crimedb.output.write_file().
+    '''
+
+    if state_file is None:
+        state_file = default_state_file(output_dir)
+
+    opts = types.SimpleNamespace(
+            data_dir=data_dir,
+            www_dir=www_dir,
+            output_dir=output_dir,
+            time_from=time_from,
+            time_to=time_to,
+            state_file=state_file,
+            jobs=jobs or os.cpu_count() or 1,
+            split_zoom=split_zoom,
+            tile_formats=tuple(tile_formats),
+            tile_archive=tile_archive,
+            encodings=tuple(encodings))
+
+    if incremental and not os.path.isdir(output_dir):
+        __LOGGER.warning('no previous render found; performing a full render')
+        incremental = False
+
+    # Only changed tiles are re-written, so changing how they're written
+    # requires a full render
+    if incremental and previous_grid is None:
+        if not os.path.isfile(state_file):
+            __LOGGER.warning(
+                    'no previous render found; performing a full render')
+            incremental = False
+        else:
+            previous_grid, previous_options = \
+                    crimedb.tiles.read_grid_state(state_file)
+            if set(previous_options['formats']) != set(opts.tile_formats) or \
+                    set(previous_options['encodings']) != \
+                        set(opts.encodings) or \
+                    previous_options['archive'] != opts.tile_archive:
+                __LOGGER.warning(
+                        'tile options changed since the previous render; '
+                        'performing a full render')
+                incremental = False
+
+    if not incremental:
+        previous_grid = None
+
+    # Clean out any old contents from the destination directory
+    if not incremental and os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+
+    # Symlink file in the www directory into the destination.
+    #
+    # By convention, ignore any directories that start with our special '_'
+    # prefix. We use this instead of the normal '.' so that these directories
+    # are more obviously visible via ls(1) and under source control.
+    static_paths = []
+    for dp, dnames, fnames in os.walk(www_dir, topdown=True):
+        # Strip paths prefixed with '_'
+        dnames[:] = [dn for dn in dnames if not dn.startswith('_')]
+        fnames[:] = [fn for fn in fnames if not fn.startswith('_')]
+
+        rd = os.path.relpath(dp, www_dir)
+        od = os.path.join(output_dir, rd)
+        sd = os.path.relpath(dp, od)
+
+        if not os.path.isdir(od):
+            os.makedirs(od)
+
+        for fn in fnames:
+            src = os.path.join(sd, fn)
+            dest = os.path.join(od, fn)
+            crimedb.output.symlink(src, dest)
+            static_paths += [dest]
+
+    # The precompressed copies of static files can't be symlinks, and so are
+    # written into the destination directory itself
+    crimedb.output.compress_files(static_paths, opts.encodings, opts.jobs)
+
+    region_aggregates = {}
+    call_per_region(
+            data_dir,
+            functools.partial(aggregate_region, opts, region_aggregates))
+
+    grid = render_grid(opts, region_aggregates, previous_grid)
+    render_global_templates(opts)
+    call_per_region(
+            data_dir,
+            functools.partial(
+                render_region_timeseries, opts, region_aggregates))
+    call_per_region(
+            data_dir,
+            functools.partial(
+                render_region_offenses, opts, region_aggregates))
+    call_per_region(
+            data_dir, functools.partial(render_region_boundary, opts))
+    call_per_region(
+            data_dir, functools.partial(render_region_templates, opts))
+
+    return grid
+
+
+class RenderTests(unittest.TestCase):
+    '''
+    Tests for rendering.
+    '''
+
+    def _files(self, output_dir):
+        files = {}
+        for dp, dnames, fnames in os.walk(output_dir):
+            for fn in fnames:
+                fp = os.path.join(dp, fn)
+                with open(fp, 'rb') as f:
+                    files[os.path.relpath(fp, output_dir)] = f.read()
+
+        return files
+
+    def test_render_incremental(self):
+        '''
+        Verify that an incremental render given the grid of the previous one
+        updates the output directory in place to match a full render.
+        '''
+
+        utc = datetime.timezone.utc
+
+        def crimes(n):
+            return [
+                crimedb.core.Crime(
+                    'crime {}'.format(i % 2),
+                    datetime.datetime(2014, 1 + i % 3, 1 + i % 28,
+                                      tzinfo=utc),
+                    (-90.25 + (i % 10) * 0.005, 38.63 + (i % 7) * 0.005))
+                for i in range(n)]
+
+        www_dir = os.path.join(
+                os.path.dirname(__file__), '..', '..', 'www')
+        time_from = datetime.datetime(2014, 1, 1, tzinfo=utc)
+        time_to = datetime.datetime(2014, 4, 1, tzinfo=utc)
+
+        with tempfile.TemporaryDirectory() as td:
+            data_dir = os.path.join(td, 'data')
+            region_dir = os.path.join(data_dir, 'stl')
+            os.makedirs(region_dir)
+            with open(os.path.join(region_dir, 'index.json'), 'wt') as mf:
+                json.dump({
+                    'name': 'stl',
+                    'source': 'test',
+                    'geo': {'type': 'Point', 'coordinates': [-90.25, 38.63]},
+                }, mf)
+
+            region = crimedb.regions.base.Region(
+                    'stl', os.path.join(td, 'work'))
+            region._clear_intermediate()
+            for c in crimes(30):
+                region._write_intermediate(c)
+            region._finish_intermediate()
+            crimedb.collate.collate_region(data_dir, region)
+
+            output_dir = os.path.join(td, 'out')
+            grid = render(
+                    data_dir, www_dir, output_dir, time_from, time_to, jobs=1)
+
+            region._append_intermediate()
+            for c in crimes(60)[30:]:
+                region._write_intermediate(c)
+            region._finish_intermediate()
+            crimedb.collate.collate_region(
+                    data_dir, region, since=region._first_written_month())
+
+            # The given grid is used rather than the saved one
+            os.unlink(default_state_file(output_dir))
+            marker_path = os.path.join(output_dir, 'marker')
+            with open(marker_path, 'wt'):
+                pass
+
+            render(
+                    data_dir, www_dir, output_dir, time_from, time_to,
+                    incremental=True, previous_grid=grid, jobs=1)
+            self.assertTrue(os.path.isfile(marker_path))
+            os.unlink(marker_path)
+
+            full_dir = os.path.join(td, 'full')
+            render(data_dir, www_dir, full_dir, time_from, time_to, jobs=1)
+            self.assertEqual(self._files(output_dir), self._files(full_dir))
@@ -0,0 +1,385 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Scheduling of recurring jobs for long-running processes such as bin/crimedbd.
+
+A job runs every so often, or whenever it's triggered. Jobs that fail are
+retried after a delay that doubles with each consecutive failure, up to a
+maximum. Delays are jittered so that jobs started together, or failing
+together because a source is down, don't keep running in lockstep.
+
+A Scheduler runs jobs as they fall due on a pool of threads that lasts as long
+as it does, and hands each job's result to a callback as soon as that job
+finishes, without waiting for any others.
+'''
+
+import concurrent.futures
+import datetime
+import logging
+import random
+import threading
+import time
+import unittest
+
+_LOGGER = logging.getLogger(__name__)
+
+# Fraction of a job's interval by which its runs are randomly delayed
+INTERVAL_JITTER = 0.1
+
+
+def retry_delay(failures, retry_interval, max_retry_interval,
+                rand=random.random):
+    '''
+    Return the number of seconds to wait before retrying a job that has
+    failed the given number of consecutive times. This is somewhere between
+    half of and all of the retry interval doubled for each failure after the
+    first, up to the maximum.
+    '''
+
+    delay = min(
+            max_retry_interval, retry_interval * 2 ** max(failures - 1, 0))
+    return delay / 2 + rand() * delay / 2
+
+
+def _isotime(t):
+    if t is None:
+        return None
+
+    return datetime.datetime.fromtimestamp(
+            t, datetime.timezone.utc).isoformat()
+
+
+class Job(object):
+    '''
+    A function run every interval seconds, starting as soon as the job is
+    created, or only when triggered if the interval is None.
+    '''
+
+    def __init__(self, name, func, interval=None, retry_interval=60,
+                 max_retry_interval=6 * 3600, clock=time.time,
+                 rand=random.random):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.clock = clock
+        self.rand = rand
+
+        self.next_time = clock() if interval is not None else None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_start = None
+        self.last_success = None
+        self.last_duration = None
+        self.last_error = None
+
+    def due(self, now):
+        '''
+        Return whether the job should be run at the given time.
+        '''
+
+        return self.next_time is not None and self.next_time <= now
+
+    def trigger(self):
+        '''
+        Make the job due now, unless it's waiting to retry a failure. If the
+        job is running, it runs again once it's finished.
+        '''
+
+        if self.failures:
+            return
+
+        self.next_time = self.clock()
+
+    def run(self):
+        '''
+        Run the job, returning the result of its function, or None if it
+        raised an exception, and schedule its next run.
+        '''
+
+        start = self.clock()
+        self.running = True
+        self.runs += 1
+        self.last_start = start
+
+        # Set again by trigger() while the job is running
+        self.next_time = None
+
+        try:
+            result = self.func()
+        except Exception as e:
+            self.failures += 1
+            self.last_error = '{}: {}'.format(type(e).__name__, e)
+            self.next_time = start + retry_delay(
+                    self.failures, self.retry_interval,
+                    self.max_retry_interval, self.rand)
+            _LOGGER.exception(
+                    'job {} failed {} time(s); retrying in {:.0f}s'.format(
+                        self.name, self.failures, self.next_time - start))
+            return None
+        finally:
+            self.running = False
+            self.last_duration = self.clock() - start
+
+        self.failures = 0
+        self.last_error = None
+        self.last_success = start
+        if self.interval is not None:
+            nt = start + self.interval * (1 + INTERVAL_JITTER * self.rand())
+            if self.next_time is None or nt < self.next_time:
+                self.next_time = nt
+
+        return result
+
+    def status(self):
+        '''
+        Return a JSON-serializable dictionary describing the state of the job.
+        '''
+
+        return {
+            'name': self.name,
+            'running': self.running,
+            'runs': self.runs,
+            'failures': self.failures,
+            'next_time': _isotime(self.next_time),
+            'last_start': _isotime(self.last_start),
+            'last_success': _isotime(self.last_success),
+            'last_duration': self.last_duration,
+            'last_error': self.last_error,
+        }
+
+
+def next_time(jobs):
+    '''
+    Return the earliest time at which any of the given Job objects is due, or
+    None if none of them are scheduled.
+    '''
+
+    times = [j.next_time for j in jobs if j.next_time is not None]
+    return min(times) if times else None
+
+
+class Scheduler(object):
+    '''
+    Runs the given Job objects on a pool of threads, one per job, as they fall
+    due. When a job finishes, the given function, if any, is called with it
+    and its result from the thread that ran it.
+    '''
+
+    def __init__(self, jobs, on_done=None):
+        self.jobs = list(jobs)
+        self.on_done = on_done
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.jobs))
+        self._lock = threading.Lock()
+        self._running = set()
+        self._finished = threading.Event()
+
+    def run_due(self, now=None):
+        '''
+        Start those jobs that are due at the given time (default: now) and
+        aren't already running, returning a list of their names.
+        '''
+
+        with self._lock:
+            due = [j for j in self.jobs
+                        if j.name not in self._running and
+                            j.due(j.clock() if now is None else now)]
+            self._running.update(j.name for j in due)
+
+        # Outside of the lock, as callbacks of jobs that have already
+        # finished are called right away
+        for j in due:
+            f = self._executor.submit(j.run)
+            f.add_done_callback(lambda f, j=j: self._done(j, f.result()))
+
+        return [j.name for j in due]
+
+    def _done(self, job, result):
+        try:
+            if self.on_done is not None:
+                self.on_done(job, result)
+        except Exception:
+            _LOGGER.exception(
+                    'handling the result of job {} failed'.format(job.name))
+        finally:
+            with self._lock:
+                self._running.discard(job.name)
+            self._finished.set()
+
+    def next_time(self):
+        '''
+        Return the earliest time at which any job that isn't running is due,
+        or None if none of them are scheduled.
+        '''
+
+        with self._lock:
+            return next_time(
+                    [j for j in self.jobs if j.name not in self._running])
+
+    def wait(self, timeout=None):
+        '''
+        Wait until a job finishes or the given number of seconds have passed,
+        returning whether a job finished.
+        '''
+
+        finished = self._finished.wait(timeout)
+        self._finished.clear()
+        return finished
+
+    def shutdown(self, wait=True):
+        '''
+        Stop starting jobs and, if requested, wait for running jobs to finish.
+        '''
+
+        self._executor.shutdown(wait=wait)
+
+
+class SchedulerTests(unittest.TestCase):
+    '''
+    Tests for job scheduling.
+    '''
+
+    def setUp(self):
+        self.now = 1000
+        self.results = []
+
+    def clock(self):
+        return self.now
+
+    def func(self):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def test_retry_delay(self):
+        '''
+        Verify that delays double with each failure, up to the maximum.
+        '''
+
+        self.assertEqual(
+                [retry_delay(f, 60, 600, lambda: 1) for f in range(1, 6)],
+                [60, 120, 240, 480, 600])
+        self.assertEqual(retry_delay(2, 60, 600, lambda: 0), 60)
+
+    def test_run(self):
+        '''
+        Verify that jobs are rescheduled after each run, retried with backoff
+        after failures, and only triggered when they're not being retried.
+        '''
+
+        job = Job('test', self.func, interval=3600, retry_interval=60,
+                  clock=self.clock, rand=lambda: 1)
+        self.assertTrue(job.due(self.now))
+
+        self.results = [True, RuntimeError('down'), RuntimeError('down'),
+                        False]
+        self.assertEqual(job.run(), True)
+        self.assertEqual(job.next_time, 1000 + 3960)
+        self.assertFalse(job.due(self.now))
+
+        self.now = job.next_time
+        with self.assertLogs(__name__, logging.ERROR):
+            self.assertIsNone(job.run())
+        self.assertEqual(job.next_time, self.now + 60)
+        self.assertEqual(job.status()['last_error'], 'RuntimeError: down')
+
+        job.trigger()
+        self.assertEqual(job.next_time, self.now + 60)
+
+        self.now += 60
+        with self.assertLogs(__name__, logging.ERROR):
+            self.assertIsNone(job.run())
+        self.assertEqual(job.next_time, self.now + 120)
+        self.assertEqual(job.status()['failures'], 2)
+
+        self.now += 120
+        self.assertEqual(job.run(), False)
+        self.assertEqual(job.status()['failures'], 0)
+        self.assertIsNone(job.status()['last_error'])
+
+    def test_triggered(self):
+        '''
+        Verify that jobs without an interval only run when triggered, and run
+        again if triggered while running.
+        '''
+
+        def func():
+            job.trigger()
+            return self.func()
+
+        job = Job('test', self.func, clock=self.clock)
+        self.results = [1, 2, 3]
+        self.assertFalse(job.due(self.now))
+
+        job.trigger()
+        self.assertEqual(job.run(), 1)
+        self.assertIsNone(next_time([job]))
+
+        self.now += 10
+        job.trigger()
+        self.assertEqual(next_time([job]), self.now)
+
+        job.func = func
+        self.assertEqual(job.run(), 2)
+        self.assertEqual(next_time([job]), self.now)
+
+    def test_scheduler(self):
+        '''
+        Verify that jobs are started as they fall due, that the result of each
+        is handled as soon as it finishes, and that running jobs aren't
+        started again.
+        '''
+
+        release = threading.Event()
+
+        def slow():
+            release.wait()
+            return 'slow'
+
+        done = []
+        slow_job = Job('slow', slow, interval=3600, clock=self.clock)
+        fast_job = Job('fast', lambda: 'fast', interval=3600,
+                       clock=self.clock, rand=lambda: 0)
+        later_job = Job('later', lambda: 'later', clock=self.clock)
+        scheduler = Scheduler(
+                [slow_job, fast_job, later_job],
+                on_done=lambda job, result: done.append((job.name, result)))
+        try:
+            self.assertEqual(scheduler.run_due(), ['slow', 'fast'])
+            self.assertTrue(scheduler.wait(10))
+            self.assertEqual(done, [('fast', 'fast')])
+
+            # The slow job is still running, so isn't started again or
+            # counted as due
+            slow_job.next_time = self.now
+            self.assertEqual(scheduler.next_time(), 1000 + 3600)
+            later_job.trigger()
+            self.assertEqual(scheduler.run_due(), ['later'])
+
+            release.set()
+            while len(done) < 3:
+                self.assertTrue(scheduler.wait(10))
+            self.assertEqual(
+                    sorted(done),
+                    [('fast', 'fast'), ('later', 'later'), ('slow', 'slow')])
+        finally:
+            release.set()
+            scheduler.shutdown()
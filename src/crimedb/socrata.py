@@ -20,6 +20,7 @@
 Utilities for interacting with Socrata datasets.
 '''
 
+import crimedb.timecodec
 import datetime
 import io
 import json
@@ -39,7 +40,7 @@ def floating_timestamp_to_datetime(ts, tz=None):
 
     d = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S')
     if tz:
-        d = tz.localize(d)
+        d = crimedb.timecodec.localize(d, tz)
 
     return d
 
@@ -49,19 +50,21 @@ def floating_timestamp_to_datetime(ts, tz=None):
 # incrementally parsed via ijson, but it's not available via MacPorts so punt
 # for now. We choose JSON here because it allows access to internal Socrata
 # fields which CSV does not.
-def dataset_rows(api_host, dataset_id, system_fields=False):
+def dataset_rows(api_url, dataset_id, system_fields=False):
     '''
-    Iterator for rows in the given dataset. Each row is a Python dictionary.
+    Iterator for rows in the given dataset, served by the API rooted at the
+    given URL, e.g. http://www.dallasopendata.com. Each row is a Python
+    dictionary.
     '''
 
     offset = 0
     while True:
         __LOGGER.debug('Fetching rows [{}, {}) from {}'.format(
                 offset, offset + __PAGESZ, dataset_id))
-        url = ('http://{host}/resource/{dataset_id}.json?'
+        url = ('{api_url}/resource/{dataset_id}.json?'
                '$offset={off}&$limit={lim}&$$exclude_system_fields={sys}').format(
-                host=api_host, dataset_id=dataset_id, off=offset, lim=__PAGESZ,
-                sys=not system_fields)
+                api_url=api_url, dataset_id=dataset_id, off=offset,
+                lim=__PAGESZ, sys=not system_fields)
         rows = json.load(io.TextIOWrapper(urllib.request.urlopen(url),
                                           encoding='utf-8',
                                           errors='replace'))
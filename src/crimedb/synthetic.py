@@ -0,0 +1,363 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Deterministic synthetic crime data, in the raw formats of each region's
+source, for benchmarking and testing.
+
+Incidents are spread uniformly over a time range and over a set of locations
+inside the region's real boundary; as in real data, many incidents share a
+location. A small fraction of incidents have no location. The same region,
+count and seed always produce the same incidents.
+
+Each region's raw records are produced in the format that its download()
+stores them in:
+
+    stl     monthly CSV files, as published by SLMPD
+    dallas  Socrata dataset rows
+    stlco   ArcGIS feature service features
+
+Records are generated lazily, so that any number can be written without
+holding them all in memory.
+'''
+
+from collections import namedtuple
+import calendar
+import crimedb.regions.boundary
+import csv
+import datetime
+import json
+import os.path
+import random
+import tempfile
+import unittest
+
+# Offense descriptions to draw from, with their relative frequencies
+OFFENSES = (
+    ('LARCENY-FROM MOTOR VEHICLE', 20),
+    ('LARCENY-ALL OTHER', 15),
+    ('BURGLARY-RESIDENCE/FORCE', 10),
+    ('AUTO THEFT-PASSENGER CAR', 10),
+    ('DESTRUCTION OF PROPERTY', 10),
+    ('ASSAULT-AGGRAVATED', 6),
+    ('ROBBERY-HIGHWAY', 5),
+    ('DRUG POSSESSION', 5),
+    ('LARCENY-SHOPLIFTING', 5),
+    ('BURGLARY-BUSINESS/FORCE', 4),
+    ('FRAUD-CREDIT CARD', 3),
+    ('WEAPONS-CARRYING CONCEALED', 3),
+    ('ROBBERY-BUSINESS', 2),
+    ('ARSON', 1),
+    ('HOMICIDE', 1),
+)
+
+# Fraction of incidents without a location
+NO_LOCATION_FRACTION = 0.02
+
+# Most distinct locations to spread incidents over
+MAX_LOCATIONS = 65536
+
+DEFAULT_TIME_FROM = datetime.datetime(2014, 1, 1)
+DEFAULT_TIME_TO = datetime.datetime(2015, 1, 1)
+
+# Columns of SLMPD CSV files
+STL_COLUMNS = (
+    'Complaint', 'CodedMonth', 'DateOccur', 'FlagCrime', 'FlagUnfounded',
+    'FlagAdministrative', 'Count', 'FlagCleanup', 'Crime', 'District',
+    'Description', 'ILEADSAddress', 'ILEADSStreet', 'Neighborhood',
+    'LocationName', 'LocationComment', 'CADAddress', 'CADStreet', 'XCoord',
+    'YCoord')
+
+Incident = namedtuple('Incident', ['index', 'description', 'time', 'location'])
+Incident.__doc__ = '''
+A synthetic incident: its index in the dataset, its description, its naive
+local time and its (lon, lat) location, or None.
+'''
+
+
+def _locations(region_name, count, rng):
+    '''
+    Return a list of count (lon, lat) tuples inside the boundary of the given
+    region.
+    '''
+
+    import shapely.geometry
+
+    boundary = crimedb.regions.boundary.boundary(region_name)
+    minx, miny, maxx, maxy = boundary.bbox
+
+    locations = []
+    while len(locations) < count:
+        loc = (rng.uniform(minx, maxx), rng.uniform(miny, maxy))
+        if boundary.contains(shapely.geometry.Point(*loc)):
+            locations.append(loc)
+
+    return locations
+
+
+def incidents(region_name, count, seed=0, time_from=DEFAULT_TIME_FROM,
+              time_to=DEFAULT_TIME_TO):
+    '''
+    Return an iterator of count Incident objects in the given region, at
+    times in the range [time_from, time_to) of naive local
+    datetime.datetime objects. Times are in no particular order.
+    '''
+
+    rng = random.Random('{}:{}'.format(region_name, seed))
+    locations = _locations(region_name, min(count, MAX_LOCATIONS), rng)
+    descriptions = [d for d, _ in OFFENSES]
+    weights = [w for _, w in OFFENSES]
+    span = int((time_to - time_from).total_seconds()) // 60
+
+    for i in range(count):
+        location = None
+        if rng.random() >= NO_LOCATION_FRACTION:
+            location = rng.choice(locations)
+
+        yield Incident(
+                i,
+                rng.choices(descriptions, weights)[0],
+                time_from + datetime.timedelta(minutes=rng.randrange(span)),
+                location)
+
+
+def _projected(incidents, proj):
+    '''
+    Yield (incident, (x, y)) tuples for the given incidents, projecting their
+    locations with the given pyproj.Proj, or (incident, None) if they have
+    no location.
+    '''
+
+    cache = {}
+    for inc in incidents:
+        xy = None
+        if inc.location is not None:
+            xy = cache.get(inc.location)
+            if xy is None:
+                xy = proj(*inc.location)
+                cache[inc.location] = xy
+
+        yield inc, xy
+
+
+def stl_rows(incidents):
+    '''
+    Return an iterator of (file name, row) tuples for the given stl
+    incidents, where the file name is that of the monthly CSV file that the
+    row is published in, and the row a dictionary keyed by STL_COLUMNS.
+    '''
+
+    import crimedb.regions.stl
+
+    codes = {d: 10000 + i for i, (d, _) in enumerate(OFFENSES)}
+    for inc, xy in _projected(incidents, crimedb.regions.stl._proj()):
+        t = inc.time
+        yield '{}{}.CSV'.format(calendar.month_name[t.month], t.year), {
+            'Complaint': '{}-{:06d}'.format(t.strftime('%y'), inc.index),
+            'CodedMonth': t.strftime('%Y-%m'),
+            'DateOccur': t.strftime('%m/%d/%Y %H:%M'),
+            'FlagCrime': 'Y',
+            'FlagUnfounded': '',
+            'FlagAdministrative': '',
+            'Count': '1',
+            'FlagCleanup': '',
+            'Crime': str(codes[inc.description]),
+            'District': str(1 + inc.index % 6),
+            'Description': inc.description,
+            'ILEADSAddress': '' if xy is None else str(inc.index % 9000),
+            'ILEADSStreet': '' if xy is None else 'MARKET ST',
+            'Neighborhood': str(1 + inc.index % 88),
+            'LocationName': '',
+            'LocationComment': '',
+            'CADAddress': '',
+            'CADStreet': '',
+            'XCoord': '0' if xy is None else '{:.2f}'.format(xy[0]),
+            'YCoord': '0' if xy is None else '{:.2f}'.format(xy[1]),
+        }
+
+
+def write_stl_files(dir_path, incidents):
+    '''
+    Write the given stl incidents to monthly CSV files in the given directory,
+    as stl's download() does, returning their paths.
+    '''
+
+    files = {}
+    try:
+        for file_name, row in stl_rows(incidents):
+            if file_name not in files:
+                f = open(
+                        os.path.join(dir_path, file_name), 'wt',
+                        encoding='utf-8', newline='')
+                w = csv.DictWriter(f, STL_COLUMNS)
+                w.writeheader()
+                files[file_name] = (f, w)
+
+            files[file_name][1].writerow(row)
+    finally:
+        for f, _ in files.values():
+            f.close()
+
+    return sorted(os.path.join(dir_path, fn) for fn in files)
+
+
+def dallas_rows(incidents):
+    '''
+    Return an iterator of Socrata dataset rows for the given dallas
+    incidents.
+    '''
+
+    import crimedb.regions.dallas
+
+    for inc, xy in _projected(incidents, crimedb.regions.dallas._proj()):
+        row = {
+            'servicenum': '{:06d}-{}'.format(inc.index, inc.time.year),
+            'startdatetime': inc.time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'offincident': inc.description,
+        }
+        if xy is not None:
+            row['pointx'] = '{:.2f}'.format(xy[0])
+            row['pointy'] = '{:.2f}'.format(xy[1])
+
+        yield row
+
+
+def stlco_features(incidents):
+    '''
+    Return an iterator of ArcGIS features for the given stlco incidents.
+
+    Every real feature has a location, so incidents without one are placed at
+    the origin, which is outside of the region.
+    '''
+
+    import crimedb.regions.stlco
+
+    tz = crimedb.regions.stlco._tz()
+    for inc, xy in _projected(incidents, crimedb.regions.stlco._proj()):
+        if xy is None:
+            xy = (0, 0)
+
+        yield {
+            'attributes': {
+                'GlobalID': '{{{:08X}-0000-4000-8000-{:012X}}}'.format(
+                    inc.index >> 32, inc.index),
+                'Date': int(tz.localize(inc.time).timestamp()) * 1000,
+                'Offense': inc.description,
+            },
+            'geometry': {'x': xy[0], 'y': xy[1]},
+        }
+
+
+# Map of region names to functions returning an iterator of raw records for
+# incidents in that region; stl's records are (file name, row) tuples
+RECORDS = {
+    'dallas': dallas_rows,
+    'stl': stl_rows,
+    'stlco': stlco_features,
+}
+
+
+def write_jsonl(path, records):
+    '''
+    Write the given iterable of records to the given file as JSON lines,
+    returning the number written.
+    '''
+
+    n = 0
+    with open(path, 'wt', encoding='utf-8') as f:
+        for r in records:
+            f.write(json.dumps(r))
+            f.write('\n')
+            n += 1
+
+    return n
+
+
+def write_region_raw(region, count, seed=0, time_from=DEFAULT_TIME_FROM,
+                     time_to=DEFAULT_TIME_TO):
+    '''
+    Generate count incidents for the given crimedb.regions.base.Region and
+    store them in its cache directory in the same way that its download()
+    would, so that they're picked up by process().
+    '''
+
+    incs = incidents(region.name, count, seed, time_from, time_to)
+    if region.name == 'stl':
+        write_stl_files(region._cache_dir(), incs)
+        return
+
+    # Regions store their records in a raw log, which imports JSON lines left
+    # in place of the log by earlier versions
+    path = os.path.join(region._cache_dir(), 'incidents')
+    write_jsonl(path, RECORDS[region.name](incs))
+    region._incidents_log()
+
+
+class SyntheticTests(unittest.TestCase):
+    '''
+    Tests for synthetic data.
+    '''
+
+    def test_incidents(self):
+        '''
+        Verify that incidents are deterministic, and within their boundary
+        and time range.
+        '''
+
+        import shapely.geometry
+
+        a = list(incidents('stl', 200, seed=1))
+        self.assertEqual(a, list(incidents('stl', 200, seed=1)))
+        self.assertNotEqual(a, list(incidents('stl', 200, seed=2)))
+
+        boundary = crimedb.regions.boundary.boundary('stl')
+        for inc in a:
+            self.assertTrue(
+                    DEFAULT_TIME_FROM <= inc.time < DEFAULT_TIME_TO)
+            if inc.location:
+                self.assertTrue(boundary.contains(
+                        shapely.geometry.Point(*inc.location)))
+
+    def test_processed(self):
+        '''
+        Verify that each region processes its synthetic records into the
+        incidents that they were generated from.
+        '''
+
+        import crimedb.regions
+
+        for rn in crimedb.regions.region_names():
+            with tempfile.TemporaryDirectory() as td:
+                region = crimedb.regions.region(rn, td)
+                write_region_raw(region, 300)
+                region.process()
+
+                def key(description, time, location):
+                    return description, time.replace(tzinfo=None), \
+                            location or ()
+
+                expected = sorted(
+                        key(i.description, i.time, i.location)
+                            for i in incidents(rn, 300))
+                actual = sorted(
+                        key(c.description, c.time, c.location)
+                            for c in region.crimes())
+
+                # Locations don't survive projection exactly
+                self.assertEqual(len(actual), len(expected))
+                for a, e in zip(actual, expected):
+                    self.assertEqual(a[0:2], e[0:2], rn)
+                    self.assertEqual(len(a[2]), len(e[2]), rn)
+                    for av, ev in zip(a[2], e[2]):
+                        self.assertAlmostEqual(av, ev, places=6)
@@ -0,0 +1,325 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Single-file SQLite archives of grid tiles.
+
+Archives use the MBTiles schema (https://github.com/mapbox/mbtiles-spec): tiles
+are mapped by (zoom_level, tile_column, tile_row) to a tile_id, the SHA-1 of
+their contents, so identical tiles (e.g. the many containing a single cell of
+count 0) are stored only once. As per the spec, tile_row counts from the south
+rather than the north as Slippy tile coordinates do; the methods here all take
+Slippy tile coordinates.
+
+An archive can be written by several processes at once. Writes are buffered
+and applied in a single short transaction by flush(), and readers do not block
+writers. Servers should open archives read-only, so that they never write to
+them and can share one archive between threads.
+'''
+
+import hashlib
+import logging
+import os.path
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib.parse
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds to wait for another process writing the archive to finish
+_BUSY_TIMEOUT = 600
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS map (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_id TEXT,
+    PRIMARY KEY (zoom_level, tile_column, tile_row)
+);
+CREATE TABLE IF NOT EXISTS images (
+    tile_id TEXT PRIMARY KEY,
+    tile_data BLOB
+);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT
+        map.zoom_level AS zoom_level,
+        map.tile_column AS tile_column,
+        map.tile_row AS tile_row,
+        images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+'''
+
+
+def _tile_row(z, y):
+    '''
+    Convert between Slippy tile y coordinates and MBTiles tile_row values;
+    the conversion is its own inverse.
+    '''
+
+    return 2 ** z - 1 - y
+
+
+class TileArchive(object):
+    '''
+    A tile archive at the given path, which is created if it does not exist.
+
+    The metadata dictionary, if given, is stored in the archive's metadata
+    table.
+
+    If read_only is set, the archive must already exist, and is opened
+    without writing anything to it, so that it can be read while another
+    process writes it. Read-only archives can only be read from, but may be
+    read from any thread.
+    '''
+
+    def __init__(self, path, metadata={}, read_only=False):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if read_only:
+            self._conn = sqlite3.connect(
+                    'file:{}?mode=ro'.format(urllib.parse.quote(path)),
+                    uri=True, timeout=_BUSY_TIMEOUT, isolation_level=None,
+                    check_same_thread=False)
+            self._writes = {}
+            self._removes = set()
+            return
+
+        self._conn = sqlite3.connect(
+                path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+        if metadata:
+            self._conn.executemany(
+                    'INSERT OR REPLACE INTO metadata (name, value) '
+                    'VALUES (?, ?)',
+                    [(k, str(v)) for k, v in metadata.items()])
+
+        self._writes = {}
+        self._removes = set()
+
+    def read_tile(self, z, x, y):
+        '''
+        Return the contents of the given tile, or None if it does not exist.
+        '''
+
+        with self._lock:
+            row = self._conn.execute(
+                    'SELECT tile_data FROM tiles '
+                    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                    (z, x, _tile_row(z, y))).fetchone()
+
+        return row[0] if row else None
+
+    def _tile_id(self, z, x, y):
+        row = self._conn.execute(
+                'SELECT tile_id FROM map '
+                'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (z, x, _tile_row(z, y))).fetchone()
+
+        return row[0] if row else None
+
+    def write_tile(self, z, x, y, data):
+        '''
+        Set the contents of the given tile to the given bytes or string
+        (encoded as UTF-8) at the next flush().
+
+        Returns True if the tile will be written, or False if it already had
+        exactly the given contents.
+        '''
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        tile_id = hashlib.sha1(data).hexdigest()
+        self._removes.discard((z, x, y))
+        if self._tile_id(z, x, y) == tile_id:
+            self._writes.pop((z, x, y), None)
+            return False
+
+        self._writes[(z, x, y)] = (tile_id, data)
+        return True
+
+    def remove_tile(self, z, x, y):
+        '''
+        Remove the given tile at the next flush().
+
+        Returns True if the tile will be removed.
+        '''
+
+        self._writes.pop((z, x, y), None)
+        if self._tile_id(z, x, y) is None:
+            return False
+
+        self._removes.add((z, x, y))
+        return True
+
+    def flush(self):
+        '''
+        Apply all buffered writes and removals in a single transaction.
+        '''
+
+        if not self._writes and not self._removes:
+            return
+
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.executemany(
+                    'INSERT OR IGNORE INTO images (tile_id, tile_data) '
+                    'VALUES (?, ?)',
+                    list(self._writes.values()))
+            self._conn.executemany(
+                    'INSERT OR REPLACE INTO map '
+                    '(zoom_level, tile_column, tile_row, tile_id) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(z, x, _tile_row(z, y), tile_id)
+                        for (z, x, y), (tile_id, _) in self._writes.items()])
+            self._conn.executemany(
+                    'DELETE FROM map '
+                    'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                    [(z, x, _tile_row(z, y)) for z, x, y in self._removes])
+
+        _LOGGER.debug('wrote {} tiles and removed {} tiles in {}'.format(
+                len(self._writes), len(self._removes), self.path))
+
+        self._writes = {}
+        self._removes = set()
+
+    def prune(self):
+        '''
+        Delete tile contents no longer referenced by any tile. This should be
+        done once all processes writing to the archive are finished.
+        '''
+
+        self.flush()
+        with self._conn:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute(
+                    'DELETE FROM images '
+                    'WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+
+    def tiles(self):
+        '''
+        Return a generator of (z, x, y) tuples of all tiles in the archive.
+        '''
+
+        for z, x, row in self._conn.execute(
+                'SELECT zoom_level, tile_column, tile_row FROM map'):
+            yield z, x, _tile_row(z, row)
+
+    def close(self):
+        '''
+        Flush any buffered writes and close the archive.
+        '''
+
+        self.flush()
+        self._conn.close()
+
+
+class TileArchiveTests(unittest.TestCase):
+    '''
+    Tests for TileArchive.
+    '''
+
+    def test_tile_archive(self):
+        '''
+        Verify that tiles can be written, read and removed, and that identical
+        tiles share storage.
+        '''
+
+        with tempfile.TemporaryDirectory() as td:
+            ap = os.path.join(td, 'tiles.mbtiles')
+            ta = TileArchive(ap, {'name': 'test', 'format': 'json'})
+            self.assertTrue(ta.write_tile(1, 0, 0, '[1]'))
+            self.assertTrue(ta.write_tile(1, 1, 0, '[1]'))
+            self.assertTrue(ta.write_tile(2, 3, 0, b'[2]'))
+            self.assertTrue(ta.write_tile(2, 3, 3, b'[3]'))
+            ta.close()
+
+            ta = TileArchive(ap)
+            self.assertEqual(ta.read_tile(1, 0, 0), b'[1]')
+            self.assertEqual(ta.read_tile(1, 1, 0), b'[1]')
+            self.assertEqual(ta.read_tile(2, 3, 0), b'[2]')
+            self.assertEqual(ta.read_tile(2, 3, 3), b'[3]')
+            self.assertIsNone(ta.read_tile(2, 0, 0))
+            self.assertEqual(
+                    ta._conn.execute('SELECT COUNT(*) FROM images').fetchone(),
+                    (3,))
+
+            # Rows count from the south
+            self.assertEqual(
+                    ta._conn.execute(
+                        'SELECT tile_row FROM map '
+                        'WHERE zoom_level = 2 AND tile_id = ?',
+                        (hashlib.sha1(b'[2]').hexdigest(),)).fetchone(),
+                    (3,))
+
+            self.assertFalse(ta.write_tile(1, 0, 0, '[1]'))
+            self.assertTrue(ta.remove_tile(2, 3, 3))
+            self.assertFalse(ta.remove_tile(2, 0, 0))
+            self.assertTrue(ta.write_tile(2, 3, 0, b'[1]'))
+            ta.prune()
+
+            self.assertEqual(
+                    sorted(ta.tiles()), [(1, 0, 0), (1, 1, 0), (2, 3, 0)])
+            self.assertEqual(ta.read_tile(2, 3, 0), b'[1]')
+            self.assertEqual(
+                    ta._conn.execute('SELECT COUNT(*) FROM images').fetchone(),
+                    (1,))
+            self.assertEqual(
+                    dict(ta._conn.execute('SELECT * FROM metadata')),
+                    {'name': 'test', 'format': 'json'})
+            ta.close()
+
+    def test_read_only(self):
+        '''
+        Verify that read-only archives see tiles written by others, can be
+        read from other threads, and can't be written.
+        '''
+
+        with tempfile.TemporaryDirectory() as td:
+            ap = os.path.join(td, 'tiles.mbtiles')
+            with self.assertRaises(sqlite3.OperationalError):
+                TileArchive(ap, read_only=True)
+
+            ta = TileArchive(ap)
+            ta.write_tile(1, 0, 0, '[1]')
+            ta.flush()
+
+            ro = TileArchive(ap, read_only=True)
+            self.assertEqual(ro.read_tile(1, 0, 0), b'[1]')
+
+            ta.write_tile(1, 1, 0, '[2]')
+            ta.flush()
+            results = []
+            t = threading.Thread(
+                    target=lambda: results.append(ro.read_tile(1, 1, 0)))
+            t.start()
+            t.join()
+            self.assertEqual(results, [b'[2]'])
+
+            ro.write_tile(2, 0, 0, '[3]')
+            with self.assertRaises(sqlite3.OperationalError):
+                ro.flush()
+
+            ro._conn.close()
+            ta.close()
@@ -0,0 +1,839 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Writing of the grid-data/<z>/<x>/<y>.<ext> tiles consumed by the LeafletJS
+plugin.
+
+Each tile can be written in any of the formats in TILE_FORMATS: GeoJSON, which
+any client can consume, and a much more compact binary encoding (see
+crimedb.www.rzgrid_to_binary()). Rather than as individual files, tiles can
+also be written to a single tile archive per format (see crimedb.tilearchive),
+which bin/tileserver can serve.
+
+Tiles are computed from an rzgrid (see crimedb.www.rzgrid_from_zgrid()). To
+support incremental rendering, the base grid from which a set of tiles was
+computed can be saved, and the tiles affected by the differences between it
+and a new base grid determined with dirty_tiles().
+
+Alongside the tiles, write_breakpoints() records the percentiles of the cell
+counts shown at each zoom level in grid-data/breakpoints.json, so that clients
+can color cells consistently without sorting every cell that they've fetched.
+
+To cut the number of requests that clients make, binary tiles are also
+grouped into bundles of 2 ** BUNDLE_ZOOM_DEPTH by 2 ** BUNDLE_ZOOM_DEPTH tiles
+("metatiles") at grid-bundles/<z>/<x>/<y>.bin, where (x, y) are the metatile
+coordinates, i.e. those of its tiles shifted right by BUNDLE_ZOOM_DEPTH. See
+tile_bundle() for their format.
+
+Rendering of the tile pyramid can be spread across multiple processes by
+render_tiles(). The pyramid is split into the independent subtrees rooted at
+each tile of a given zoom level; each is rendered by a worker given only its
+slice of the base grid. Tiles above that zoom level are rendered by the parent
+process from the coarsest few levels of each subtree.
+'''
+
+from collections import defaultdict
+import crimedb.output
+import crimedb.tilearchive
+import crimedb.www
+from functools import partial
+import json
+import logging
+import multiprocessing
+import os.path
+import struct
+import tempfile
+import unittest
+
+__LOGGER = logging.getLogger(__name__)
+
+
+def _tile_to_geojson(rzgrid, x, y, z, zoom_depth):
+    return json.dumps(crimedb.www.rzgrid_to_geojson(rzgrid, x, y, z, zoom_depth))
+
+
+# Map of tile format names to (file extension, encoder) tuples. Encoders have
+# the same signature as crimedb.www.rzgrid_to_geojson().
+TILE_FORMATS = {
+    'binary': ('.bin', crimedb.www.rzgrid_to_binary),
+    'geojson': ('.json', _tile_to_geojson),
+}
+
+# Formats written by default
+DEFAULT_TILE_FORMATS = ('binary', 'geojson')
+
+# Bundles are 2 ** BUNDLE_ZOOM_DEPTH tiles on a side
+BUNDLE_ZOOM_DEPTH = 2
+
+# Version of the bundle format written by tile_bundle()
+BUNDLE_VERSION = 1
+
+# Percentiles of cell counts recorded by write_breakpoints(); these are the
+# boundaries of the color buckets used by crimedb-leaflet.js
+GRID_PERCENTILES = (0.0, 0.10, 0.25, 0.50, 0.75, 0.90, 0.95, 0.99, 1.0)
+
+
+def tile_path(output_dir, z, x, y, fmt='geojson'):
+    '''
+    Return the path of the given tile in the output directory.
+    '''
+
+    return os.path.join(
+            output_dir, 'grid-data', str(z), str(x),
+            '{}{}'.format(y, TILE_FORMATS[fmt][0]))
+
+
+def tile_archive_path(output_dir, fmt='geojson'):
+    '''
+    Return the path of the archive of tiles in the given format in the output
+    directory.
+    '''
+
+    return os.path.join(
+            output_dir, 'grid-data{}.mbtiles'.format(TILE_FORMATS[fmt][0]))
+
+
+def bundle_path(output_dir, z, x, y):
+    '''
+    Return the path of the bundle for the given metatile in the output
+    directory.
+    '''
+
+    return os.path.join(
+            output_dir, 'grid-bundles', str(z), str(x), '{}.bin'.format(y))
+
+
+def encode_tile(cells, z, x, y, fmt='geojson',
+                zoom_depth=crimedb.www.GRID_CELL_ZOOM_DEPTH):
+    '''
+    Return the bytes of the given tile in the given format, with the cells
+    of the given {xx => {yy => count}} grid, where (xx, yy) are the
+    coordinates of each cell within the tile. This is the same as the tile
+    written by write_tiles() for an rzgrid with those cells.
+    '''
+
+    rzgrid = defaultdict(
+            partial(defaultdict,
+                partial(defaultdict,
+                    partial(defaultdict,
+                        partial(defaultdict, int)))))
+    for xx, ycounts in cells.items():
+        for yy, count in ycounts.items():
+            rzgrid[z][x][y][xx][yy] = count
+
+    data = TILE_FORMATS[fmt][1](rzgrid, x, y, z, zoom_depth)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    return data
+
+
+class _TileFiles(object):
+    '''
+    Writes tiles to individual files in the output directory.
+    '''
+
+    def __init__(self, output_dir, encodings):
+        self.output_dir = output_dir
+        self.encodings = encodings
+
+    def write_tile(self, fmt, z, x, y, data):
+        return crimedb.output.write_file(
+                tile_path(self.output_dir, z, x, y, fmt), data, self.encodings)
+
+    def remove_tile(self, fmt, z, x, y):
+        return crimedb.output.remove_file(
+                tile_path(self.output_dir, z, x, y, fmt))
+
+    def close(self):
+        pass
+
+
+class _TileArchives(object):
+    '''
+    Writes tiles to the archive for their format in the output directory.
+    Archives are opened as needed; only those for formats being written are
+    created.
+    '''
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self._archives = {}
+
+    def _archive(self, fmt, create):
+        if fmt not in self._archives:
+            ap = tile_archive_path(self.output_dir, fmt)
+            if not create and not os.path.isfile(ap):
+                return None
+
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._archives[fmt] = crimedb.tilearchive.TileArchive(ap)
+
+        return self._archives[fmt]
+
+    def write_tile(self, fmt, z, x, y, data):
+        return self._archive(fmt, True).write_tile(z, x, y, data)
+
+    def remove_tile(self, fmt, z, x, y):
+        ta = self._archive(fmt, False)
+        return ta.remove_tile(z, x, y) if ta else False
+
+    def close(self):
+        for ta in self._archives.values():
+            ta.close()
+
+
+def dirty_tiles(old_grid, new_grid, base_zoom, max_zoom):
+    '''
+    Return a {z => set((x, y))} dictionary of the tiles at zoom levels
+    [0, max_zoom] whose contents are affected by the differences between the
+    two given {x => {y => count}} grids at base_zoom.
+
+    A cell present in only one grid is considered to have changed even if its
+    count is 0, as empty cells are still rendered.
+    '''
+
+    changed = set()
+    for g1, g2 in [(old_grid, new_grid), (new_grid, old_grid)]:
+        for x, ycounts in g1.items():
+            for y, count in ycounts.items():
+                if x not in g2 or y not in g2[x] or g2[x][y] != count:
+                    changed.add((x, y))
+
+    tiles = defaultdict(set)
+    for z in range(0, max_zoom + 1):
+        shift = base_zoom - z
+        for x, y in changed:
+            tiles[z].add((x >> shift, y >> shift))
+
+    return tiles
+
+
+def write_tiles(output_dir, rzgrid, zoom_depth, tiles=None,
+                formats=DEFAULT_TILE_FORMATS, encodings=(), archive=False):
+    '''
+    Write tiles in each of the given formats for the given rzgrid to the
+    output directory, precompressed in the given encodings as per
+    crimedb.output.write_file(). If archive is True, tiles are written to tile
+    archives rather than individual files, and are not precompressed.
+
+    If a {z => set((x, y))} dictionary of tiles is given, only those tiles are
+    written, and any of them that are no longer present in the rzgrid are
+    removed.
+
+    Returns a (written, removed) tuple of the number of tile files affected.
+    '''
+
+    if archive:
+        writer = _TileArchives(output_dir)
+    else:
+        writer = _TileFiles(output_dir, encodings)
+
+    if tiles is None:
+        tiles = {
+            z: [(x, y) for x, ygrids in xgrids.items() for y in ygrids]
+                for z, xgrids in rzgrid.items()}
+
+    written = 0
+    removed = 0
+    for z, xys in tiles.items():
+        for x, y in xys:
+            # Stale tiles are removed in every format, not just the ones that
+            # we're writing, so that we don't leave behind tiles in formats
+            # that we've stopped producing
+            if x not in rzgrid[z] or y not in rzgrid[z][x]:
+                for fmt in TILE_FORMATS:
+                    removed += writer.remove_tile(fmt, z, x, y)
+                continue
+
+            for fmt in formats:
+                written += writer.write_tile(
+                        fmt, z, x, y,
+                        TILE_FORMATS[fmt][1](rzgrid, x, y, z, zoom_depth))
+
+    writer.close()
+
+    __LOGGER.debug('wrote {} tiles and removed {} tiles'.format(
+            written, removed))
+
+    return written, removed
+
+
+def _render_subtree(job):
+    '''
+    Render all tiles in the subtree of the pyramid rooted at zoom level
+    split_zoom that is covered by the given grid, returning the zgrid levels
+    needed to render the tiles above it along with the results of
+    write_tiles().
+
+    This takes a single tuple argument so that it can be used with
+    multiprocessing.Pool.imap_unordered().
+    '''
+
+    output_dir, grid, tiles, base_zoom, split_zoom, zoom_depth, options = job
+
+    zgrid = crimedb.www.zgrid_from_grid(grid, base_zoom, split_zoom)
+    rzgrid = crimedb.www.rzgrid_from_zgrid(zgrid, zoom_depth, split_zoom)
+    written, removed = write_tiles(
+            output_dir, rzgrid, zoom_depth, tiles, **options)
+
+    return {
+        z: {x: dict(ycounts) for x, ycounts in zgrid[z].items()}
+            for z in range(split_zoom, split_zoom + zoom_depth)}, \
+        written, removed
+
+
+def render_tiles(output_dir, grid, tiles=None,
+                 base_zoom=crimedb.www.GRID_BASE_ZOOM,
+                 zoom_depth=crimedb.www.GRID_CELL_ZOOM_DEPTH,
+                 split_zoom=10, jobs=1, formats=DEFAULT_TILE_FORMATS,
+                 encodings=(), archive=False):
+    '''
+    Compute and write the tile pyramid for the given {x => {y => count}} grid
+    at base_zoom in each of the given formats and encodings, using up to the
+    given number of worker processes. Tiles are written to archives if archive
+    is True.
+
+    If a {z => set((x, y))} dictionary of tiles is given, only those tiles are
+    written as per write_tiles().
+    '''
+
+    max_zoom = base_zoom - zoom_depth
+    assert 0 <= split_zoom <= max_zoom
+
+    # Partition the grid and set of tiles to write by the subtree containing
+    # them. Subtrees with tiles to write but no cells are still rendered so
+    # that their stale tiles get removed.
+    options = {'formats': formats, 'encodings': encodings, 'archive': archive}
+
+    shift = base_zoom - split_zoom
+    subtree_grids = defaultdict(partial(defaultdict, dict))
+    for x, ycounts in grid.items():
+        for y, count in ycounts.items():
+            subtree_grids[(x >> shift, y >> shift)][x][y] = count
+
+    subtree_tiles = None
+    if tiles is not None:
+        subtree_tiles = defaultdict(partial(defaultdict, set))
+        for z, xys in tiles.items():
+            if z < split_zoom:
+                continue
+
+            for x, y in xys:
+                st = (x >> (z - split_zoom), y >> (z - split_zoom))
+                subtree_tiles[st][z].add((x, y))
+                subtree_grids[st]
+
+    jobs_args = [
+        (output_dir, g,
+         subtree_tiles[st] if subtree_tiles is not None else None,
+         base_zoom, split_zoom, zoom_depth, options)
+            for st, g in subtree_grids.items()]
+
+    # Create archives up front, rather than racing to do so in each worker
+    if archive:
+        for fmt in formats:
+            os.makedirs(output_dir, exist_ok=True)
+            crimedb.tilearchive.TileArchive(
+                    tile_archive_path(output_dir, fmt),
+                    {
+                        'name': 'crimedb',
+                        'type': 'overlay',
+                        'version': 1,
+                        'format': TILE_FORMATS[fmt][0][1:],
+                        'minzoom': 0,
+                        'maxzoom': max_zoom,
+                    }).close()
+
+    __LOGGER.info('rendering {} subtrees at zoom {} with {} jobs'.format(
+            len(jobs_args), split_zoom, jobs))
+
+    # Merge the coarsest levels of each subtree so that we can render the
+    # tiles above them
+    zgrid = defaultdict(partial(defaultdict, partial(defaultdict, int)))
+    for z in range(split_zoom, split_zoom + zoom_depth):
+        zgrid[z]
+
+    counts = [0, 0]
+
+    def merge_subtree(result):
+        subtree_zgrid, written, removed = result
+        for z, xgrids in subtree_zgrid.items():
+            for x, ycounts in xgrids.items():
+                zgrid[z][x].update(ycounts)
+
+        counts[0] += written
+        counts[1] += removed
+
+    if jobs > 1 and len(jobs_args) > 1:
+        # Our bin/ scripts are not importable, so we must fork rather than
+        # spawn worker processes, which would re-execute them
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(jobs) as pool:
+            for result in pool.imap_unordered(_render_subtree, jobs_args):
+                merge_subtree(result)
+    else:
+        for ja in jobs_args:
+            merge_subtree(_render_subtree(ja))
+
+    if split_zoom > 0:
+        for z, xgrids in crimedb.www.zgrid_from_grid(
+                zgrid[split_zoom], split_zoom, 0).items():
+            zgrid[z] = xgrids
+
+        coarse_tiles = None
+        if tiles is not None:
+            coarse_tiles = {
+                z: xys for z, xys in tiles.items() if z < split_zoom}
+
+        written, removed = write_tiles(
+                output_dir,
+                crimedb.www.rzgrid_from_zgrid(zgrid, zoom_depth),
+                zoom_depth,
+                coarse_tiles,
+                **options)
+        counts[0] += written
+        counts[1] += removed
+
+    # Tiles removed or replaced by workers may have left unused contents
+    # behind in archives
+    if archive:
+        for fmt in TILE_FORMATS:
+            ap = tile_archive_path(output_dir, fmt)
+            if os.path.isfile(ap):
+                ta = crimedb.tilearchive.TileArchive(ap)
+                ta.prune()
+                ta.close()
+
+    __LOGGER.info('wrote {} tiles and removed {} tiles'.format(*counts))
+
+
+def tile_bundle(read_tile, z, x, y, depth=BUNDLE_ZOOM_DEPTH):
+    '''
+    Return the bundle for the given metatile of binary tiles, or None if it
+    contains no tiles. The read_tile(z, x, y) callable returns the contents of
+    the given tile, or None if it does not exist.
+
+    A bundle consists of
+
+      - a BUNDLE_VERSION byte
+      - a depth byte
+      - a zoom byte
+      - the metatile's x and y as little-endian 32-bit integers
+      - an index of (2 ** depth) ** 2 + 1 offsets as little-endian 32-bit
+        integers, relative to the end of the index; tile (xx, yy) within the
+        metatile is the data between offsets yy * 2 ** depth + xx and the one
+        following it, and is absent if these are equal
+      - the tiles' data
+    '''
+
+    side = 2 ** depth
+    offsets = [0]
+    tiles = []
+    for yy in range(0, side):
+        for xx in range(0, side):
+            data = read_tile(z, (x << depth) + xx, (y << depth) + yy) or b''
+            offsets += [offsets[-1] + len(data)]
+            tiles += [data]
+
+    if offsets[-1] == 0:
+        return None
+
+    return struct.pack('<BBBII', BUNDLE_VERSION, depth, z, x, y) + \
+            struct.pack('<{}I'.format(len(offsets)), *offsets) + \
+            b''.join(tiles)
+
+
+def write_bundles(output_dir, tiles=None, encodings=(),
+                  depth=BUNDLE_ZOOM_DEPTH):
+    '''
+    Write bundles of the binary tile files in the output directory,
+    precompressed in the given encodings.
+
+    If a {z => set((x, y))} dictionary of tiles is given, only the bundles
+    containing them are written, and those that no longer contain any tiles
+    are removed. Otherwise a bundle is written for every metatile with a tile
+    in the output directory.
+
+    Returns a (written, removed) tuple of the number of bundles affected.
+    '''
+
+    if tiles is None:
+        tiles = defaultdict(set)
+        grid_dir = os.path.join(output_dir, 'grid-data')
+        ext = TILE_FORMATS['binary'][0]
+        for dp, _, fnames in os.walk(grid_dir):
+            rd = os.path.relpath(dp, grid_dir).split(os.sep)
+            if len(rd) != 2:
+                continue
+
+            z, x = (int(v) for v in rd)
+            for fn in fnames:
+                if fn.endswith(ext):
+                    tiles[z].add((x, int(fn[:-len(ext)])))
+
+    def read_tile(z, x, y):
+        tp = tile_path(output_dir, z, x, y, 'binary')
+        if not os.path.isfile(tp):
+            return None
+
+        with open(tp, 'rb') as tf:
+            return tf.read()
+
+    written = 0
+    removed = 0
+    for z, xys in tiles.items():
+        for x, y in {(x >> depth, y >> depth) for x, y in xys}:
+            bp = bundle_path(output_dir, z, x, y)
+            bundle = tile_bundle(read_tile, z, x, y, depth)
+            if bundle is None:
+                removed += crimedb.output.remove_file(bp)
+            else:
+                written += crimedb.output.write_file(bp, bundle, encodings)
+
+    __LOGGER.info('wrote {} bundles and removed {} bundles'.format(
+            written, removed))
+
+    return written, removed
+
+
+def breakpoints_path(output_dir):
+    '''
+    Return the path of the breakpoints file in the output directory.
+    '''
+
+    return os.path.join(output_dir, 'grid-data', 'breakpoints.json')
+
+
+def grid_breakpoints(grid, base_zoom=crimedb.www.GRID_BASE_ZOOM,
+                     zoom_depth=crimedb.www.GRID_CELL_ZOOM_DEPTH,
+                     percentiles=GRID_PERCENTILES):
+    '''
+    Return a {z => [count, ...]} dictionary of the given percentiles of the
+    counts of the cells in tiles at each zoom level z, i.e. of the cells at
+    zoom level z + zoom_depth, for the given {x => {y => count}} grid at
+    base_zoom. Zoom levels with no cells are omitted.
+
+    A percentile p of n cells is the count of the floor((n - 1) * p)th cell
+    in sorted order, as computed by crimedb-leaflet.js.
+    '''
+
+    counts = {
+        (x, y): count
+            for x, ycounts in grid.items()
+            for y, count in ycounts.items()}
+
+    breakpoints = {}
+    for z in range(base_zoom, zoom_depth - 1, -1):
+        if counts:
+            values = sorted(counts.values())
+            breakpoints[z - zoom_depth] = [
+                values[int((len(values) - 1) * p)] for p in percentiles]
+
+        rolled = defaultdict(int)
+        for (x, y), count in counts.items():
+            rolled[(x >> 1, y >> 1)] += count
+        counts = rolled
+
+    return breakpoints
+
+
+def write_breakpoints(output_dir, grid, base_zoom=crimedb.www.GRID_BASE_ZOOM,
+                      zoom_depth=crimedb.www.GRID_CELL_ZOOM_DEPTH,
+                      encodings=()):
+    '''
+    Write the breakpoints file for the given {x => {y => count}} grid at
+    base_zoom to the output directory, precompressed in the given encodings.
+    '''
+
+    breakpoints = grid_breakpoints(grid, base_zoom, zoom_depth)
+    crimedb.output.write_file(breakpoints_path(output_dir), json.dumps({
+        'percentiles': list(GRID_PERCENTILES),
+        'zooms': {str(z): bp for z, bp in sorted(breakpoints.items())},
+    }), encodings)
+
+
+def read_grid_state(path):
+    '''
+    Read an ({x => {y => count}} grid, options) tuple saved with
+    write_grid_state(), where options is a dictionary of the formats,
+    encodings and archive arguments with which tiles were written.
+    '''
+
+    grid = crimedb.www.grid_from_crimes([], 0)
+    with open(path, 'rt', encoding='utf-8') as sf:
+        state = json.load(sf)
+
+    for x, y, count in state['grid']:
+        grid[x][y] = count
+
+    # State written before these were configurable only has plain GeoJSON
+    return grid, {
+        'formats': tuple(state.get('formats', ['geojson'])),
+        'encodings': tuple(state.get('encodings', [])),
+        'archive': state.get('archive', False),
+    }
+
+
+def write_grid_state(path, grid, formats=DEFAULT_TILE_FORMATS, encodings=(),
+                     archive=False):
+    '''
+    Save the given {x => {y => count}} grid and the options with which tiles
+    were rendered from it so that a later render can determine which tiles
+    have changed.
+    '''
+
+    crimedb.output.write_file(path, json.dumps({
+        'formats': list(formats),
+        'encodings': list(encodings),
+        'archive': archive,
+        'grid': [
+            [x, y, count]
+                for x, ycounts in sorted(grid.items())
+                for y, count in sorted(ycounts.items())],
+    }))
+
+
+class RenderTilesTests(unittest.TestCase):
+    '''
+    Tests for render_tiles().
+    '''
+
+    def test_render_tiles(self):
+        '''
+        Verify that rendering subtrees yields the same tiles as rendering the
+        entire pyramid at once, regardless of the split zoom level.
+        '''
+
+        grid = crimedb.www.grid_add({
+            0: {0: 3, 7: 1},
+            1: {6: 2},
+            5: {5: 4, 6: 0},
+            7: {1: 1},
+        })
+
+        zgrid = crimedb.www.zgrid_from_grid(grid, 3, 0)
+        rzgrid = crimedb.www.rzgrid_from_zgrid(zgrid, 1)
+
+        with tempfile.TemporaryDirectory() as td:
+            expected = os.path.join(td, 'expected')
+            write_tiles(expected, rzgrid, 1)
+            self.assertEqual(
+                    set(RenderTilesTests._read_tiles(expected)),
+                    {os.path.join('grid-data', str(z), str(x), str(y) + ext)
+                        for z, x, y in [
+                            (0, 0, 0),
+                            (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0),
+                            (2, 0, 0), (2, 0, 3), (2, 2, 2), (2, 2, 3),
+                            (2, 3, 0)]
+                        for ext in ['.bin', '.json']})
+
+            for split_zoom in [0, 1, 2]:
+                for jobs in [1, 2]:
+                    actual = os.path.join(td, '{}-{}'.format(split_zoom, jobs))
+                    render_tiles(actual, grid, base_zoom=3, zoom_depth=1,
+                                 split_zoom=split_zoom, jobs=jobs)
+                    self.assertEqual(
+                            RenderTilesTests._read_tiles(actual),
+                            RenderTilesTests._read_tiles(expected))
+
+    def test_render_tiles_archive(self):
+        '''
+        Verify that tile archives contain the same tiles as are written to
+        individual files, and that removed tiles are removed from them.
+        '''
+
+        grid = crimedb.www.grid_add({
+            0: {0: 3, 7: 1},
+            5: {5: 4, 6: 0},
+        })
+
+        with tempfile.TemporaryDirectory() as td:
+            expected = os.path.join(td, 'expected')
+            render_tiles(expected, grid, base_zoom=3, zoom_depth=1,
+                         split_zoom=0)
+
+            actual = os.path.join(td, 'actual')
+            for jobs in [1, 2]:
+                render_tiles(actual, grid, base_zoom=3, zoom_depth=1,
+                             split_zoom=1, jobs=jobs, archive=True)
+                self.assertEqual(
+                        RenderTilesTests._read_tile_archives(actual),
+                        RenderTilesTests._read_tiles(expected))
+
+            new_grid = crimedb.www.grid_add({0: {0: 3}})
+            tiles = dirty_tiles(grid, new_grid, 3, 2)
+            render_tiles(expected, new_grid, tiles, base_zoom=3, zoom_depth=1,
+                         split_zoom=0)
+            render_tiles(actual, new_grid, tiles, base_zoom=3, zoom_depth=1,
+                         split_zoom=1, jobs=2, archive=True)
+            self.assertEqual(
+                    RenderTilesTests._read_tile_archives(actual),
+                    RenderTilesTests._read_tiles(expected))
+
+    def _read_tile_archives(output_dir):
+        tiles = {}
+        for fmt in TILE_FORMATS:
+            ta = crimedb.tilearchive.TileArchive(
+                    tile_archive_path(output_dir, fmt))
+            for z, x, y in ta.tiles():
+                tiles[os.path.relpath(
+                        tile_path(output_dir, z, x, y, fmt),
+                        output_dir)] = ta.read_tile(z, x, y)
+            ta.close()
+
+        return tiles
+
+    def _read_tiles(output_dir):
+        tiles = {}
+        for dp, _, fnames in os.walk(output_dir):
+            for fn in fnames:
+                with open(os.path.join(dp, fn), 'rb') as tf:
+                    tiles[os.path.relpath(os.path.join(dp, fn), output_dir)] = \
+                            tf.read()
+
+        return tiles
+
+
+class BundleTests(unittest.TestCase):
+    '''
+    Tests for tile bundles.
+    '''
+
+    def test_write_bundles(self):
+        '''
+        Verify that bundles contain the tiles within them, and that bundles
+        left without tiles are removed.
+        '''
+
+        grid = crimedb.www.grid_add({
+            0: {0: 3, 7: 1},
+            1: {6: 2},
+            5: {5: 4, 6: 0},
+            7: {1: 1},
+        })
+
+        with tempfile.TemporaryDirectory() as td:
+            render_tiles(td, grid, base_zoom=4, zoom_depth=1, split_zoom=0)
+            write_bundles(td, depth=1)
+
+            tiles = RenderTilesTests._read_tiles(td)
+            bundles = {
+                tp: data for tp, data in tiles.items()
+                    if tp.startswith('grid-bundles')}
+            self.assertEqual(
+                    sorted(bundles),
+                    [os.path.join('grid-bundles', str(z), str(x), str(y) + '.bin')
+                        for z, x, y in [
+                            (0, 0, 0), (1, 0, 0), (2, 0, 0),
+                            (3, 0, 0), (3, 0, 1), (3, 1, 0), (3, 1, 1)]])
+
+            for tp, data in bundles.items():
+                version, depth, z, x, y = struct.unpack_from('<BBBII', data)
+                self.assertEqual((version, depth), (BUNDLE_VERSION, 1))
+                self.assertEqual(tp, os.path.relpath(
+                        bundle_path(td, z, x, y), td))
+
+                offsets = struct.unpack_from('<5I', data, 11)
+                for i in range(0, 4):
+                    xx, yy = (x << 1) + i % 2, (y << 1) + i // 2
+                    self.assertEqual(
+                            data[31 + offsets[i]:31 + offsets[i + 1]],
+                            tiles.get(os.path.relpath(
+                                tile_path(td, z, xx, yy, 'binary'), td), b''))
+
+            # Incremental renders only touch the bundles of the given tiles;
+            # of these, the zoom 3 bundle at (0, 0) is unchanged
+            new_grid = crimedb.www.grid_add({0: {0: 3}})
+            dirty = dirty_tiles(grid, new_grid, 4, 3)
+            render_tiles(td, new_grid, dirty, base_zoom=4, zoom_depth=1,
+                         split_zoom=0)
+            self.assertEqual(write_bundles(td, dirty, depth=1), (3, 3))
+
+            with tempfile.TemporaryDirectory() as etd:
+                render_tiles(etd, new_grid, base_zoom=4, zoom_depth=1,
+                             split_zoom=0)
+                write_bundles(etd, depth=1)
+                self.assertEqual(
+                        RenderTilesTests._read_tiles(td),
+                        RenderTilesTests._read_tiles(etd))
+
+
+class GridBreakpointsTests(unittest.TestCase):
+    '''
+    Tests for grid_breakpoints().
+    '''
+
+    def test_grid_breakpoints(self):
+        '''
+        Verify that breakpoints are the percentiles of the rolled up counts
+        at each zoom level.
+        '''
+
+        grid = crimedb.www.grid_add({
+            0: {0: 3, 7: 1},
+            1: {6: 2},
+            5: {5: 4, 6: 0},
+            7: {1: 1},
+        })
+
+        breakpoints = grid_breakpoints(grid, 3, 1, (0.0, 0.5, 1.0))
+        zgrid = crimedb.www.zgrid_from_grid(grid, 3, 0)
+        self.assertEqual(sorted(breakpoints), [0, 1, 2])
+        for z, bp in breakpoints.items():
+            values = sorted(
+                    count
+                        for ycounts in zgrid[z + 1].values()
+                        for count in ycounts.values())
+            self.assertEqual(bp, [
+                values[0],
+                values[(len(values) - 1) // 2],
+                values[-1]])
+
+        self.assertEqual(breakpoints[2], [0, 1, 4])
+        self.assertEqual(breakpoints[0], [1, 3, 4])
+        self.assertEqual(grid_breakpoints({}, 3, 1), {})
+
+
+class DirtyTilesTests(unittest.TestCase):
+    '''
+    Tests for dirty_tiles().
+    '''
+
+    def test_dirty_tiles(self):
+        '''
+        Verify that changed, added and removed cells dirty their tiles at all
+        zoom levels.
+        '''
+
+        old_grid = crimedb.www.grid_add({
+            0: {0: 1, 7: 0},
+            5: {5: 2},
+        })
+        new_grid = crimedb.www.grid_add({
+            0: {0: 1},
+            5: {5: 3},
+            6: {1: 0},
+        })
+
+        self.assertEqual(
+                dirty_tiles(old_grid, new_grid, 3, 2),
+                {
+                    0: {(0, 0)},
+                    1: {(0, 1), (1, 1), (1, 0)},
+                    2: {(0, 3), (2, 2), (3, 0)},
+                })
+
+        self.assertEqual(dirty_tiles(new_grid, new_grid, 3, 2), {})
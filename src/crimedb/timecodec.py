@@ -0,0 +1,318 @@
+# Copyright 2014 Peter Griess
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Fast encoding and decoding of CrimeDB timestamps.
+
+CrimeDB writes times as RFC 3339 strings of a fixed layout (see
+STRFTIME_FORMAT), e.g. '2014-01-06T00:30:00-0600'. Parsing these with
+datetime.strptime() and writing them with datetime.strftime() is slow enough
+to dominate reading and writing crimes, so the functions here handle that
+layout directly. Anything else (e.g. years before 1000, or offsets with
+seconds) falls back to strptime() / strftime(), so results are always exactly
+what those would produce.
+
+Localizing naive times in pytz time zones is similarly sped up by a table of
+each zone's UTC offsets, built once per zone.
+
+Run this module to benchmark it against the standard library.
+'''
+
+import bisect
+import datetime
+import functools
+import re
+import unittest
+
+# The layout of timestamps written by CrimeDB
+STRFTIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+_TIME_RE = re.compile(
+        r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)([+-]\d\d\d\d)\Z',
+        re.ASCII)
+
+# Map of '+HHMM' offset strings to the tzinfo objects that strptime() would
+# give them, and of UTC offsets to their '+HHMM' strings
+_OFFSET_TZINFOS = {}
+_OFFSET_STRINGS = {}
+
+# Once we know a string is in our layout, datetime.fromisoformat() parses it
+# far faster than anything else; it only accepts '+HHMM' offsets as of Python
+# 3.11, however
+try:
+    datetime.datetime.fromisoformat('1970-01-01T00:00:00+0000')
+    _fromisoformat = datetime.datetime.fromisoformat
+except ValueError:
+    _fromisoformat = None
+
+
+def _offset_tzinfo(offset):
+    tzinfo = _OFFSET_TZINFOS.get(offset)
+    if tzinfo is None:
+        tzinfo = datetime.datetime.strptime(
+                '1970-01-01T00:00:00' + offset, STRFTIME_FORMAT).tzinfo
+        _OFFSET_TZINFOS[offset] = tzinfo
+
+    return tzinfo
+
+
+def _offset_string(utcoffset):
+    s = _OFFSET_STRINGS.get(utcoffset)
+    if s is None:
+        s = datetime.datetime(
+                2000, 1, 1,
+                tzinfo=datetime.timezone(utcoffset)).strftime('%z')
+        _OFFSET_STRINGS[utcoffset] = s
+
+    return s
+
+
+def parse_time(s):
+    '''
+    Return a datetime.datetime for the given timestamp string; this is
+    equivalent to datetime.datetime.strptime(s, STRFTIME_FORMAT).
+    '''
+
+    m = _TIME_RE.match(s)
+    if not m:
+        return datetime.datetime.strptime(s, STRFTIME_FORMAT)
+
+    if _fromisoformat:
+        return _fromisoformat(s)
+
+    y, mo, d, h, mi, sec, off = m.groups()
+    return datetime.datetime(
+            int(y), int(mo), int(d), int(h), int(mi), int(sec),
+            tzinfo=_offset_tzinfo(off))
+
+
+def format_time(dt):
+    '''
+    Return the timestamp string for the given datetime.datetime; this is
+    equivalent to dt.strftime(STRFTIME_FORMAT).
+    '''
+
+    # strftime() doesn't zero-pad years before 1000 on all platforms, and
+    # writes offsets with seconds as '+HHMMSS'; leave those to it
+    utcoffset = dt.utcoffset()
+    if utcoffset is None:
+        off = ''
+    elif utcoffset.microseconds or utcoffset.seconds % 60:
+        return dt.strftime(STRFTIME_FORMAT)
+    else:
+        off = _offset_string(utcoffset)
+
+    if dt.year < 1000:
+        return dt.strftime(STRFTIME_FORMAT)
+
+    return '%04d-%02d-%02dT%02d:%02d:%02d%s' % (
+            dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, off)
+
+
+def parse_epoch(s):
+    '''
+    Return the given timestamp string in (floating point) seconds since the
+    epoch; this is equivalent to parse_time(s).timestamp().
+    '''
+
+    return parse_time(s).timestamp()
+
+
+def format_epoch(ts, tz=datetime.timezone.utc):
+    '''
+    Return the timestamp string for the given seconds since the epoch in the
+    given time zone.
+    '''
+
+    return format_time(datetime.datetime.fromtimestamp(ts, tz))
+
+
+class _ZoneTable(object):
+    '''
+    The UTC offsets of a pytz time zone, keyed by local time.
+
+    For each period between the zone's transitions we record the range of
+    local times that fall unambiguously within it, leaving a margin of a few
+    days on either side. Local times within these ranges are localized by
+    simply attaching the period's tzinfo, which is exactly what pytz would do;
+    anything else is left to pytz.
+    '''
+
+    # Margin around transitions, comfortably more than any UTC offset
+    _MARGIN = datetime.timedelta(days=2)
+
+    def __init__(self, tz):
+        self.tz = tz
+        self.starts = []
+        self.ends = []
+        self.tzinfos = []
+
+        tts = tz._utc_transition_times
+        for i, inf in enumerate(tz._transition_info):
+            utcoffset = inf[0]
+            start = datetime.datetime.min
+            if i > 0:
+                start = tts[i] + utcoffset + self._MARGIN
+
+            end = datetime.datetime.max
+            if i + 1 < len(tts):
+                end = tts[i + 1] + utcoffset - self._MARGIN
+
+            if start >= end:
+                continue
+
+            self.starts += [start]
+            self.ends += [end]
+            self.tzinfos += [tz._tzinfos[inf]]
+
+    def localize(self, dt):
+        i = bisect.bisect_right(self.starts, dt) - 1
+        if i < 0 or dt >= self.ends[i]:
+            return self.tz.localize(dt)
+
+        return dt.replace(tzinfo=self.tzinfos[i])
+
+
+@functools.lru_cache(maxsize=None)
+def _zone_table(tz):
+    return _ZoneTable(tz)
+
+
+def localize(dt, tz):
+    '''
+    Return the given naive datetime.datetime in the given time zone; this is
+    equivalent to tz.localize(dt) for pytz time zones.
+    '''
+
+    if hasattr(tz, '_utc_transition_times'):
+        return _zone_table(tz).localize(dt)
+
+    if hasattr(tz, 'localize'):
+        return tz.localize(dt)
+
+    return dt.replace(tzinfo=tz)
+
+
+class TimeCodecTests(unittest.TestCase):
+    '''
+    Tests for timestamp encoding and decoding.
+    '''
+
+    _TIMES = [
+        '2014-01-06T00:30:00-0600',
+        '2014-07-04T23:59:59-0500',
+        '1970-01-01T00:00:00+0000',
+        '1969-12-31T23:59:59+0530',
+        '2014-01-06T00:30:00Z',
+        '2014-1-6T0:30:00-0600',
+        '2014-01-06T00:30:00-06:00',
+        '0999-01-01T00:00:00+0000',
+    ]
+
+    def test_parse(self):
+        '''
+        Verify that timestamps are parsed exactly as strptime() would.
+        '''
+
+        for s in self._TIMES:
+            expected = datetime.datetime.strptime(s, STRFTIME_FORMAT)
+            dt = parse_time(s)
+            self.assertEqual(dt, expected)
+            self.assertEqual(dt.tzinfo, expected.tzinfo)
+            self.assertEqual(format_time(dt), expected.strftime(STRFTIME_FORMAT))
+            self.assertEqual(parse_epoch(s), expected.timestamp())
+
+        for s in [
+                '2014-13-06T00:30:00-0600',
+                '2014-02-30T00:30:00-0600',
+                '2014-01-06T24:30:00-0600',
+                '2014-01-06 00:30:00-0600',
+                '2014-01-06T00:30:00']:
+            self.assertRaises(ValueError, parse_time, s)
+
+    def test_format(self):
+        '''
+        Verify that times are formatted exactly as strftime() would.
+        '''
+
+        import pytz
+
+        tz = pytz.timezone('US/Central')
+        for dt in [
+                datetime.datetime(2014, 1, 6, 0, 30),
+                datetime.datetime(2014, 1, 6, 0, 30, 15, 500),
+                datetime.datetime(
+                    2014, 1, 6, 0, 30, tzinfo=datetime.timezone.utc),
+                tz.localize(datetime.datetime(2014, 1, 6, 0, 30)),
+                tz.localize(datetime.datetime(1800, 1, 1)),
+                datetime.datetime(
+                    2014, 1, 6, tzinfo=datetime.timezone(
+                        datetime.timedelta(hours=1, seconds=30))),
+                datetime.datetime(999, 1, 1)]:
+            self.assertEqual(format_time(dt), dt.strftime(STRFTIME_FORMAT))
+
+        self.assertEqual(format_epoch(0), '1970-01-01T00:00:00+0000')
+        self.assertEqual(format_epoch(1389033000, tz), '2014-01-06T12:30:00-0600')
+
+    def test_localize(self):
+        '''
+        Verify that localizing times matches pytz, including around DST
+        transitions.
+        '''
+
+        import pytz
+
+        for tzn in ['US/Central', 'Australia/Lord_Howe', 'UTC']:
+            tz = pytz.timezone(tzn)
+            dts = [datetime.datetime(1800, 1, 1), datetime.datetime(2100, 1, 1)]
+            for day in [datetime.datetime(2014, 3, 9), datetime.datetime(2014, 11, 2),
+                        datetime.datetime(2014, 4, 6), datetime.datetime(2014, 10, 5)]:
+                for minutes in range(-3 * 24 * 60, 3 * 24 * 60, 15):
+                    dts += [day + datetime.timedelta(minutes=minutes)]
+
+            for dt in dts:
+                expected = tz.localize(dt)
+                ldt = localize(dt, tz)
+                self.assertEqual(ldt, expected)
+                self.assertIs(ldt.tzinfo, expected.tzinfo)
+
+
+if __name__ == '__main__':
+    import pytz
+    import timeit
+
+    tz = pytz.timezone('US/Central')
+    s = '2014-01-06T00:30:00-0600'
+    dt = parse_time(s)
+    naive = dt.replace(tzinfo=None)
+
+    for name, stmt, baseline in [
+            ('parse',
+             lambda: parse_time(s),
+             lambda: datetime.datetime.strptime(s, STRFTIME_FORMAT)),
+            ('format',
+             lambda: format_time(dt),
+             lambda: dt.strftime(STRFTIME_FORMAT)),
+            ('parse_epoch',
+             lambda: parse_epoch(s),
+             lambda: datetime.datetime.strptime(
+                 s, STRFTIME_FORMAT).timestamp()),
+            ('localize',
+             lambda: localize(naive, tz),
+             lambda: tz.localize(naive))]:
+        n = 100000
+        t = min(timeit.repeat(stmt, number=n, repeat=5)) / n
+        bt = min(timeit.repeat(baseline, number=n, repeat=5)) / n
+        print('{:<12} {:>8.3f}us (stdlib/pytz {:>8.3f}us, {:.1f}x)'.format(
+                name, t * 1e6, bt * 1e6, bt / t))
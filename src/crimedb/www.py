@@ -21,11 +21,23 @@ from functools import partial
 import logging
 import math
 import pprint
-import shapely.geometry
 import unittest
 
 __LOGGER = logging.getLogger(__name__)
 
+# Maximum zoom level for which we render grid tiles
+MAX_ZOOM_LEVEL = 14
+
+# Number of zoom levels below that of its tile at which each grid cell is
+# computed; i.e. each tile contains a (2 ** depth) x (2 ** depth) grid
+GRID_CELL_ZOOM_DEPTH = 3
+
+# Zoom level at which crimes are initially binned into grid cells
+GRID_BASE_ZOOM = MAX_ZOOM_LEVEL + GRID_CELL_ZOOM_DEPTH
+
+# Version of the encoding produced by rzgrid_to_binary()
+BINARY_TILE_VERSION = 1
+
 
 # From http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
 def slippy_tile_coordinates_from_point(lon, lat, zoom):
@@ -59,6 +71,8 @@ def bbox_from_slippy_tile_coordinates(x, y, z):
     map tile.
     '''
 
+    import shapely.geometry
+
     minx, miny = point_from_slippy_tile_coordinates(x, y, z)
     maxx, maxy = point_from_slippy_tile_coordinates(x + 1, y + 1, z)
 
@@ -125,13 +139,15 @@ def zgrid_from_grid(grid, zoom, min_zoom):
     return zgrid
 
 
-def rzgrid_from_zgrid(zgrid, zoom_depth):
+def rzgrid_from_zgrid(zgrid, zoom_depth, min_zoom=0):
     '''
     Return a {z => {x => {y => {x => {y => count}}} grid.
 
     Each cell of the grid is an {x => {y => count}} grid itself of z +
     zoom_depth resolution. The idea is to allow fetching of a single file
     representing a slice of the grid.
+
+    Only zoom levels of at least min_zoom are computed.
     '''
 
     rzgrid = defaultdict(
@@ -143,25 +159,16 @@ def rzgrid_from_zgrid(zgrid, zoom_depth):
     max_zoom = max(zgrid.keys()) - zoom_depth
     assert max_zoom >= 0
 
-    for z in range(0, max_zoom + 1):
-        __LOGGER.info('Computing rzgrid zoom={}'.format(z))
-        for x, ycounts in zgrid[z].items():
-            for y, _ in zgrid[z][x].items():
-
-                p = 2 ** zoom_depth
-                xx_min = x * p
-                xx_max = (x + 1) * p - 1
-                yy_min = y * p
-                yy_max = (y + 1) * p - 1
-                for xx, yycounts in zgrid[z + zoom_depth].items():
-                    if xx < xx_min or xx > xx_max:
-                        continue
-
-                    for yy, yycount in yycounts.items():
-                        if yy < yy_min or yy > yy_max:
-                            continue
-
-                        rzgrid[z][x][y][xx - xx_min][yy - yy_min] = yycount
+    # Rather than scanning all cells at z + zoom_depth for each tile at z,
+    # assign each cell to the tile that contains it
+    p = 2 ** zoom_depth
+    for z in range(min_zoom, max_zoom + 1):
+        __LOGGER.debug('Computing rzgrid zoom={}'.format(z))
+        for xx, yycounts in zgrid[z + zoom_depth].items():
+            x = xx // p
+            for yy, yycount in yycounts.items():
+                y = yy // p
+                rzgrid[z][x][y][xx - x * p][yy - y * p] = yycount
 
     return rzgrid
 
@@ -186,6 +193,27 @@ def grid_pformat(grid):
     return '\n'.join(pretty)
 
 
+def _box_geojson(minx, miny, maxx, maxy):
+    '''
+    Return a GeoJSON Polygon for the given box, with its vertices in the same
+    order as the equivalent shapely.geometry.box().
+
+    Building this ourselves is much cheaper than constructing a Shapely object
+    for every cell that we render.
+    '''
+
+    return {
+        'type': 'Polygon',
+        'coordinates': [[
+            [maxx, miny],
+            [maxx, maxy],
+            [minx, maxy],
+            [minx, miny],
+            [maxx, miny],
+        ]],
+    }
+
+
 def rzgrid_to_geojson(rzgrid, x, y, zoom, zoom_depth):
     '''
     Return a GeoJSON object describing the squares at rzgrid[z][x][y].
@@ -205,18 +233,118 @@ def rzgrid_to_geojson(rzgrid, x, y, zoom, zoom_depth):
             if yy not in rzgrid[zoom][x][y][xx]:
                 continue
 
-            so = shapely.geometry.box(
+            gjo = _box_geojson(
                 nw[0] + xx * lon_width,
                 nw[1] + yy * lat_width,
                 nw[0] + (xx + 1) * lon_width,
                 nw[1] + (yy + 1) * lat_width)
-            gjo = shapely.geometry.mapping(so)
             gjo['crime_count'] = rzgrid[zoom][x][y][xx][yy]
             gjos += [gjo]
 
     return gjos
 
 
+def _encode_varint(n):
+    '''
+    Return the unsigned LEB128 encoding of the given integer.
+    '''
+
+    assert n >= 0
+
+    b = bytearray()
+    while True:
+        if n < 0x80:
+            b.append(n)
+            return bytes(b)
+
+        b.append((n & 0x7f) | 0x80)
+        n >>= 7
+
+
+def _decode_varint(data, pos):
+    '''
+    Return a (value, pos) tuple of the unsigned LEB128 integer starting at the
+    given position in data and the position immediately after it.
+    '''
+
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, pos
+
+        shift += 7
+
+
+def rzgrid_to_binary(rzgrid, x, y, zoom, zoom_depth):
+    '''
+    Return a compact binary encoding of the squares at rzgrid[z][x][y].
+
+    The encoding consists of
+
+      - a BINARY_TILE_VERSION byte
+      - a zoom_depth byte
+      - the tile's zoom, x and y as varints
+      - a bitmap of which of the (2 ** zoom_depth) ** 2 cells in the tile are
+        present, in row-major order (i.e. cell (xx, yy) is bit
+        yy * 2 ** zoom_depth + xx), least significant bit first
+      - the count of each present cell as a varint, in bitmap order
+
+    Clients already know the geometry of each tile and so can reconstruct the
+    cell polygons themselves; see the decoder in crimedb-leaflet.js.
+    '''
+
+    side = 2 ** zoom_depth
+    bitmap = bytearray((side * side + 7) // 8)
+    counts = []
+    for yy in range(0, side):
+        for xx in range(0, side):
+            if yy not in rzgrid[zoom][x][y][xx]:
+                continue
+
+            i = yy * side + xx
+            bitmap[i // 8] |= 1 << (i % 8)
+            counts += [_encode_varint(rzgrid[zoom][x][y][xx][yy])]
+
+    return bytes([BINARY_TILE_VERSION, zoom_depth]) + \
+            _encode_varint(zoom) + \
+            _encode_varint(x) + \
+            _encode_varint(y) + \
+            bytes(bitmap) + \
+            b''.join(counts)
+
+
+def binary_to_rzgrid_tile(data):
+    '''
+    The inverse of rzgrid_to_binary(). Returns a (zoom, x, y, zoom_depth,
+    {x => {y => count}}) tuple.
+    '''
+
+    if data[0] != BINARY_TILE_VERSION:
+        raise ValueError('unsupported binary tile version {}'.format(data[0]))
+
+    zoom_depth = data[1]
+    zoom, pos = _decode_varint(data, 2)
+    x, pos = _decode_varint(data, pos)
+    y, pos = _decode_varint(data, pos)
+
+    side = 2 ** zoom_depth
+    bitmap = data[pos:pos + (side * side + 7) // 8]
+    pos += len(bitmap)
+
+    grid = defaultdict(partial(defaultdict, int))
+    for i in range(0, side * side):
+        if not bitmap[i // 8] & (1 << (i % 8)):
+            continue
+
+        grid[i % side][i // side], pos = _decode_varint(data, pos)
+
+    return zoom, x, y, zoom_depth, grid
+
+
 class GridTests(unittest.TestCase):
     '''
     Tests for verifying grid operations.
@@ -294,6 +422,57 @@ class GridTests(unittest.TestCase):
 
         return grid
 
+    def test_rzgrid_to_geojson(self):
+        '''
+        Verify that rzgrid_to_geojson() produces the same polygons as
+        Shapely would.
+        '''
+
+        import shapely.geometry
+
+        rzgrid = rzgrid_from_zgrid(zgrid_from_grid(GridTests._GRID1, 2, 0), 1)
+        nw = point_from_slippy_tile_coordinates(1, 0, 1)
+        se = point_from_slippy_tile_coordinates(2, 1, 1)
+        lon_width = (se[0] - nw[0]) / 2
+        lat_width = (se[1] - nw[1]) / 2
+
+        gjos = rzgrid_to_geojson(rzgrid, 1, 0, 1, 1)
+        self.assertEqual(4, len(gjos))
+        for gjo, (xx, yy) in zip(gjos, [(0, 0), (0, 1), (1, 0), (1, 1)]):
+            expected = shapely.geometry.mapping(shapely.geometry.box(
+                nw[0] + xx * lon_width,
+                nw[1] + yy * lat_width,
+                nw[0] + (xx + 1) * lon_width,
+                nw[1] + (yy + 1) * lat_width))
+            self.assertEqual(
+                    shapely.geometry.shape(gjo).equals_exact(
+                        shapely.geometry.shape(expected), 0),
+                    True)
+            self.assertEqual(gjo['crime_count'], rzgrid[1][1][0][xx][yy])
+
+    def test_rzgrid_to_binary(self):
+        '''
+        Verify that binary tiles round-trip, including cells with a count of
+        0 and counts needing multi-byte varints.
+        '''
+
+        grid = GridTests._list_to_grid([
+            [13, 0, 8, 19],
+            [4, 1000, 8, 4],
+            [10, 6, 7, 1],
+            [6, 2, 300000, 8],
+        ])
+        del grid[0][1]
+        del grid[2][2]
+
+        zgrid = zgrid_from_grid(grid, 2, 0)
+        for z, x, y, zoom_depth in [(0, 0, 0, 2), (1, 1, 1, 1)]:
+            rzgrid = rzgrid_from_zgrid(zgrid, zoom_depth)
+            data = rzgrid_to_binary(rzgrid, x, y, z, zoom_depth)
+            self.assertEqual(
+                    binary_to_rzgrid_tile(data),
+                    (z, x, y, zoom_depth, rzgrid[z][x][y]))
+
     _GRID1 = _list_to_grid([
         [13, 5, 8, 19],
         [4, 19, 8, 4],
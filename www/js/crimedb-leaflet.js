@@ -106,6 +106,13 @@
     var lat2tile = function(lat, zoom) {
         return Math.floor((1.0 - Math.log(Math.tan(lat * Math.PI / 180.0) + 1 / Math.cos(lat * Math.PI / 180.0)) / Math.PI) / 2.0 * Math.pow(2, zoom));
     };
+    var tile2lon = function(x, zoom) {
+        return x / Math.pow(2, zoom) * 360.0 - 180.0;
+    };
+    var tile2lat = function(y, zoom) {
+        var n = Math.PI - 2.0 * Math.PI * y / Math.pow(2, zoom);
+        return 180.0 / Math.PI * Math.atan(0.5 * (Math.exp(n) - Math.exp(-n)));
+    };
     var tilesForMap = function(map) {
         var bounds = map.getBounds();
         var zoom = Math.min(14, map.getZoom());
@@ -134,26 +141,250 @@
     };
 
     /**
-     * Get the URL from which to fetch a grid tile.
+     * Decode a grid tile in the binary format written by
+     * crimedb.www.rzgrid_to_binary() into the same array of polygons, each
+     * with a 'crime_count' property, found in GeoJSON tiles.
+     */
+    var decodeBinaryTile = function(buffer) {
+        var data = new Uint8Array(buffer);
+        var pos = 0;
+
+        var readVarint = function() {
+            var value = 0;
+            var mult = 1;
+            var b;
+            do {
+                b = data[pos++];
+                value += (b & 0x7f) * mult;
+                mult *= 128;
+            } while (b & 0x80);
+
+            return value;
+        };
+
+        var version = data[pos++];
+        if (version !== 1) {
+            throw 'Unsupported binary tile version ' + version + '!';
+        }
+
+        var zoomDepth = data[pos++];
+        var z = readVarint();
+        var x = readVarint();
+        var y = readVarint();
+
+        var side = Math.pow(2, zoomDepth);
+        var bitmapPos = pos;
+        pos += Math.ceil(side * side / 8);
+
+        var west = tile2lon(x, z);
+        var north = tile2lat(y, z);
+        var lonWidth = (tile2lon(x + 1, z) - west) / side;
+        var latWidth = (tile2lat(y + 1, z) - north) / side;
+
+        // Cells are listed in row-major order; see rzgrid_to_binary()
+        var cells = [];
+        for (var i = 0; i < side * side; ++i) {
+            if (!(data[bitmapPos + (i >> 3)] & (1 << (i & 7)))) {
+                continue;
+            }
+
+            var xx = i % side;
+            var yy = Math.floor(i / side);
+            var minx = west + xx * lonWidth;
+            var miny = north + yy * latWidth;
+            var maxx = west + (xx + 1) * lonWidth;
+            var maxy = north + (yy + 1) * latWidth;
+
+            cells.push({
+                type: 'Polygon',
+                coordinates: [[
+                    [maxx, miny],
+                    [maxx, maxy],
+                    [minx, maxy],
+                    [minx, miny],
+                    [maxx, miny],
+                ]],
+                crime_count: readVarint(),
+            });
+        }
+
+        return cells;
+    };
+
+    /**
+     * Bundles are 2 ** BUNDLE_ZOOM_DEPTH tiles on a side; this must match
+     * crimedb.tiles.BUNDLE_ZOOM_DEPTH.
+     */
+    var BUNDLE_ZOOM_DEPTH = 2;
+
+    /**
+     * Decode a bundle of binary tiles written by crimedb.tiles.tile_bundle()
+     * into an array of objects with the 'z', 'x' and 'y' coordinates of each
+     * tile in the bundle and its decoded 'data', which is null if the tile
+     * is absent.
+     */
+    var decodeBundle = function(buffer) {
+        var view = new DataView(buffer);
+
+        var version = view.getUint8(0);
+        if (version !== 1) {
+            throw 'Unsupported bundle version ' + version + '!';
+        }
+
+        var side = Math.pow(2, view.getUint8(1));
+        var z = view.getUint8(2);
+        var x = view.getUint32(3, true);
+        var y = view.getUint32(7, true);
+
+        var indexPos = 11;
+        var dataPos = indexPos + 4 * (side * side + 1);
+
+        var tiles = [];
+        for (var i = 0; i < side * side; ++i) {
+            var start = view.getUint32(indexPos + 4 * i, true);
+            var end = view.getUint32(indexPos + 4 * (i + 1), true);
+
+            tiles.push({
+                z: z,
+                x: x * side + i % side,
+                y: y * side + Math.floor(i / side),
+                data: start === end ?
+                    null :
+                    decodeBinaryTile(
+                        buffer.slice(dataPos + start, dataPos + end)),
+            });
+        }
+
+        return tiles;
+    };
+
+    /**
+     * Formats in which grid tiles are available, keyed by the name used for
+     * the 'format' option of CrimeDBLayer.
+     */
+    var TILE_FORMATS = {
+        binary: {
+            extension: '.bin',
+            responseType: 'arraybuffer',
+            decode: decodeBinaryTile,
+        },
+        geojson: {
+            extension: '.json',
+            responseType: 'text',
+            decode: JSON.parse,
+        },
+    };
+
+    /**
+     * Whether or not this browser can fetch and decode binary tiles.
      */
-    var gridUrl = function(x, y, z) {
+    var binaryTilesSupported = function() {
+        return typeof ArrayBuffer !== 'undefined' &&
+            typeof Uint8Array !== 'undefined' &&
+            typeof DataView !== 'undefined' &&
+            'responseType' in new XMLHttpRequest();
+    };
+
+    /**
+     * Get the URL from which to fetch a grid tile in the given format.
+     */
+    var gridUrl = function(x, y, z, format) {
         return '//www.crimedb.org/grid-data/' +
-            z + '/' + x + '/' + y + '.json';
+            z + '/' + x + '/' + y + TILE_FORMATS[format].extension;
+    };
+
+    /**
+     * Get the URL from which to fetch the given bundle of binary tiles.
+     */
+    var bundleUrl = function(x, y, z) {
+        return '//www.crimedb.org/grid-bundles/' + z + '/' + x + '/' + y + '.bin';
+    };
+
+    /**
+     * URL of the per-zoom color breakpoints written by
+     * crimedb.tiles.write_breakpoints().
+     */
+    var BREAKPOINTS_URL = '//www.crimedb.org/grid-data/breakpoints.json';
+
+    /**
+     * Style a GeoJSON feature for a grid cell using the given breakpoints.
+     * Counts outside of the breakpoints, e.g. from a tile cached before the
+     * breakpoints were fetched, get the nearest color.
+     */
+    var cellStyle = function(feature, colorBuckets) {
+        var value = Math.min(
+            Math.max(feature.properties.crimeCount, colorBuckets[0]),
+            colorBuckets[colorBuckets.length - 1]);
+
+        return {
+            color: GRID_COLORS[bucketForValue(value, colorBuckets)],
+            fillOpacity: 0.4,
+            stroke: false
+        };
     };
 
     var CrimeDBLayer = L.Class.extend({
-        initialize: function() {
+        options: {
+            // Format of the grid tiles to fetch; one of the keys in
+            // TILE_FORMATS. Binary tiles are much smaller, but we fall back
+            // to GeoJSON if the browser can't handle them.
+            format: 'binary',
+
+            // Whether to fetch binary tiles in bundles rather than one at a
+            // time, which takes far fewer requests to fill the map
+            bundles: true,
+
+            // Maximum number of decoded tiles to keep around for re-use. The
+            // least recently used tiles beyond this are discarded, though
+            // never those currently on the map.
+            maxCachedTiles: 256,
+
+            // Time range, in epoch seconds or RFC3339, of the crimes to
+            // show; by default, all crimes are shown. Tiles for a time range
+            // are computed on demand by the bin/serve instance at tileServer,
+            // and colored by the crimes visible on the map rather than by
+            // the published breakpoints. See also setTimeRange().
+            timeFrom: null,
+            timeTo: null,
+            tileServer: '//www.crimedb.org',
+        },
+
+        initialize: function(options) {
             var self = this;
 
-            self.currentLayers = [];
-            self.currentBounds = null;
-            self.crimeDBData = {};
+            L.setOptions(self, options);
+            if (self.options.format === 'binary' && !binaryTilesSupported()) {
+                self.options.format = 'geojson';
+            }
+
+            // Decoded tiles, keyed by URL. Each entry is an object with the
+            // tile's 'data' (null if the server had no such tile) and the
+            // 'lastUsed' generation in which it was last on the map.
+            self.tileCache = {};
+            self.tileCacheSize = 0;
+            self.generation = 0;
+
+            // Tiles currently being fetched, keyed by URL
+            self.pendingTiles = {};
+
+            // Layers on the map for each visible tile, keyed by URL
+            self.tileLayers = {};
+
+            // Breakpoints for each zoom level, as fetched from the server.
+            // Until they arrive (or if they can't be fetched), breakpoints
+            // are computed from the visible tiles instead.
+            self.breakpoints = null;
+            self.colorBuckets = null;
+            self.legend = null;
+
             self.updateCallback = null;
+            self.map = null;
         },
 
         onAdd: function(map) {
             var self = this;
 
+            self.map = map;
             self.updateCallback = self.update.bind(self, map);
             map.on('load', self.updateCallback)
                 .on('viewreset', self.updateCallback)
@@ -161,6 +392,10 @@
                 .on('moveend', self.updateCallback)
                 .on('resize', self.updateCallback);
 
+            if (!self.breakpoints) {
+                self.fetchBreakpoints(map);
+            }
+
             // Perform the initial udpate rather than waiting for the user
             // to do something
             self.updateCallback();
@@ -179,144 +414,379 @@
                     .off('resize', self.updateCallback);
             }
 
-            self.currentLayers.forEach(function(l) {
-                map.removeLayer(l);
+            Object.keys(self.tileLayers).forEach(function(url) {
+                map.removeLayer(self.tileLayers[url]);
             });
-            self.currentLayers = [];
+            self.tileLayers = {};
+
+            if (self.legend) {
+                map.removeControl(self.legend);
+                self.legend = null;
+                self.colorBuckets = null;
+            }
 
             map.attributionControl.removeAttribution(ATTRIBUTION_TEXT);
+            self.map = null;
         },
 
-        update: function(map) {
+        /**
+         * Show only crimes in the given time range, in epoch seconds or
+         * RFC3339; either end can be null to leave the range open, and
+         * passing neither shows all crimes again.
+         */
+        setTimeRange: function(timeFrom, timeTo) {
             var self = this;
 
-            // Kick off a fetch for each of the tiles that we need to render
-            // the current map.
-            tilesForMap(map).forEach(function(t) {
+            self.options.timeFrom = timeFrom;
+            self.options.timeTo = timeTo;
+            if (!self.map) {
+                return;
+            }
 
-                // If we have all of the tiles that we need to render the
-                // grid, go ahead and do it. Note that this re-computes the
-                // set of tiles needed because the map may have moved since
-                // we initially performed the fetch.
-                var maybeRenderGrid = function() {
-                    var haveAllData = tilesForMap(map).reduce(
-                        function(acc, t) {
-                            return acc && (gridUrl(t.x, t.y, t.z) in self.crimeDBData);
-                        },
-                        true
-                    );
+            // Tiles are cached by URL, so those for the previous time range
+            // can be re-used if we go back to it
+            Object.keys(self.tileLayers).forEach(function(url) {
+                self.map.removeLayer(self.tileLayers[url]);
+            });
+            self.tileLayers = {};
+            self.colorBuckets = null;
 
-                    if (!haveAllData) {
-                        return;
-                    }
+            self.update(self.map);
+        },
 
-                    self.renderTileData(map);
-                };
+        hasTimeRange: function() {
+            return this.options.timeFrom !== null ||
+                this.options.timeTo !== null;
+        },
+
+        /**
+         * Get the URL from which to fetch a grid tile in the given format,
+         * taking into account our time range.
+         */
+        tileUrl: function(x, y, z, format) {
+            var self = this;
+            if (!self.hasTimeRange()) {
+                return gridUrl(x, y, z, format);
+            }
+
+            var params = [];
+            if (self.options.timeFrom !== null) {
+                params.push(
+                    'from=' + encodeURIComponent(self.options.timeFrom));
+            }
+            if (self.options.timeTo !== null) {
+                params.push('to=' + encodeURIComponent(self.options.timeTo));
+            }
+
+            return self.options.tileServer + '/grid-data/' +
+                z + '/' + x + '/' + y + TILE_FORMATS[format].extension +
+                '?' + params.join('&');
+        },
+
+        fetchBreakpoints: function(map) {
+            var self = this;
+
+            self.fetch(BREAKPOINTS_URL, 'text', function(response) {
+                if (response === null) {
+                    return;
+                }
+
+                self.breakpoints = JSON.parse(response).zooms;
+                self.update(map);
+            });
+        },
+
+        update: function(map) {
+            var self = this;
+            var format = self.options.format;
+            // Bundles are only published for all crimes
+            var useBundles = format === 'binary' && self.options.bundles &&
+                !self.hasTimeRange();
 
-                var url = gridUrl(t.x, t.y, t.z);
-                if (url in self.crimeDBData) {
-                    maybeRenderGrid();
+            // Kick off a fetch for each of the visible tiles that we don't
+            // already have or are waiting for; each is drawn as it arrives
+            tilesForMap(map).forEach(function(t) {
+                var url = self.tileUrl(t.x, t.y, t.z, format);
+                if (url in self.tileCache || url in self.pendingTiles) {
+                    return;
+                }
+
+                if (useBundles) {
+                    self.fetchBundle(map, t);
                 } else {
-                    var req = new XMLHttpRequest();
-                    req.onreadystatechange = function() {
-                        if (req.readyState !== 4) {
-                            return;
-                        }
-
-                        if (req.status === 200) {
-                            self.crimeDBData[url] = JSON.parse(req.response);
-                        } else if (req.status === 404) {
-                            self.crimeDBData[url] = null;
-                        } else {
-                            return;
-                        }
-
-                        maybeRenderGrid();
-                    };
-                    req.open('GET', url);
-                    req.responseType = 'text';
-                    req.send();
+                    self.fetchTile(map, t);
                 }
             });
+
+            self.renderTileData(map);
         },
 
-        renderTileData: function(map) {
+        /**
+         * Fetch the given URL, calling done() with the response, or with null
+         * if the server doesn't have it. If given, failed() is called if the
+         * fetch fails for any other reason.
+         */
+        fetch: function(url, responseType, done, failed) {
+            var req = new XMLHttpRequest();
+            req.onreadystatechange = function() {
+                if (req.readyState !== 4) {
+                    return;
+                }
+
+                if (req.status === 200) {
+                    done(req.response);
+                } else if (req.status === 404) {
+                    done(null);
+                } else if (failed) {
+                    failed();
+                }
+            };
+            req.open('GET', url);
+            req.responseType = responseType;
+            req.send();
+        },
+
+        cacheTile: function(url, data) {
             var self = this;
 
-            // If the map hasn't moved, there's nothing to do
-            var bounds = map.getBounds();
-            if (bounds.equals(self.currentBounds)) {
-                return;
+            if (!(url in self.tileCache)) {
+                ++self.tileCacheSize;
             }
 
-            self.currentBounds = bounds;
+            self.tileCache[url] = {
+                data: data,
+                lastUsed: self.generation,
+            };
+        },
 
-            // Clear out the current view, including the legend
-            self.currentLayers.forEach(function(l) {
-                map.removeLayer(l);
-            });
-            self.currentLayers = [];
-            var legend = L.DomUtil.get('crimeDBLegend');
-            if (legend) {
-                legend.remove();
+        fetchTile: function(map, t) {
+            var self = this;
+            var format = self.options.format;
+            var url = self.tileUrl(t.x, t.y, t.z, format);
+
+            self.pendingTiles[url] = true;
+            self.fetch(
+                url,
+                TILE_FORMATS[format].responseType,
+                function(response) {
+                    delete self.pendingTiles[url];
+                    self.cacheTile(
+                        url,
+                        response === null ?
+                            null : TILE_FORMATS[format].decode(response));
+                    self.renderTileData(map);
+                },
+                function() {
+                    delete self.pendingTiles[url];
+                }
+            );
+        },
+
+        /**
+         * Fetch the bundle containing the given tile, caching all of the
+         * tiles in it.
+         */
+        fetchBundle: function(map, t) {
+            var self = this;
+            var side = Math.pow(2, BUNDLE_ZOOM_DEPTH);
+            var bx = Math.floor(t.x / side);
+            var by = Math.floor(t.y / side);
+
+            var urls = [];
+            for (var yy = 0; yy < side; ++yy) {
+                for (var xx = 0; xx < side; ++xx) {
+                    urls.push(gridUrl(
+                        bx * side + xx, by * side + yy, t.z, 'binary'));
+                }
             }
 
-            var gd = tilesForMap(map).reduce(
-                function(acc, t) {
-                    var td = self.crimeDBData[gridUrl(t.x, t.y, t.z)];
+            urls.forEach(function(url) {
+                self.pendingTiles[url] = true;
+            });
 
-                    // Not all cells have data, e.g. if we got a 404 from
-                    // the server for this tile
-                    if (td) {
-                        acc = acc.concat(td);
+            self.fetch(
+                bundleUrl(bx, by, t.z),
+                'arraybuffer',
+                function(response) {
+                    urls.forEach(function(url) {
+                        delete self.pendingTiles[url];
+                    });
+
+                    // A missing bundle has no tiles at all
+                    if (response === null) {
+                        urls.forEach(function(url) {
+                            self.cacheTile(url, null);
+                        });
+                    } else {
+                        decodeBundle(response).forEach(function(bt) {
+                            self.cacheTile(
+                                gridUrl(bt.x, bt.y, bt.z, 'binary'), bt.data);
+                        });
                     }
 
-                    return acc;
+                    self.renderTileData(map);
                 },
-                []
+                function() {
+                    urls.forEach(function(url) {
+                        delete self.pendingTiles[url];
+                    });
+
+                    // Fall back to fetching the tile on its own
+                    self.fetchTile(map, t);
+                }
             );
+        },
+
+        /**
+         * Bring the layers on the map up to date with the visible tiles,
+         * adding layers for tiles that have come into view and removing
+         * those for tiles that have gone out of it.
+         */
+        renderTileData: function(map) {
+            var self = this;
+            var format = self.options.format;
+            var zoom = Math.min(14, map.getZoom());
 
-            var crimeCounts = gd.map(function(gc) { return gc.crime_count; });
-            var crimeGeoJson = gd.map(function(gc) {
-                var cnt = gc.crime_count;
+            ++self.generation;
+
+            var visible = {};
+            tilesForMap(map).forEach(function(t) {
+                var url = self.tileUrl(t.x, t.y, t.z, format);
+                visible[url] = true;
+
+                if (url in self.tileCache) {
+                    self.tileCache[url].lastUsed = self.generation;
+                }
+            });
+
+            Object.keys(self.tileLayers).forEach(function(url) {
+                if (!(url in visible)) {
+                    map.removeLayer(self.tileLayers[url]);
+                    delete self.tileLayers[url];
+                }
+            });
+
+            // The published breakpoints are for all crimes, so are no use
+            // for a time range
+            var colorBuckets =
+                (!self.hasTimeRange() &&
+                    self.breakpoints && self.breakpoints[zoom]) ||
+                self.computeColorBuckets(visible);
+            if (!colorBuckets) {
+                return;
+            }
+
+            // Existing layers only need to be re-styled if the breakpoints
+            // have changed, e.g. because we've zoomed
+            if (!self.colorBuckets ||
+                    colorBuckets.join() !== self.colorBuckets.join()) {
+                self.colorBuckets = colorBuckets;
+                Object.keys(self.tileLayers).forEach(function(url) {
+                    self.tileLayers[url].setStyle(function(f) {
+                        return cellStyle(f, colorBuckets);
+                    });
+                });
+                self.renderLegend(map);
+            }
+
+            Object.keys(visible).forEach(function(url) {
+                if (url in self.tileLayers ||
+                        !(url in self.tileCache) ||
+                        !self.tileCache[url].data) {
+                    return;
+                }
 
                 // The 'geometry' property will contain the 'crime_count'
                 // value as well, which is kind of weird. It would be nice
                 // for this to be strictly GeoJSON, but that requires
                 // copying the gc object (which seems non-trivial in JS)
                 // and then deleting the 'crime_count' field.
-                return {
-                    type: 'Feature',
-                    properties: {
-                        crimeCount: cnt,
-                    },
-                    geometry: gc,
-                };
+                var features = self.tileCache[url].data.map(function(gc) {
+                    return {
+                        type: 'Feature',
+                        properties: {
+                            crimeCount: gc.crime_count,
+                        },
+                        geometry: gc,
+                    };
+                });
+
+                self.tileLayers[url] = L.geoJson(features, {
+                    style: function(f) {
+                        return cellStyle(f, self.colorBuckets);
+                    }
+                }).addTo(map);
             });
 
-            // Compute percentiles for coloring
-            var colorBuckets = computePercentiles(
-                crimeCounts, GRID_PERCENTILES);
+            self.evictTiles();
+        },
 
-            // Render the crime grid
-            var l = L.geoJson(crimeGeoJson, {
-                style: function (f) {
-                    return {
-                        color: GRID_COLORS[
-                            bucketForValue(
-                                f.properties.crimeCount,
-                                colorBuckets
-                            )
-                        ],
-                        fillOpacity: 0.4,
-                        stroke: false
-                    };
+        /**
+         * Compute breakpoints from the cell counts of the given visible
+         * tiles, returning null if we don't have them all yet.
+         */
+        computeColorBuckets: function(visible) {
+            var self = this;
+
+            var crimeCounts = [];
+            var urls = Object.keys(visible);
+            for (var i = 0; i < urls.length; ++i) {
+                var entry = self.tileCache[urls[i]];
+                if (!entry) {
+                    return null;
                 }
-            }).addTo(map);
-            self.currentLayers.push(l);
 
-            l = L.control({position: 'bottomright'});
-            l.onAdd = function(map) {
+                // Not all tiles have data, e.g. if we got a 404 from the
+                // server for this tile
+                if (entry.data) {
+                    entry.data.forEach(function(gc) {
+                        crimeCounts.push(gc.crime_count);
+                    });
+                }
+            }
+
+            if (crimeCounts.length === 0) {
+                return null;
+            }
+
+            return computePercentiles(crimeCounts, GRID_PERCENTILES);
+        },
+
+        /**
+         * Discard the least recently used tiles until the cache is within
+         * its limit. Tiles on the map now are never discarded.
+         */
+        evictTiles: function() {
+            var self = this;
+
+            var excess = self.tileCacheSize - self.options.maxCachedTiles;
+            if (excess <= 0) {
+                return;
+            }
+
+            var candidates = Object.keys(self.tileCache).filter(function(url) {
+                return self.tileCache[url].lastUsed < self.generation;
+            });
+            candidates.sort(function(a, b) {
+                return self.tileCache[a].lastUsed - self.tileCache[b].lastUsed;
+            });
+
+            candidates.slice(0, excess).forEach(function(url) {
+                delete self.tileCache[url];
+                --self.tileCacheSize;
+            });
+        },
+
+        renderLegend: function(map) {
+            var self = this;
+            var colorBuckets = self.colorBuckets;
+
+            if (self.legend) {
+                map.removeControl(self.legend);
+            }
+
+            self.legend = L.control({position: 'bottomright'});
+            self.legend.onAdd = function(map) {
                 var legendDiv = L.DomUtil.create('div');
                 legendDiv.setAttribute('id', 'crimeDBLegend');
                 legendDiv.setAttribute(
@@ -345,8 +815,7 @@
 
                 return legendDiv;
             };
-            l.addTo(map);
-            self.currentLayers.push(l);
+            self.legend.addTo(map);
         }
     });
 